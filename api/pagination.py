@@ -0,0 +1,16 @@
+"""
+Pagination of the list endpoints of the api.
+"""
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """Keyset pagination on the primary key: each page is read with a
+    `WHERE id > <last id of the previous page>` query using the primary key
+    index, so the cost of a page does not depend on its position (unlike
+    OFFSET). The cursor of the next page is given in the `next` link.
+    """
+    ordering = 'id'
+    page_size = 1000
+    page_size_query_param = 'page_size'
+    max_page_size = 10000
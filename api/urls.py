@@ -5,8 +5,11 @@ from .views import (edge_list, edge_detail,
                     get_lanes_field_attribute,
                     get_length_field_attribute,
                     get_speed_field_attribute,
+                    edge_attributes,
                     edges_results,
                     get_field_from_edges_results,
+                    edges_results_intervals,
+                    edges_results_tile,
                     )
 from rest_framework import routers
 
@@ -25,7 +28,14 @@ urlpatterns = [
          get_length_field_attribute),
     path('network/<int:pk>/edges/speed/',
          get_speed_field_attribute),
+    path('network/<int:pk>/edges/attributes/', edge_attributes,
+         name='edge_attributes'),
      path('run/<str:pk>/edges_results/', edges_results),
+    path('run/<str:pk>/edges_results/intervals/', edges_results_intervals,
+         name='edges_results_intervals'),
     path('run/<str:pk>/edges_results/<str:field>', get_field_from_edges_results),
+    path('run/<str:pk>/edges_results/<str:field>/<int:interval>/'
+         '<int:z>/<int:x>/<int:y>.bin',
+         edges_results_tile, name='edges_results_tile'),
     
     ]
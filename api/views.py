@@ -1,25 +1,144 @@
 # from rest_framework import viewsets
 from rest_framework import status
+from .pagination import KeysetPagination
 from .serializers import (EdgeSerializer, EdgeResultsSerializer)
-from metro_app.models import Edge, RoadNetwork, EdgeResults, Run, RoadType
+from metro_app.models import Edge, RoadNetwork, EdgeResults, Run
+from metro_app.result_store import (EDGE_FIELDS, has_result_store,
+                                    load_array)
+from metro_app.result_tiles import get_intervals, get_result_tile
+from metro_app.tiles import encode_feature_ids, is_valid_tile
+from metro_app.visualization_cache import bump_network_version
 from rest_framework.response import Response
-from django.http import HttpResponse, Http404 # JsonResponse
+from django.http import (HttpResponse, HttpResponseBadRequest, Http404,
+                         JsonResponse, StreamingHttpResponse)
+from django.shortcuts import get_object_or_404
 from rest_framework.decorators import api_view
 import json
 from django.shortcuts import render
+import csv
 import datetime
+import io
+import itertools
+import numpy as np
+import pandas as pd
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import etag
+
+# Formats of the streamed lists, with their content type.
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+# Number of rows read from the database and serialized at once.
+STREAM_BATCH_SIZE = 2000
+EDGE_STREAM_COLUMNS = (
+    'id', 'network', 'edge_id', 'name', 'source', 'target', 'road_type',
+    'length', 'speed', 'lanes',
+)
+EDGE_RESULTS_STREAM_COLUMNS = (
+    'id', 'edge', 'run', 'time', 'congestion', 'travel_time', 'speed',
+)
+
+# Number of per-edge series of results serialized at once.
+SERIES_BATCH_SIZE = 1000
+
+# Attributes of the edges, with the default value of the road type when the
+# value of the edge is NULL.
+EDGE_ATTRIBUTES = {
+    'lanes': Coalesce('lanes', 'road_type__default_lanes'),
+    'speed': Coalesce('speed', 'road_type__default_speed'),
+    'length': F('length'),
+}
+
+
+def get_edge_attributes(roadnetwork, fields):
+    """Return the edge_id and the attributes of EDGE_ATTRIBUTES of the edges
+    of a network, ordered by edge_id, as a queryset of tuples (the defaults
+    are resolved by the database)."""
+    annotations = {
+        'attribute_{}'.format(field): EDGE_ATTRIBUTES[field]
+        for field in fields
+    }
+    return Edge.objects.filter(network=roadnetwork).annotate(
+        **annotations).order_by('edge_id').values_list(
+        'edge_id', *annotations)
+
+def to_stream_value(value):
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return value
+
+
+def stream_rows(columns, rows, stream_format):
+    """Yield rows (tuples of values for the columns) as NDJSON (one object
+    per line) or as CSV (with a header), by batches of STREAM_BATCH_SIZE rows.
+    """
+    rows = iter(rows)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if stream_format == 'csv':
+        writer.writerow(columns)
+    while batch := list(itertools.islice(rows, STREAM_BATCH_SIZE)):
+        batch = [[to_stream_value(value) for value in row] for row in batch]
+        if stream_format == 'csv':
+            writer.writerows(batch)
+        else:
+            for row in batch:
+                buffer.write(json.dumps(dict(zip(columns, row))))
+                buffer.write('\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if stream_format == 'csv' and buffer.tell():
+        yield buffer.getvalue()
+
+
+def streaming_response(stream_format, columns, queryset, filename):
+    """Return a response streaming the rows of a values_list queryset, read
+    with a server-side cursor so that the memory used does not depend on the
+    number of rows."""
+    if stream_format not in STREAM_FORMATS:
+        return HttpResponseBadRequest(
+            'Valid stream formats: {}'.format(', '.join(STREAM_FORMATS)))
+    rows = queryset.iterator(chunk_size=STREAM_BATCH_SIZE)
+    response = StreamingHttpResponse(
+        stream_rows(columns, rows, stream_format),
+        content_type=STREAM_FORMATS[stream_format])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+        filename, stream_format)
+    return response
+
 
 @api_view(['GET', 'POST'])
 def edge_list(request):
     """
     List all edges of all networks, or create a new edge.
+
+    The edges are paginated by keyset (see KeysetPagination). With the
+    `stream` parameter (ndjson or csv), all the edges are streamed instead.
     """
     if request.method == 'GET':
-        edges = Edge.objects.prefetch_related('network', 'source', 'target',
-                                              'road_type').all()
+        stream_format = request.GET.get('stream')
+        if stream_format is not None:
+            edges = Edge.objects.annotate(
+                resolved_speed=EDGE_ATTRIBUTES['speed'],
+                resolved_lanes=EDGE_ATTRIBUTES['lanes'],
+            ).order_by('id').values_list(
+                'id', 'network_id', 'edge_id', 'name', 'source_id',
+                'target_id', 'road_type_id', 'length', 'resolved_speed',
+                'resolved_lanes')
+            return streaming_response(stream_format, EDGE_STREAM_COLUMNS,
+                                      edges, 'edges')
+        # The road types are joined for the default speed and lanes.
+        edges = Edge.objects.select_related('road_type')
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(edges, request)
         context = {'request': request}  # for filtering by field in url
-        serializer = EdgeSerializer(edges, many=True, context=context)
-        return Response(serializer.data)
+        serializer = EdgeSerializer(page, many=True, context=context)
+        return paginator.get_paginated_response(serializer.data)
 
     elif request.method == 'POST':
         serializer = EdgeSerializer(data=request.data)
@@ -35,7 +154,7 @@ def edge_detail(request, pk):
     Display a single edge instance of all network.
     """
     try:
-        edge = Edge.objects.get(pk=pk)
+        edge = Edge.objects.select_related('road_type').get(pk=pk)
     except Edge.DoesNotExist:
         return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -52,6 +171,8 @@ def edge_detail(request, pk):
 
     elif request.method == 'DELETE':
         edge.delete()
+        # The deletions do not send signals (see metro_app/signals.py).
+        bump_network_version(edge.network_id)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -66,20 +187,15 @@ def edges_of_a_network(request, pk):
         return Response(status=status.HTTP_404_NOT_FOUND)
 
     else:
-        edges = Edge.objects.values("road_type_id", "edge_id",
-                                    "name", "length", "speed",
-                                    "lanes").filter(network=roadnetwork)
-        roadtypes = RoadType.objects.filter(network=roadnetwork)
-        roadtypes = {roadtype.id: roadtype for roadtype in roadtypes}
-
-        for edge in edges:
-            if edge["lanes"] is None:
-                edge['lanes'] = roadtypes[edge['road_type_id']].default_lanes
-
-            if edge["speed"] is None:
-                edge['speed'] = roadtypes[edge['road_type_id']].default_speed
-
-    edges = json.dumps(list(edges))
+        edges = Edge.objects.filter(network=roadnetwork).annotate(
+            resolved_speed=EDGE_ATTRIBUTES['speed'],
+            resolved_lanes=EDGE_ATTRIBUTES['lanes'],
+        ).values_list("road_type_id", "edge_id", "name", "length",
+                      "resolved_speed", "resolved_lanes")
+        keys = ("road_type_id", "edge_id", "name", "length", "speed", "lanes")
+        edges = [dict(zip(keys, edge)) for edge in edges]
+
+    edges = json.dumps(edges)
     if request.method == 'GET':
         return HttpResponse(edges, content_type="application/json")
         """"serializer = EdgeSerializer(edges, context={'request': request},
@@ -109,11 +225,10 @@ def single_edge_instance_of_a_network(request, pk, id):
         return render(request, 'mapbox_popup.html', {'edge': edge})
 
 
-def get_lanes_field_attribute(request, pk):
+def get_field_attribute(request, pk, field):
     """
-    This function is for filtering only lanes field from the api instead of
-    having them all (name, speed, lanes and length). The results will used to
-    as speed_output in the hml roadtype filter in the visualization.
+    Return the values of a field of EDGE_ATTRIBUTES for all the edges of a
+    network, as a dictionary {edge_id: value}.
     """
     try:
         roadnetwork = RoadNetwork.objects.get(pk=pk)
@@ -122,44 +237,27 @@ def get_lanes_field_attribute(request, pk):
         return Response(status=status.HTTP_404_NOT_FOUND)
 
     else:
-        edges = Edge.objects.filter(
-            network=roadnetwork).values('road_type_id', 'edge_id', 'lanes')
-        roadtypes = RoadType.objects.filter(network=roadnetwork)
-        roadtypes = {roadtype.id: roadtype for roadtype in roadtypes}
-        lanes_dict = {}
-        for edge in edges:
-            if edge["lanes"] is None:
-                edge['lanes'] = roadtypes[edge['road_type_id']].default_lanes
-
-            values_list = list(edge.values())
-            lanes_dict[values_list[1]] = values_list[2]
-
-        edges = json.dumps(lanes_dict)
+        edges = json.dumps(dict(get_edge_attributes(roadnetwork, [field])))
     if request.method == 'GET':
         return HttpResponse(edges, content_type="application/json")
 
 
-def get_length_field_attribute(request, pk):
+def get_lanes_field_attribute(request, pk):
     """
-    This function is for filtering only length field from the api instead of
+    This function is for filtering only lanes field from the api instead of
     having them all (name, speed, lanes and length). The results will used to
     as speed_output in the hml roadtype filter in the visualization.
     """
-    try:
-        roadnetwork = RoadNetwork.objects.get(pk=pk)
-
-    except RoadNetwork.DoesNotExist:
-        return Response(status=status.HTTP_404_NOT_FOUND)
+    return get_field_attribute(request, pk, 'lanes')
 
-    else:
-        edges = Edge.objects.filter(
-            network=roadnetwork).values('edge_id', 'length')
-        length_dict = {list(edge.values())[0]: list(edge.values())[1]
-                       for edge in edges}
 
-        edges = json.dumps(length_dict)
-    if request.method == 'GET':
-        return HttpResponse(edges, content_type="application/json")
+def get_length_field_attribute(request, pk):
+    """
+    This function is for filtering only length field from the api instead of
+    having them all (name, speed, lanes and length). The results will used to
+    as speed_output in the hml roadtype filter in the visualization.
+    """
+    return get_field_attribute(request, pk, 'length')
 
 
 def get_speed_field_attribute(request, pk):
@@ -168,68 +266,213 @@ def get_speed_field_attribute(request, pk):
     having them all (name, speed, lanes and length). The results will used to
     as speed_output in the hml roadtype filter in the visualization.
     """
-    try:
-        roadnetwork = RoadNetwork.objects.get(pk=pk)
-
-    except RoadNetwork.DoesNotExist:
-        return Response(status=status.HTTP_404_NOT_FOUND)
-
-    else:
-        edges = Edge.objects.filter(
-            network=roadnetwork).values('road_type_id', 'edge_id', 'speed')
-
-        roadtypes = RoadType.objects.filter(network=roadnetwork)
-        roadtypes = {roadtype.id: roadtype for roadtype in roadtypes}
-
-        speed_dict = {}
-        for edge in edges:
-            if edge["speed"] is None:
-                edge['speed'] = roadtypes[edge['road_type_id']].default_speed
-
-            values_list = list(edge.values())
-            speed_dict[values_list[1]] = values_list[2]
-
-        edges = json.dumps(speed_dict)
-    if request.method == 'GET':
-        return HttpResponse(edges, content_type="application/json")
+    return get_field_attribute(request, pk, 'speed')
+
+
+def get_attribute_fields(request):
+    """Return the fields requested in the `fields` parameter (all the fields
+    of EDGE_ATTRIBUTES by default), or None if a field is invalid."""
+    fields = request.GET.get('fields')
+    if not fields:
+        return list(EDGE_ATTRIBUTES)
+    fields = fields.split(',')
+    if not all(field in EDGE_ATTRIBUTES for field in fields):
+        return None
+    return fields
+
+
+def edge_attributes_etag(request, pk):
+    # The attributes only change with the version of the network.
+    version = RoadNetwork.objects.filter(pk=pk).values_list(
+        'version', flat=True).first()
+    fields = get_attribute_fields(request)
+    if version is None or fields is None:
+        return None
+    # Weak, as the response is compressed depending on the request.
+    return 'W/"{}-{}-{}"'.format(pk, version, '-'.join(fields))
+
+
+@etag(edge_attributes_etag)
+@gzip_page
+def edge_attributes(request, pk):
+    """
+    Return attributes of all the edges of a network (with the defaults of
+    their road type) as little-endian binary arrays, for the styling of the
+    map:
+    - the edge ids (uint32 or float64, given by the X-Edge-Id-Type header,
+      see metro_app.tiles.encode_feature_ids);
+    - followed by one float32 array per field of the `fields` parameter
+      (comma-separated, in the order given by the X-Edge-Fields header), NaN
+      for NULL values.
+    The number of edges is given by the X-Edge-Count header.
+    """
+    roadnetwork = get_object_or_404(RoadNetwork, pk=pk)
+    fields = get_attribute_fields(request)
+    if fields is None:
+        return HttpResponseBadRequest(
+            'Valid fields: {}'.format(', '.join(EDGE_ATTRIBUTES)))
+    df = pd.DataFrame.from_records(
+        get_edge_attributes(roadnetwork, fields).iterator(),
+        columns=['edge_id'] + fields)
+    ids, id_type = encode_feature_ids(df['edge_id'].to_numpy(dtype=np.int64))
+    content = ids + b''.join(
+        df[field].to_numpy(dtype='<f4', na_value=np.nan).tobytes()
+        for field in fields
+    )
+    response = HttpResponse(content, content_type='application/octet-stream')
+    response['X-Edge-Count'] = len(df)
+    response['X-Edge-Id-Type'] = id_type
+    response['X-Edge-Fields'] = ','.join(fields)
+    # The browser revalidates the attributes with the ETag.
+    response['Cache-Control'] = 'no-cache'
+    return response
 
 @api_view(['GET'])
 def edges_results(request, pk):
-    """Return edges results data """
-    # roadnetwork = RoadNetwork.objects.get(pk=pk)
-
-    run = Run.objects.get(id=pk)
-    # network_id = run.network_id
-    edges = EdgeResults.objects.select_related(
-        'run').filter(run=run)
-   # edges = json.dumps(edges)
-    if request.method == 'GET':
-        #return HttpResponse(edges, content_type="application/json")
-        serializer = EdgeResultsSerializer(edges, 
-            context={'request': request}, many=True)
-        return Response(serializer.data)
+    """Return edges results data, paginated by keyset (see KeysetPagination),
+    or streamed with the `stream` parameter (ndjson or csv, with the times in
+    seconds)."""
+    run = get_object_or_404(Run, pk=pk)
+    edges = EdgeResults.objects.filter(run=run)
+    stream_format = request.GET.get('stream')
+    if stream_format is not None:
+        edges = edges.order_by('id').values_list(
+            'id', 'edge_id', 'run_id', 'time', 'congestion', 'travel_time',
+            'speed')
+        return streaming_response(stream_format, EDGE_RESULTS_STREAM_COLUMNS,
+                                  edges, 'edges_results')
+    paginator = KeysetPagination()
+    page = paginator.paginate_queryset(edges, request)
+    serializer = EdgeResultsSerializer(
+        page, context={'request': request}, many=True)
+    return paginator.get_paginated_response(serializer.data)
+
+
+def parse_series_filters(request):
+    """Return the time window (`start` and `end` parameters, in seconds since
+    midnight) and the edges (`edges` parameter, comma-separated edge ids) of
+    a request for edge results. The parameters not given are None.
+
+    :raises ValueError: If a parameter is invalid.
+    """
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    edges = request.GET.get('edges')
+    return (
+        float(start) if start else None,
+        float(end) if end else None,
+        [int(edge) for edge in edges.split(',') if edge] if edges else None,
+    )
+
+
+def iter_store_series(run, field, start, end, edge_ids):
+    """Yield the edge_id and the time-ordered results of the edges of a run,
+    from its columnar store."""
+    user_ids = load_array(run, 'edge_user_ids')
+    breakpoints = load_array(run, 'breakpoints')
+    first = 0 if start is None else np.searchsorted(breakpoints, start)
+    last = len(breakpoints) if end is None else np.searchsorted(
+        breakpoints, end, side='right')
+    if edge_ids is None:
+        rows = np.arange(len(user_ids))
+    else:
+        rows = np.flatnonzero(np.isin(user_ids, edge_ids))
+    matrix = load_array(run, field)
+    for i in range(0, len(rows), SERIES_BATCH_SIZE):
+        batch = rows[i:i + SERIES_BATCH_SIZE]
+        values = np.asarray(matrix[batch, first:last])
+        # NaN and infinity are not valid JSON.
+        values = np.where(np.isfinite(values), values, None)
+        yield from zip(user_ids[batch].tolist(), values.tolist())
+
+
+def iter_database_series(run, field, start, end, edge_ids):
+    """Yield the edge_id and the time-ordered results of the edges of a run,
+    aggregated by the database (one array per edge, ordered by time)."""
+    edges = Edge.objects.filter(network=run.network.road_network)
+    if edge_ids is not None:
+        edges = edges.filter(edge_id__in=edge_ids)
+    user_ids = dict(edges.values_list('id', 'edge_id'))
+    results = EdgeResults.objects.filter(run=run)
+    if start is not None:
+        results = results.filter(time__gte=datetime.timedelta(seconds=start))
+    if end is not None:
+        results = results.filter(time__lte=datetime.timedelta(seconds=end))
+    if edge_ids is not None:
+        results = results.filter(edge_id__in=list(user_ids))
+    series = results.values('edge_id').annotate(
+        series=ArrayAgg(field, ordering='time')
+    ).order_by('edge_id').values_list('edge_id', 'series')
+    for edge_id, values in series.iterator(chunk_size=SERIES_BATCH_SIZE):
+        yield user_ids[edge_id], values
+
+
+def stream_series(series):
+    """Yield the JSON object {edge_id: [values]} of per-edge series, by
+    batches of SERIES_BATCH_SIZE edges."""
+    yield '{'
+    separator = ''
+    while batch := list(itertools.islice(series, SERIES_BATCH_SIZE)):
+        yield separator + ','.join(
+            '"{}":{}'.format(edge_id, json.dumps(
+                values, default=datetime.timedelta.total_seconds))
+            for edge_id, values in batch
+        )
+        separator = ','
+    yield '}'
+
 
 @api_view(['GET'])
 def get_field_from_edges_results(request, pk, field):
-   
-    if not field in ("congestion", "speed", "travel_time"):
+    """
+    Return the results of the edges of a run for a field, as time-ordered
+    series {edge_id: [value at each interval]}. The series are built by the
+    columnar store or by the database and streamed to the client.
+
+    The optional parameters `start` and `end` (in seconds since midnight,
+    included) restrict the series to a time window and the optional parameter
+    `edges` (comma-separated edge ids) restricts the results to some edges.
+    """
+    if not field in EDGE_FIELDS:
         raise Http404
-        # return Response(status=status.HTTP_404_NOT_FOUND)
-    
-    run = Run.objects.get(id=pk)
-    edges = EdgeResults.objects.select_related('run').filter(
-        run=run).values("edge__edge_id", field)
-
-    speed_dict = {}
-    for dictionary in edges:
-        if dictionary["edge__edge_id"] in speed_dict:
-            speed_dict[dictionary["edge__edge_id"]].append(dictionary[field])
-        else:
-            speed_dict[dictionary["edge__edge_id"]] = [dictionary[field]]
-    
-    edges = json.dumps(speed_dict, default=datetime.timedelta.total_seconds)
-    if request.method == 'GET':
-        return HttpResponse(edges, content_type="application/json")
 
+    run = get_object_or_404(Run, pk=pk)
+    try:
+        start, end, edge_ids = parse_series_filters(request)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid start, end or edges.')
+    if has_result_store(run):
+        # Read the results from the columnar store of the run.
+        series = iter_store_series(run, field, start, end, edge_ids)
+    else:
+        series = iter_database_series(run, field, start, end, edge_ids)
+    return StreamingHttpResponse(
+        stream_series(series), content_type="application/json")
+
+
+def edges_results_intervals(request, pk):
+    """Return the times of the intervals of the results of a run (in seconds
+    since midnight)."""
+    run = get_object_or_404(Run, pk=pk)
+    return JsonResponse({'intervals': get_intervals(run).tolist()})
 
 
+def edges_results_tile(request, pk, field, interval, z, x, y):
+    """Return the results of the edges of a map tile for one interval, as a
+    binary array (see metro_app/result_tiles.py)."""
+    if field not in EDGE_FIELDS or not is_valid_tile(z, x, y):
+        raise Http404
+    run = get_object_or_404(
+        Run.objects.select_related('parameter_set', 'network__road_network'),
+        pk=pk,
+    )
+    if run.network.road_network.simple:
+        raise Http404
+    try:
+        content, id_type = get_result_tile(run, field, interval, z, x, y)
+    except IndexError:
+        raise Http404
+    response = HttpResponse(content, content_type='application/octet-stream')
+    response['X-Edge-Id-Type'] = id_type
+    response['Cache-Control'] = 'max-age=3600'
+    return response
@@ -0,0 +1 @@
+default_app_config = 'metro_app.apps.MetroAppConfig'
@@ -4,12 +4,15 @@ from metro_app.models import Agent, Population, Vehicle, Zone
 from metro_app.forms import AgentForm, AgentFileForm
 from metro_app.filters import AgentFilter
 from metro_app.tables import AgentTable
-from django_tables2 import RequestConfig
+from metro_app.pagination import paginate_table
 import json
+import uuid
 from datetime import timedelta
-from metro_app.simulation_io import generate_agents
+from metro_app.simulation_io import (generate_agents, generate_agents_shard,
+                                     get_population_shards)
 from django_q.tasks import async_task
-from metro_app.hooks import str_hook
+from metro_app.hooks import str_hook, agent_shard_hook
+from metro_app.deletion import start_deletion_task
 from metro_app.models import Population, BackgroundTask
 
 
@@ -147,15 +150,14 @@ def agent_table(request, pk):
     population = Population.objects.get(id=pk)
     agent = Agent.objects.select_related().filter(population=population)
     my_filter = AgentFilter(request.GET, queryset=agent)
-    table = AgentTable(my_filter.qs)
-    RequestConfig(request).configure(table)
-    table.paginate(page=request.GET.get("page", 1), per_page=15)
+    table, pagination = paginate_table(request, AgentTable, my_filter.qs)
 
     current_path = request.get_full_path()
     network_attribute = current_path.split("/")[4]
     context = {
         "table": table,
         "filter": my_filter,
+        "pagination": pagination,
         "population": population,
         "network_attribute": network_attribute
     }
@@ -164,10 +166,12 @@ def agent_table(request, pk):
 def delete_agents(request, pk):
     population = Population.objects.get(id=pk)
     agents = Agent.objects.filter(population=population)
-    if agents:
+    if agents.exists():
         if request.method == 'POST':
-            agents.delete()
-            messages.success(request, "Population successfuly deleted")
+            start_deletion_task(Agent, {'population': population.id},
+                                population.project, 'Deleting agents',
+                                population=population)
+            messages.success(request, "Agent deletion started")
             return redirect('population_details', pk)
     else:
         messages.warning(request, "There is no data to delete")
@@ -189,14 +193,29 @@ def generate_agents_input(request, pk):
             please create one before !')
         return redirect('population_details', population.pk)
 
-    task_id = async_task(generate_agents, population,  hook=str_hook)
+    nb_shards = len(get_population_shards(population))
     description = 'Generating agents'
-    db_task = BackgroundTask(
-        project=population.project,
-        id=task_id,
-        description=description,
-        population=population)
-    db_task.save()
+    if nb_shards > 1 and not population.virtual:
+        # The shards are generated in parallel by the django-q workers; the
+        # BackgroundTask is updated by the hook when all of them are done.
+        group = str(uuid.uuid4())
+        db_task = BackgroundTask(
+            project=population.project,
+            id=group,
+            description=description,
+            population=population)
+        db_task.save()
+        for index in range(nb_shards):
+            async_task(generate_agents_shard, population, index, nb_shards,
+                       group=group, hook=agent_shard_hook)
+    else:
+        task_id = async_task(generate_agents, population,  hook=str_hook)
+        db_task = BackgroundTask(
+            project=population.project,
+            id=task_id,
+            description=description,
+            population=population)
+        db_task.save()
     messages.success(request, "Task successfully started")
     return redirect('population_details', pk)
     
@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_migrate
 
 
 class MetroAppConfig(AppConfig):
     name = 'metro_app'
+
+    def ready(self):
+        # Connect the signal receivers.
+        from . import signals
+        pre_migrate.connect(signals.create_extensions, sender=self)
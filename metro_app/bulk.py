@@ -0,0 +1,385 @@
+"""
+Bulk loading of rows in the database.
+
+Large imports (network files, generated agents, simulation results) insert
+millions of rows. On PostgreSQL, the rows are streamed to the server with
+COPY FROM STDIN, which is much faster than INSERT statements. On the other
+database backends, the rows are converted to model instances and inserted with
+bulk_create.
+
+The rows are given as tuples of values, one value for each of the columns
+passed to bulk_load:
+- foreign keys are given as the primary key of the related instance;
+- durations are given as timedelta or as a number of seconds;
+- geometries are given as GEOS or Shapely geometries, or as (E)WKB hex strings
+  (the SRID of the field is used if the geometry does not have one); with
+  bulk_load_columns, arrays of strings must be EWKB with a SRID, as returned
+  by points_to_ewkb, segments_to_ewkb and geometries_to_ewkb.
+"""
+import io
+import itertools
+import math
+from datetime import timedelta
+
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.geos import GEOSGeometry
+import numpy as np
+from django.db import connection, models
+
+# Number of rows sent to the database at once.
+BATCH_SIZE = 10000
+
+COPY_NULL = '\\N'
+# Format of the durations, in seconds (fixed-point: PostgreSQL does not parse
+# the exponent notation in intervals).
+DURATION_FORMAT = '{:.6f} seconds'
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+def to_seconds(value):
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+def to_ewkb(value, srid):
+    """Returns the hexadecimal EWKB representation of a geometry, with the
+    given SRID if the geometry does not have one.
+    """
+    if isinstance(value, GEOSGeometry):
+        if value.srid is None:
+            value = value.clone()
+            value.srid = srid
+        hexewkb = value.hexewkb
+        return hexewkb.decode() if isinstance(hexewkb, bytes) else hexewkb
+    if isinstance(value, (str, bytes)):
+        # Already a WKB or EWKB hex string.
+        return to_ewkb(GEOSGeometry(value), srid)
+    # Shapely geometry.
+    from shapely import wkb
+    return wkb.dumps(value, hex=True, srid=srid)
+
+
+# Hexadecimal representation of each byte.
+HEX_BYTES = np.array(['{:02X}'.format(i) for i in range(256)])
+
+# Little-endian EWKB of a 2D point with a SRID.
+EWKB_POINT = np.dtype([
+    ('byte_order', 'u1'),
+    ('type', '<u4'),
+    ('srid', '<u4'),
+    ('x', '<f8'),
+    ('y', '<f8'),
+])
+# Little-endian EWKB of a 2D LineString with two points and a SRID.
+EWKB_SEGMENT = np.dtype([
+    ('byte_order', 'u1'),
+    ('type', '<u4'),
+    ('srid', '<u4'),
+    ('nb_points', '<u4'),
+    ('x0', '<f8'),
+    ('y0', '<f8'),
+    ('x1', '<f8'),
+    ('y1', '<f8'),
+])
+WKB_POINT = 1
+WKB_LINESTRING = 2
+EWKB_SRID_FLAG = 0x20000000
+
+
+def to_hex(records):
+    """Returns the hexadecimal representation of each record of a structured
+    array, as an array of strings.
+    """
+    hex_bytes = HEX_BYTES[records.view(np.uint8).reshape(
+        len(records), records.dtype.itemsize)]
+    return np.ascontiguousarray(hex_bytes).view(
+        '<U{}'.format(2 * records.dtype.itemsize)).ravel()
+
+
+def points_to_ewkb(x, y, srid):
+    """Returns the hexadecimal EWKB representation of points, from arrays of
+    coordinates, without creating a geometry object per point.
+
+    :returns: Array of strings.
+    :rtype: numpy.ndarray
+    """
+    points = np.empty(len(x), dtype=EWKB_POINT)
+    points['byte_order'] = 1
+    points['type'] = WKB_POINT | EWKB_SRID_FLAG
+    points['srid'] = srid
+    points['x'] = x
+    points['y'] = y
+    return to_hex(points)
+
+
+def segments_to_ewkb(x0, y0, x1, y1, srid):
+    """Returns the hexadecimal EWKB representation of straight LineStrings
+    from (x0, y0) to (x1, y1), from arrays of coordinates.
+
+    :returns: Array of strings.
+    :rtype: numpy.ndarray
+    """
+    segments = np.empty(len(x0), dtype=EWKB_SEGMENT)
+    segments['byte_order'] = 1
+    segments['type'] = WKB_LINESTRING | EWKB_SRID_FLAG
+    segments['srid'] = srid
+    segments['nb_points'] = 2
+    segments['x0'] = x0
+    segments['y0'] = y0
+    segments['x1'] = x1
+    segments['y1'] = y1
+    return to_hex(segments)
+
+
+def geometries_to_ewkb(geometries, srid):
+    """Returns the hexadecimal EWKB representation of an array of Shapely
+    geometries (missing geometries are kept as None), converted at once by
+    Shapely.
+
+    :returns: Array of strings (or None).
+    :rtype: numpy.ndarray
+    """
+    import shapely
+    geometries = shapely.set_srid(np.asarray(geometries, dtype=object), srid)
+    return shapely.to_wkb(geometries, hex=True, include_srid=True)
+
+
+def copy_formatter(field):
+    """Returns a function converting a value of the field to its
+    representation in the text format of COPY.
+    """
+    if field.is_relation:
+        # Foreign keys are given as the primary key of the related instance.
+        return copy_formatter(field.target_field)
+    if isinstance(field, GeometryField):
+        return lambda value: to_ewkb(value, field.srid)
+    if isinstance(field, models.DurationField):
+        return lambda value: DURATION_FORMAT.format(to_seconds(value))
+    if isinstance(field, models.BooleanField):
+        return lambda value: 't' if value else 'f'
+    if isinstance(field, models.FloatField):
+        return lambda value: repr(float(value))
+    if isinstance(field, (models.IntegerField, models.AutoField)):
+        return lambda value: str(int(value))
+    return lambda value: str(value).translate(COPY_ESCAPES)
+
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def get_fields(model, columns):
+    return [model._meta.get_field(column) for column in columns]
+
+
+def get_default_fields(model, fields):
+    """Returns the fields which are not given in the rows but have a default
+    value (the defaults are set by Django, not by the database, so they must
+    be sent explicitly with COPY).
+    """
+    return [
+        field for field in model._meta.concrete_fields
+        if field not in fields and field.has_default()
+    ]
+
+
+def get_copy_sql(model, fields):
+    return 'COPY {} ({}) FROM STDIN'.format(
+        connection.ops.quote_name(model._meta.db_table),
+        ', '.join(connection.ops.quote_name(field.column) for field in fields),
+    )
+
+
+def copy_rows(model, columns, rows, batch_size=BATCH_SIZE):
+    """Inserts rows in the table of a model with COPY FROM STDIN
+    (PostgreSQL only).
+    """
+    fields = get_fields(model, columns)
+    default_fields = get_default_fields(model, fields)
+    formatters = [copy_formatter(field) for field in fields + default_fields]
+    sql = get_copy_sql(model, fields + default_fields)
+    count = 0
+    rows = iter(rows)
+    with connection.cursor() as cursor:
+        while batch := list(itertools.islice(rows, batch_size)):
+            buffer = io.StringIO()
+            for row in batch:
+                row = itertools.chain(
+                    row, (field.get_default() for field in default_fields))
+                buffer.write('\t'.join(
+                    COPY_NULL if is_null(value) else formatter(value)
+                    for formatter, value in zip(formatters, row)
+                ))
+                buffer.write('\n')
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+            count += len(batch)
+    return count
+
+
+def format_value(field, value):
+    return COPY_NULL if is_null(value) else copy_formatter(field)(value)
+
+
+def format_array(field, values):
+    """Returns the representations in the text format of COPY of an array of
+    values of a field, as a list of strings.
+
+    Numeric and boolean arrays are converted by NumPy, without calling a
+    Python function for each value.
+    """
+    if field.is_relation:
+        field = field.target_field
+    if isinstance(field, GeometryField) and values.dtype.kind == 'U':
+        # Hexadecimal EWKB (see points_to_ewkb).
+        return values.tolist()
+    if isinstance(field, GeometryField):
+        # The strings are hexadecimal EWKB, the other geometries are
+        # converted one by one.
+        return [value if isinstance(value, str) else format_value(field, value)
+                for value in values.tolist()]
+    if values.dtype.kind not in 'biuf':
+        return [format_value(field, value) for value in values.tolist()]
+    if values.dtype.kind == 'b':
+        return np.where(values, 't', 'f').tolist()
+    nulls = np.isnan(values) if values.dtype.kind == 'f' else False
+    if isinstance(field, (models.IntegerField, models.AutoField)):
+        # Float arrays of integer fields (e.g. read with missing values).
+        strings = np.where(nulls, 0, values).astype(np.int64).astype(str)
+    elif isinstance(field, models.DurationField):
+        strings = np.char.mod('%.6f seconds', np.where(nulls, 0, values))
+    else:
+        strings = values.astype(str)
+    if np.any(nulls):
+        strings = np.where(nulls, COPY_NULL, strings)
+    return strings.tolist()
+
+
+def copy_columns(model, columns, size, batch_size=BATCH_SIZE):
+    """Inserts rows given column-wise in the table of a model with COPY FROM
+    STDIN (PostgreSQL only).
+    """
+    fields = get_fields(model, columns)
+    default_fields = get_default_fields(model, fields)
+    sql = get_copy_sql(model, fields + default_fields)
+    with connection.cursor() as cursor:
+        for start in range(0, size, batch_size):
+            n = min(batch_size, size - start)
+            strings = list()
+            for field, values in zip(fields, columns.values()):
+                if isinstance(values, np.ndarray):
+                    strings.append(
+                        format_array(field, values[start:start + n]))
+                else:
+                    strings.append(
+                        itertools.repeat(format_value(field, values), n))
+            for field in default_fields:
+                if callable(field.default):
+                    strings.append([
+                        format_value(field, field.get_default())
+                        for _ in range(n)
+                    ])
+                else:
+                    strings.append(itertools.repeat(
+                        format_value(field, field.get_default()), n))
+            buffer = io.StringIO()
+            buffer.write('\n'.join(map('\t'.join, zip(*strings))))
+            buffer.write('\n')
+            buffer.seek(0)
+            cursor.copy_expert(sql, buffer)
+    return size
+
+
+def model_value(field, value):
+    """Converts a value of a row to the Python type expected by the field."""
+    if is_null(value):
+        return None
+    if isinstance(field, GeometryField):
+        return GEOSGeometry(to_ewkb(value, field.srid))
+    if isinstance(field, models.DurationField):
+        return timedelta(seconds=to_seconds(value))
+    return value
+
+
+def iter_instances(model, columns, rows):
+    """Yields unsaved instances of a model built from rows (in the format of
+    bulk_load).
+    """
+    fields = get_fields(model, columns)
+    for row in rows:
+        yield model(**{
+            field.attname: model_value(field, value)
+            for field, value in zip(fields, row)
+        })
+
+
+def create_rows(model, columns, rows, batch_size=BATCH_SIZE):
+    """Inserts rows in the table of a model with bulk_create."""
+    count = 0
+    instances = iter_instances(model, columns, rows)
+    while batch := list(itertools.islice(instances, batch_size)):
+        model.objects.bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def bulk_load(model, columns, rows, batch_size=BATCH_SIZE):
+    """Inserts rows in the table of a model, using COPY on PostgreSQL and
+    bulk_create on the other database backends.
+
+    :param model: Model class of the rows.
+    :param columns: Name of the fields of the model given in each row.
+    :param rows: Iterable of tuples with one value per column.
+    :param batch_size: Maximum number of rows held in memory and sent to the
+       database at once.
+    :type model: django.db.models.Model
+    :type columns: list of str
+    :type rows: iterable of tuple
+    :type batch_size: integer
+    :returns: Number of rows inserted.
+    :rtype: integer
+    """
+    if connection.vendor == 'postgresql':
+        return copy_rows(model, columns, rows, batch_size)
+    else:
+        return create_rows(model, columns, rows, batch_size)
+
+
+def bulk_load_columns(model, columns, size, batch_size=BATCH_SIZE):
+    """Inserts rows given column-wise in the table of a model.
+
+    This is equivalent to bulk_load but, on PostgreSQL, the numeric columns
+    are converted to text by NumPy, which is much faster for large tables.
+
+    :param model: Model class of the rows.
+    :param columns: Dictionary mapping the names of fields of the model to a
+       NumPy array of `size` values, or to a single value used for all the
+       rows.
+    :param size: Number of rows.
+    :param batch_size: Maximum number of rows sent to the database at once.
+    :type model: django.db.models.Model
+    :type columns: dict
+    :type size: integer
+    :type batch_size: integer
+    :returns: Number of rows inserted.
+    :rtype: integer
+    """
+    if connection.vendor == 'postgresql':
+        return copy_columns(model, columns, size, batch_size)
+    return create_rows(
+        model, list(columns), iter_column_rows(columns, size), batch_size)
+
+
+def iter_column_rows(columns, size):
+    """Yields the rows of columns given as in bulk_load_columns."""
+    return zip(*(
+        values.tolist() if isinstance(values, np.ndarray)
+        else itertools.repeat(values, size)
+        for values in columns.values()
+    ))
@@ -0,0 +1,141 @@
+"""
+Background deletion of large sets of objects.
+
+Django's .delete() collects all the objects deleted in cascade in memory
+(runs, populations and networks have millions of agents and result rows) and
+deletes them in a single transaction. delete_objects deletes them with plain
+SQL instead:
+- the models deleted in cascade are walked from the foreign keys, and the
+  rows of each model are deleted before the rows they reference;
+- the rows are deleted by chunks of DELETE_CHUNK_SIZE, each chunk in its own
+  transaction, so that the locks are held briefly and the progress is visible
+  in the BackgroundTask;
+- when the result tables are partitioned by run (see partitions.py), the
+  partitions of the deleted runs are dropped instead of deleting their rows.
+
+The deletion does not send the pre_delete and post_delete signals: the work
+done by the receivers (partitions, network versions) is done here.
+
+If the task fails, the rows deleted so far are only dependent rows, so the
+deletion can be started again.
+"""
+import shutil
+import uuid
+
+from django.db import models
+from django_q.tasks import async_task
+
+from .hooks import progress_reporter, str_hook
+from .models import BackgroundTask, Edge, Node, Run
+from .partitions import drop_run_partitions
+from .result_store import get_result_directory
+from .visualization_cache import bump_network_version
+
+# Number of rows deleted in each transaction.
+DELETE_CHUNK_SIZE = 10000
+
+
+def join_lookup(*parts):
+    return '__'.join(part for part in parts if part)
+
+
+def iter_cascade(model, lookup='', ancestors=()):
+    """Yields the models deleted in cascade with the rows of a model (and the
+    model itself), with the lookup from each model to the deleted rows (empty
+    for the model itself). The dependent models are yielded before the models
+    they reference.
+    """
+    ancestors += (model, )
+    for relation in model._meta.related_objects:
+        related_model = relation.related_model
+        if (relation.on_delete is not models.CASCADE
+                or related_model in ancestors):
+            continue
+        yield from iter_cascade(
+            related_model,
+            join_lookup(relation.field.name, lookup),
+            ancestors,
+        )
+    yield model, lookup
+
+
+def delete_in_chunks(queryset, report, chunk_size=DELETE_CHUNK_SIZE):
+    """Deletes the rows of a queryset by chunks, without fetching the
+    instances and without cascade.
+
+    :returns: Number of rows deleted.
+    :rtype: integer
+    """
+    step = 'Deleting {}'.format(queryset.model._meta.verbose_name_plural)
+    count = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            return count
+        count += queryset.filter(pk__in=pks)._raw_delete(queryset.db)
+        report(step, count)
+
+
+def drop_run_data(runs):
+    """Drops the result partitions and removes the result files of runs."""
+    for run in runs:
+        drop_run_partitions(run.id)
+        shutil.rmtree(get_result_directory(run), ignore_errors=True)
+
+
+def delete_objects(model, filters, task_id):
+    """Deletes the objects of a model matching filters and all the objects
+    deleted in cascade.
+
+    :param model: Model of the objects to delete.
+    :param filters: Filters of the objects to delete (e.g. `{'pk': run.id}`
+       or `{'network': roadnetwork.id}`).
+    :param task_id: Id of the BackgroundTask of the deletion, to which the
+       progress is reported (the BackgroundTask must not be deleted in
+       cascade).
+    :type model: django.db.models.Model
+    :type filters: dict
+    :type task_id: uuid.UUID
+    """
+    report = progress_reporter(id=task_id)
+    networks = set()
+    if model in (Node, Edge):
+        networks.update(model.objects.filter(**filters).values_list(
+            'network_id', flat=True).distinct())
+    querysets = [
+        related_model.objects.filter(**{
+            join_lookup(lookup, key): value for key, value in filters.items()
+        })
+        for related_model, lookup in iter_cascade(model)
+    ]
+    for queryset in querysets:
+        if queryset.model is Run:
+            # Before the result rows are deleted one by one.
+            drop_run_data(queryset.only('id'))
+    count = 0
+    for queryset in querysets:
+        count += delete_in_chunks(queryset, report)
+    for network_id in networks:
+        # The visualization artifacts of the previous version are now stale.
+        bump_network_version(network_id)
+    return '{} rows deleted'.format(count)
+
+
+def start_deletion_task(model, filters, project, description, **task_fields):
+    """Starts a background task deleting objects (see delete_objects).
+
+    :param task_fields: Foreign keys of the BackgroundTask (e.g.
+       `road_network=roadnetwork`), which must not be deleted by the task.
+    :type description: str
+    """
+    # The BackgroundTask is created first so that the task knows its id: its
+    # id is the group of the task (see hooks.str_hook).
+    task_id = uuid.uuid4()
+    BackgroundTask.objects.create(
+        id=task_id,
+        project=project,
+        description=description[:50],
+        **task_fields
+    )
+    async_task(delete_objects, model, filters, task_id, group=str(task_id),
+               hook=str_hook)
@@ -84,20 +84,25 @@ class ODPairFilter(django_filters.FilterSet):
 
 
 class AgentFilter(django_filters.FilterSet):
-    agent_id = NumberFilter(field_name='Agent id', lookup_expr='icontains',
+    # Exact lookups, which use the indexes of Agent (icontains on integers
+    # reads all the agents of the population).
+    agent_id = NumberFilter(field_name='agent_id', lookup_expr='exact',
                       widget=forms.TextInput(attrs={
                                   'class': 'form-control',
-                                  'placeholder': 'Agent id contains',
+                                  'placeholder': 'Agent id',
                               }))
-    origin_zone__zone_id = NumberFilter(field_name='Destination', lookup_expr='icontains',
+    origin_zone__zone_id = NumberFilter(field_name='origin_zone__zone_id',
+                                        lookup_expr='exact',
                       widget=forms.TextInput(attrs={
                                   'class': 'form-control',
-                                  'placeholder': 'Origin id contains',
+                                  'placeholder': 'Origin id',
                               }))
-    destination_zone__zone_id = NumberFilter(field_name='Origin', lookup_expr='icontains',
+    destination_zone__zone_id = NumberFilter(
+                      field_name='destination_zone__zone_id',
+                      lookup_expr='exact',
                       widget=forms.TextInput(attrs={
                                   'class': 'form-control',
-                                  'placeholder': 'Destination Id contains',
+                                  'placeholder': 'Destination id',
                               }))
     class Meta:
         model = Agent
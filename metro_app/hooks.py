@@ -1,11 +1,18 @@
 from django.core.files.storage import default_storage
+from django.utils import timezone
+from django_q.tasks import fetch_group
 from datetime import timedelta
-from .models import BackgroundTask
+from .models import Agent, BackgroundTask
 
 
 def str_hook(task):
-    """Hook for async task that return a string."""
-    db_task = BackgroundTask.objects.get(id=task.id)
+    """Hook for async task that return a string.
+
+    The BackgroundTask is the one whose id is the group of the task, if the
+    task has a group (for the tasks which need the id of their BackgroundTask,
+    created before them), or the id of the task otherwise.
+    """
+    db_task = BackgroundTask.objects.get(id=task.group or task.id)
     db_task.time_taken = timedelta(seconds=task.time_taken())
     db_task.result = str(task.result)
     if task.success:
@@ -17,3 +24,65 @@ def str_hook(task):
         if isinstance(arg, str) and default_storage.exists(arg):
             default_storage.delete(arg)
     db_task.save()
+
+
+def agent_shard_hook(task):
+    """Hook for the tasks generating the shards of the agents of a population
+    (see simulation_io.generate_agents_shard).
+
+    The tasks of a population belong to the same group, whose name is the id
+    of the BackgroundTask. The BackgroundTask is updated when the tasks of all
+    the shards are done. If one of them failed, all the agents of the
+    population are deleted.
+    """
+    db_task = BackgroundTask.objects.get(id=task.group)
+    population, _, nb_shards = task.args
+    # The current task is added in case its result is not saved yet.
+    tasks = {t.id: t for t in fetch_group(task.group, failures=True) or ()}
+    tasks[task.id] = task
+    tasks = list(tasks.values())
+    if len(tasks) < nb_shards:
+        db_task.result = 'Generated {} / {} shards'.format(
+            len(tasks), nb_shards)
+        db_task.progress = 100 * len(tasks) / nb_shards
+        db_task.save()
+        return
+    db_task.time_taken = timezone.now() - db_task.start_date
+    failures = [str(t.result) for t in tasks if not t.success]
+    if failures:
+        # Imported here, deletion.py imports the hooks.
+        from .deletion import delete_objects
+        # Deleted by chunks with plain SQL (see deletion.py), the progress is
+        # reported to the BackgroundTask.
+        delete_objects(Agent, {'population': population.id}, db_task.id)
+        db_task.status = BackgroundTask.FAILED
+        db_task.result = "Couldn't save agent due to his error: {}".format(
+            failures[0])
+    else:
+        population.generated = True
+        population.save()
+        db_task.status = BackgroundTask.FINISHED
+        db_task.result = 'Agents successfully created'
+    db_task.save()
+
+
+def progress_reporter(**filters):
+    """Returns a function reporting the progress of the in-progress
+    BackgroundTask matching the filters (e.g. `road_network=roadnetwork`).
+
+    The function takes a description of the current step, the number of
+    elements processed and the total number of elements (or None if unknown).
+    The updates are only visible to the other connections if they are not run
+    in a transaction.
+    """
+    def report(step, count, total=None):
+        if total:
+            result = '{}: {} / {}'.format(step, count, total)
+            progress = min(100.0, 100 * count / total)
+        else:
+            result = '{}: {}'.format(step, count)
+            progress = None
+        BackgroundTask.objects.filter(
+            status=BackgroundTask.INPROGRESS, **filters
+        ).update(result=result, progress=progress)
+    return report
@@ -0,0 +1,343 @@
+"""Benchmarks of the data-intensive tasks of MetroWeb.
+
+The benchmarks create synthetic instances in a transaction which is rolled
+back at the end, so they can be run against any database without leaving data
+behind.
+
+Usage::
+
+    python manage.py benchmark export --sizes 10000 100000 1000000
+    python manage.py benchmark generate_agents --sizes 100000 1000000
+    python manage.py benchmark offset_polygons --sizes 500000
+"""
+import shutil
+import time
+from datetime import timedelta
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import LineString, Point
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from metro_app.models import (Agent, Edge, Network, Node, ODMatrix, ODPair,
+                              ParameterSet, Population, PopulationSegment,
+                              Preferences, Project, RoadNetwork, RoadType, Run,
+                              Vehicle, Zone, ZoneNodeRelation, ZoneSet)
+from metro_app.networks import (BUFFER, OFFSET_CURVE, get_offset_polygon,
+                                get_offset_polygons)
+from metro_app.simulation_io import (generate_agents, generate_values,
+                                     get_input_directory, to_input_json)
+
+
+class Rollback(Exception):
+    """Raised to roll back the transaction of a benchmark."""
+
+
+def make_run(n_agents, n_zones=1000):
+    """Creates a run with a road network of `n_zones` nodes (one per zone)
+    and a population of `n_agents` agents.
+    """
+    user = User.objects.create(username='benchmark-{}'.format(time.time()))
+    project = Project.objects.create(owner=user, name='Benchmark')
+    road_network = RoadNetwork.objects.create(project=project,
+                                              name='Benchmark')
+    road_type = RoadType.objects.create(
+        network=road_network, road_type_id=1, congestion=RoadType.FREEFLOW)
+    Node.objects.bulk_create(
+        Node(network=road_network, node_id=i, location=Point(i * .001, 0))
+        for i in range(n_zones)
+    )
+    nodes = list(road_network.node_set.order_by('node_id'))
+    Edge.objects.bulk_create(
+        Edge(network=road_network, edge_id=i, source=source, target=target,
+             road_type=road_type, length=.1,
+             geometry=LineString(source.location, target.location))
+        for i, (source, target) in enumerate(zip(nodes[:-1], nodes[1:]))
+    )
+    zone_set = ZoneSet.objects.create(project=project, name='Benchmark')
+    Zone.objects.bulk_create(
+        Zone(zone_set=zone_set, zone_id=i, centroid=node.location)
+        for i, node in enumerate(nodes)
+    )
+    zones = list(zone_set.zone_set.order_by('zone_id'))
+    network = Network.objects.create(project=project,
+                                     road_network=road_network,
+                                     zone_set=zone_set, name='Benchmark')
+    ZoneNodeRelation.objects.bulk_create(
+        ZoneNodeRelation(network=network, zone=zone, node=node)
+        for zone, node in zip(zones, nodes)
+    )
+    vehicle = Vehicle.objects.create(project=project, vehicle_id=1,
+                                     length=8.0)
+    population = Population.objects.create(
+        project=project, zone_set=zone_set, random_seed=0, name='Benchmark')
+    Agent.objects.bulk_create(
+        (
+            Agent(
+                agent_id=i + 1,
+                population=population,
+                origin_zone=zones[i % n_zones],
+                destination_zone=zones[(i * 7 + 1) % n_zones],
+                mode_choice_model=Agent.FIRST_MODE,
+                t_star=timedelta(hours=8),
+                beta=5.0,
+                gamma=20.0,
+                vehicle=vehicle,
+                dep_time_car_choice_model=Agent.CONSTANT_DEP_TIME,
+                dep_time_car_constant=timedelta(hours=7),
+                car_vot=-10.0,
+            )
+            for i in range(n_agents)
+        ),
+        batch_size=10000,
+    )
+    parameter_set = ParameterSet.objects.create(
+        project=project, period_start=timedelta(hours=6),
+        period_end=timedelta(hours=10), random_seed=1, name='Benchmark')
+    return Run.objects.create(project=project, parameter_set=parameter_set,
+                              population=population, network=network,
+                              name='Benchmark')
+
+
+def make_population(n_agents, n_zones=1000):
+    """Creates a population with a single segment of `n_agents` agents,
+    spread over `n_zones` origin-destination pairs.
+    """
+    user = User.objects.create(username='benchmark-{}'.format(time.time()))
+    project = Project.objects.create(owner=user, name='Benchmark')
+    zone_set = ZoneSet.objects.create(project=project, name='Benchmark')
+    Zone.objects.bulk_create(
+        Zone(zone_set=zone_set, zone_id=i) for i in range(n_zones))
+    zones = list(zone_set.zone_set.order_by('zone_id'))
+    od_matrix = ODMatrix.objects.create(project=project, zone_set=zone_set,
+                                        size=n_agents, name='Benchmark')
+    sizes = [n_agents // n_zones + (i < n_agents % n_zones)
+             for i in range(n_zones)]
+    ODPair.objects.bulk_create(
+        ODPair(matrix=od_matrix, origin=zones[i],
+               destination=zones[(i * 7 + 1) % n_zones], size=size)
+        for i, size in enumerate(sizes) if size
+    )
+    vehicle = Vehicle.objects.create(project=project, vehicle_id=1,
+                                     length=8.0)
+    preferences = Preferences.objects.create(
+        project=project, name='Benchmark',
+        mode_choice_model=Preferences.FIRST_MODE,
+        t_star_distr=Preferences.NORMAL, t_star_mean=timedelta(hours=8),
+        t_star_std=timedelta(minutes=30),
+        beta_mean=5.0, gamma_mean=20.0, vehicle=vehicle,
+        dep_time_car_choice_model=Preferences.CONSTANT_DEP_TIME,
+        dep_time_car_constant_distr=Preferences.UNIFORM,
+        dep_time_car_constant_mean=timedelta(hours=7),
+        dep_time_car_constant_std=timedelta(hours=1),
+        car_vot_distr=Preferences.LOGNORMAL, car_vot_mean=2.0,
+        car_vot_std=0.5,
+    )
+    population = Population.objects.create(
+        project=project, zone_set=zone_set, random_seed=0, name='Benchmark')
+    PopulationSegment.objects.create(
+        population=population, preferences=preferences, od_matrix=od_matrix,
+        name='Benchmark')
+    return population
+
+
+def legacy_generate_agents(population):
+    """Agent generation with one Agent instance per agent and bulk_create, as
+    done before the columns of the agents were generated as arrays (restricted
+    to the models used by make_population).
+    """
+    agents = list()
+    i = 0
+    rng = np.random.default_rng(population.random_seed)
+    for population_segment in population.populationsegment_set.all():
+        preferences = population_segment.preferences
+        od_matrix = population_segment.od_matrix
+        size = od_matrix.size
+        t_star = generate_values(
+            rng, preferences.t_star_distr, preferences.t_star_mean,
+            preferences.t_star_std, size)
+        delta = generate_values(
+            rng, preferences.delta_distr, preferences.delta_mean,
+            preferences.delta_std, size)
+        beta = generate_values(
+            rng, preferences.beta_distr, preferences.beta_mean,
+            preferences.beta_std, size)
+        gamma = generate_values(
+            rng, preferences.gamma_distr, preferences.gamma_mean,
+            preferences.gamma_std, size)
+        dep_time_car_constant = generate_values(
+            rng, preferences.dep_time_car_constant_distr,
+            preferences.dep_time_car_constant_mean,
+            preferences.dep_time_car_constant_std, size)
+        car_vot = generate_values(
+            rng, preferences.car_vot_distr, preferences.car_vot_mean,
+            preferences.car_vot_std, size)
+        for od_pair in od_matrix.odpair_set.all():
+            for _ in range(od_pair.size):
+                agents.append(Agent(
+                    agent_id=i + 1,
+                    population=population,
+                    origin_zone=od_pair.origin,
+                    destination_zone=od_pair.destination,
+                    mode_choice_model=preferences.mode_choice_model,
+                    t_star=timedelta(seconds=t_star[i]),
+                    delta=timedelta(seconds=delta[i]),
+                    beta=beta[i] / 3600.0,
+                    gamma=gamma[i] / 3600.0,
+                    desired_arrival=preferences.desired_arrival,
+                    vehicle=preferences.vehicle,
+                    dep_time_car_choice_model=(
+                        preferences.dep_time_car_choice_model),
+                    dep_time_car_constant=timedelta(
+                        seconds=dep_time_car_constant[i]),
+                    car_vot=-car_vot[i] / 3600.0,
+                ))
+                i += 1
+    Agent.objects.bulk_create(agents)
+
+
+def make_road_geometries(n, seed=0):
+    """Returns `n` random LineStrings of three points (in EPSG:3857), with
+    random widths and half of the roads oneway, for the offset polygons
+    benchmark.
+    """
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(0, 1e5, size=(n, 1, 2))
+    steps = rng.normal(0, 100, size=(n, 2, 2))
+    coords = np.concatenate([start, start + np.cumsum(steps, axis=1)], axis=1)
+    linestrings = gpd.GeoSeries(shapely.linestrings(coords), crs='EPSG:3857')
+    widths = 3 * rng.integers(1, 5, size=n)
+    oneway = rng.random(n) < .5
+    return linestrings, widths, oneway
+
+
+class Command(BaseCommand):
+    help = 'Run benchmarks of the data-intensive tasks.'
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='benchmark', required=True)
+        export = subparsers.add_parser(
+            'export', help='Export of the simulator input file.')
+        export.add_argument(
+            '--sizes', type=int, nargs='+',
+            default=[10000, 100000, 1000000],
+            help='Number of agents of the populations to export.')
+        export.add_argument(
+            '--legacy-sample', type=int, default=10000,
+            help=(
+                'Number of agents used to time the legacy per-agent lookups '
+                '(the results are extrapolated to the full population).'
+            ))
+
+        generation = subparsers.add_parser(
+            'generate_agents', help='Generation of the agents of a population.')
+        generation.add_argument(
+            '--sizes', type=int, nargs='+', default=[100000, 1000000],
+            help='Number of agents of the populations to generate.')
+        generation.add_argument(
+            '--skip-legacy', action='store_true',
+            help='Do not time the legacy generation.')
+
+        offset = subparsers.add_parser(
+            'offset_polygons',
+            help='Computation of the road polygons of the visualization.')
+        offset.add_argument(
+            '--sizes', type=int, nargs='+', default=[500000],
+            help='Number of edges of the networks.')
+        offset.add_argument(
+            '--legacy-sample', type=int, default=10000,
+            help=(
+                'Number of edges used to time the legacy per-edge computation '
+                '(the results are extrapolated to the full network).'
+            ))
+
+    def handle(self, *args, **options):
+        getattr(self, 'benchmark_{}'.format(options['benchmark']))(**options)
+
+    def report(self, label, n, seconds, queries, extrapolated=False,
+               unit='agents'):
+        self.stdout.write(
+            '{:<24} {:>10} {} {:>10.2f} s {:>10} queries{}'.format(
+                label, n, unit, seconds, queries,
+                ' (extrapolated)' if extrapolated else ''))
+
+    def benchmark_export(self, sizes, legacy_sample, **options):
+        for n in sizes:
+            try:
+                with transaction.atomic():
+                    run = make_run(n)
+                    self.time_legacy_lookups(run, n, legacy_sample)
+                    self.time_export(run, n)
+                    raise Rollback
+            except Rollback:
+                pass
+
+    def time_legacy_lookups(self, run, n, sample):
+        """Zone-to-node resolution with two queries per agent, as done before
+        the zone-node map of the network was introduced.
+        """
+        sample = min(n, sample)
+        agents = run.population.agent_set.all()[:sample]
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for agent in agents:
+                agent.get_origin_node(run.network)
+                agent.get_destination_node(run.network)
+            seconds = time.perf_counter() - start
+        ratio = n / sample
+        self.report('legacy lookups', n, seconds * ratio,
+                    round(len(queries) * ratio), extrapolated=ratio > 1)
+
+    def time_export(self, run, n):
+        run = Run.objects.get(pk=run.pk)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            to_input_json(run)
+            seconds = time.perf_counter() - start
+        self.report('to_input_json', n, seconds, len(queries))
+        shutil.rmtree(get_input_directory(run), ignore_errors=True)
+
+    def benchmark_generate_agents(self, sizes, skip_legacy, **options):
+        functions = [('generate_agents', generate_agents)]
+        if not skip_legacy:
+            functions.insert(0, ('legacy generate_agents',
+                                 legacy_generate_agents))
+        for n in sizes:
+            for label, function in functions:
+                try:
+                    with transaction.atomic():
+                        population = make_population(n)
+                        with CaptureQueriesContext(connection) as queries:
+                            start = time.perf_counter()
+                            function(population)
+                            seconds = time.perf_counter() - start
+                        assert population.agent_set.count() == n, \
+                            'Invalid number of agents generated'
+                        self.report(label, n, seconds, len(queries))
+                        raise Rollback
+                except Rollback:
+                    pass
+
+    def benchmark_offset_polygons(self, sizes, legacy_sample, **options):
+        for n in sizes:
+            linestrings, widths, oneway = make_road_geometries(n)
+            sample = min(n, legacy_sample)
+            start = time.perf_counter()
+            for i in range(sample):
+                get_offset_polygon(linestrings.iloc[i], widths[i],
+                                   oneway=oneway[i])
+            seconds = time.perf_counter() - start
+            self.report('legacy per-edge', n, seconds * n / sample, 0,
+                        extrapolated=sample < n, unit='edges')
+            for method in (BUFFER, OFFSET_CURVE):
+                start = time.perf_counter()
+                get_offset_polygons(linestrings, widths, oneway,
+                                    method=method)
+                seconds = time.perf_counter() - start
+                self.report('vectorized {}'.format(method), n, seconds, 0,
+                            unit='edges')
@@ -0,0 +1,46 @@
+"""Store a slice of the agents of a virtual population in the database.
+
+Usage::
+
+    python manage.py materialize_agents <population id> --ids 1 1000
+    python manage.py materialize_agents <population id> --od 12 47
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from metro_app.models import Population
+from metro_app.simulation_io import materialize_agents
+
+
+class Command(BaseCommand):
+    help = 'Store a slice of the agents of a virtual population.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('population', type=int,
+                            help='Id of the population.')
+        parser.add_argument(
+            '--ids', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+            help='Range of agent ids to store (both included).')
+        parser.add_argument(
+            '--od', type=int, nargs=2, metavar=('ORIGIN', 'DESTINATION'),
+            help='Ids of the origin and destination zones of the agents.')
+
+    def handle(self, *args, **options):
+        try:
+            population = Population.objects.get(id=options['population'])
+        except Population.DoesNotExist:
+            raise CommandError('Population does not exist')
+        if not population.virtual:
+            raise CommandError('The population is not virtual')
+        kwargs = dict()
+        if options['ids']:
+            kwargs['first_id'], kwargs['last_id'] = options['ids']
+        if options['od']:
+            zones = population.zone_set.zone_set
+            try:
+                kwargs['origin'], kwargs['destination'] = (
+                    zones.get(zone_id=zone_id).id
+                    for zone_id in options['od']
+                )
+            except zones.model.DoesNotExist:
+                raise CommandError('Zone does not exist')
+        self.stdout.write(materialize_agents(population, **kwargs))
@@ -0,0 +1,24 @@
+"""Partition the result tables by run (PostgreSQL only, see
+metro_app.partitions).
+
+Usage::
+
+    python manage.py partition_results
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from metro_app.models import Run
+from metro_app.partitions import partition_result_tables
+
+
+class Command(BaseCommand):
+    help = 'Partition the result tables by run.'
+
+    def handle(self, *args, **options):
+        run_ids = list(Run.objects.values_list('id', flat=True))
+        try:
+            converted = partition_result_tables(run_ids, stdout=self.stdout)
+        except ValueError as e:
+            raise CommandError(e)
+        if not converted:
+            self.stdout.write('The result tables are already partitioned.')
@@ -18,12 +18,15 @@ https://www.webforefront.com/django/setuprelationshipsdjangomodels.html
 
 import os
 import random
+import uuid
 from datetime import timedelta
 from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.contrib.gis.db import models
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.utils.functional import cached_property
 from colorfield.fields import ColorField
 from django_q.tasks import fetch
 
@@ -260,6 +263,9 @@ class RoadNetwork(models.Model):
     :nb_road_types int: Total number of roadtypes in the road network.
     :nb_nodes int: Total number of nodes in the road network.
     :nb_edges int: Total number of edges in the road network.
+    :version int: Version of the content of the road network, incremented
+     whenever its nodes, edges or road types are modified (the visualization
+     artifacts are stored by version).
     :srid str: Spatial Reference System Identifier used for the coordinates of
      the nodes and the geometry of the edges.
     :name str: Name of the instance.
@@ -282,6 +288,7 @@ class RoadNetwork(models.Model):
     nb_road_types = models.PositiveIntegerField(default=0)
     nb_nodes = models.PositiveIntegerField(default=0)
     nb_edges = models.PositiveIntegerField(default=0)
+    version = models.PositiveIntegerField(default=0, editable=False)
     srid = models.PositiveIntegerField(
         default=4326,
         help_text=(
@@ -390,6 +397,12 @@ class Node(models.Model):
 
     class Meta:
         db_table = 'Node'
+        indexes = [
+            models.Index(fields=['network', 'node_id']),
+            # Trigram index for the name__icontains filter (see apps.py).
+            GinIndex(fields=['name'], name='node_name_trgm',
+                     opclasses=['gin_trgm_ops']),
+        ]
 
 
 class Edge(models.Model):
@@ -456,6 +469,12 @@ class Edge(models.Model):
 
     class Meta:
         db_table = 'Edge'
+        indexes = [
+            models.Index(fields=['network', 'edge_id']),
+            # Trigram index for the name__icontains filter (see apps.py).
+            GinIndex(fields=['name'], name='edge_name_trgm',
+                     opclasses=['gin_trgm_ops']),
+        ]
 
     def get_lanes(self):
         return self.lanes or self.road_type.default_lanes
@@ -584,6 +603,12 @@ class Zone(models.Model):
 
     class Meta:
         db_table = 'Zone'
+        indexes = [
+            models.Index(fields=['zone_set', 'zone_id']),
+            # Trigram index for the name__icontains filter (see apps.py).
+            GinIndex(fields=['name'], name='zone_name_trgm',
+                     opclasses=['gin_trgm_ops']),
+        ]
 
 
 class ODMatrix(models.Model):
@@ -632,6 +657,9 @@ class Population(models.Model):
      agents (default is a random integer).
     :generated bool: If True, indicate that the set of agents corresponding to
      the population segment has been generated.
+    :virtual bool: If True, the agents are never stored in the database: they
+     are generated from the population segments and the random seed when the
+     input of a run is exported (default is False).
     :locked bool: If True, the instance cannot be modified (default is False).
     :name str: Name of the instance.
     :comment str: Description of the instance (default is '').
@@ -643,6 +671,11 @@ class Population(models.Model):
     zone_set = models.ForeignKey(ZoneSet, on_delete=models.CASCADE)
     random_seed = models.PositiveIntegerField(get_random_seed)
     generated = models.BooleanField(default=False)
+    virtual = models.BooleanField(
+        default=False,
+        help_text='Generate the agents when the runs are exported instead of '
+                  'storing them in the database',
+    )
     locked = models.BooleanField(default=False)
     name = models.CharField(max_length=80, help_text='Name of the Population')
     comment = models.CharField(
@@ -939,6 +972,19 @@ class Network(models.Model):
     def __str__(self):
         return self.name
 
+    @cached_property
+    def zone_node_map(self):
+        """Dictionary mapping the id of each zone of the network to the id of
+        the node it is connected to.
+
+        The dictionary is built with a single query the first time it is
+        accessed and is then reused for the lifetime of the instance, so that
+        callers iterating over many agents (input export, validation, etc.) do
+        not need one query per zone lookup.
+        """
+        return dict(
+            self.zonenoderelation_set.values_list('zone_id', 'node_id'))
+
     class Meta:
         db_table = 'Network'
 
@@ -1074,6 +1120,10 @@ class EdgeResults(models.Model):
 
     class Meta:
         db_table = 'EdgesResults'
+        indexes = [
+            models.Index(fields=['run', 'edge', 'time']),
+            models.Index(fields=['run', 'time']),
+        ]
 
 
 class Agent(models.Model):
@@ -1236,8 +1286,27 @@ class Agent(models.Model):
         except ZoneNodeRelation.DoesNotExist:
             return None
 
+    def get_origin_node_id(self, network):
+        """Returns the id of the node connected to the origin zone of the
+        agent, using the zone-node map of the network (None if the zone is not
+        connected to any node).
+        """
+        return network.zone_node_map.get(self.origin_zone_id)
+
+    def get_destination_node_id(self, network):
+        """Returns the id of the node connected to the destination zone of the
+        agent, using the zone-node map of the network (None if the zone is not
+        connected to any node).
+        """
+        return network.zone_node_map.get(self.destination_zone_id)
+
     class Meta:
         db_table = 'Agent'
+        indexes = [
+            models.Index(fields=['population', 'agent_id']),
+            models.Index(fields=['population', 'origin_zone']),
+            models.Index(fields=['population', 'destination_zone']),
+        ]
 
 
 class AgentResults(models.Model):
@@ -1276,6 +1345,9 @@ class AgentResults(models.Model):
 
     class Meta:
         db_table = 'AgentResults'
+        indexes = [
+            models.Index(fields=['run', 'agent']),
+        ]
 
 
 class AgentRoadPath(models.Model):
@@ -1299,6 +1371,10 @@ class AgentRoadPath(models.Model):
 
     class Meta:
         db_table = 'AgentRoadPath'
+        indexes = [
+            models.Index(fields=['run', 'agent', 'time']),
+            models.Index(fields=['run', 'edge']),
+        ]
 
 
 class AggregateResult(models.Model):
@@ -1360,6 +1436,9 @@ class AggregateResult(models.Model):
 
     class Meta:
         db_table = 'AggregateResult'
+        indexes = [
+            models.Index(fields=['run', 'iteration']),
+        ]
 
 
 class BackgroundTask(models.Model):
@@ -1372,6 +1451,8 @@ class BackgroundTask(models.Model):
     :start_date datetime.datetime: Starting time of the task.
     :end_date datetime.datetime: Ending time of the task.
     :time_taken timedelta: Total running time of the task.
+    :progress float: Share of the work done by an in-progress task (between 0
+     and 100), for the tasks reporting their progress.
     """
     INPROGRESS = 0
     FINISHED = 1
@@ -1388,6 +1469,7 @@ class BackgroundTask(models.Model):
     start_date = models.DateTimeField(auto_now_add=True)
     time_taken = models.DurationField(null=True, blank=True)
     result = models.TextField(null=True, blank=True)
+    progress = models.FloatField(null=True, blank=True)
     # Optional Foreign Keys.
     road_network = models.ForeignKey(RoadNetwork, on_delete=models.CASCADE,
                                      blank=True, null=True)
@@ -1427,3 +1509,34 @@ class BackgroundTask(models.Model):
 
     class Meta:
         db_table = 'BackgroundTask'
+
+
+class FileUpload(models.Model):
+    """Class to represent a file uploaded in several parts, so that large
+    import files are never held in memory by the web server and interrupted
+    uploads can be resumed.
+
+    The parts are appended to a staging file in the `uploads` directory of
+    MEDIA_ROOT.
+
+    :id UUID: Id of the upload.
+    :filename str: Name of the uploaded file.
+    :size int: Total size of the file, in bytes.
+    :offset int: Number of bytes received so far.
+    :start_date datetime.datetime: Starting time of the upload.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    start_date = models.DateTimeField(auto_now_add=True)
+
+    def get_staging_path(self):
+        return os.path.join(
+            settings.MEDIA_ROOT, 'uploads', '{}.part'.format(self.id))
+
+    def is_complete(self):
+        return self.offset == self.size
+
+    class Meta:
+        db_table = 'FileUpload'
@@ -4,7 +4,7 @@ from metro_app.models import Project, Network, Node, Zone,ZoneNodeRelation
 from metro_app.forms import NetworkForm, ZoneNodeRelationFileForm
 from metro_app.filters import ZoneNodeRelationFilter
 from metro_app.tables import ZoneNodeRelationTable
-from django_tables2 import RequestConfig
+from metro_app.pagination import paginate_table
 import csv
 
 def list_of_networks(request, pk):
@@ -152,9 +152,8 @@ def zone_node_relation_table(request, pk):
     network = Network.objects.get(id=pk)
     zone_node_relation = ZoneNodeRelation.objects.select_related().filter(network=network)
     my_filter = ZoneNodeRelationFilter(request.GET, queryset=zone_node_relation)
-    table = ZoneNodeRelationTable(my_filter.qs)
-    #table.paginate(page=request.GET.get("page", 1), per_page=15)
-    RequestConfig(request).configure(table)
+    table, pagination = paginate_table(request, ZoneNodeRelationTable,
+                                       my_filter.qs)
 
     current_path = request.get_full_path()
     network_attribute = current_path.split("/")[4]
@@ -162,6 +161,7 @@ def zone_node_relation_table(request, pk):
     context = {
         "table": table,
         "filter": my_filter,
+        "pagination": pagination,
         "network": network,
         "network_attribute": network_attribute
     }
@@ -1,13 +1,13 @@
 from django.http import HttpResponse
 from django.contrib import messages
 from django.contrib.gis.geos import fromstr
-from django.contrib.gis.geos import GEOSGeometry, LineString, Polygon
+from django.contrib.gis.geos import Polygon
 from django.core.files.storage import default_storage
-from shapely import geometry as geom
+import shapely
 from django.shortcuts import render, redirect, get_object_or_404
 import json
 import csv
-import uuid
+import itertools
 import numpy as np
 import pandas as pd
 import geopandas as gpd
@@ -18,10 +18,16 @@ from .forms import (NodeForm, EdgeForm,
                     RoadTypeFileForm, ZoneFileForm, ODPairFileForm,)
 from .models import (Node, Edge, RoadNetwork, RoadType, ZoneSet, Zone,
                      ODPair, ODMatrix, BackgroundTask)
-from .hooks import str_hook
+from .bulk import bulk_load_columns, points_to_ewkb, segments_to_ewkb
+from .deletion import delete_in_chunks
+from .hooks import progress_reporter, str_hook
+from .readers import count_features, iter_chunks
+from .uploads import save_request_file
+from .visualization_cache import (bump_network_version, evict_versions,
+                                  get_version_directory)
 from django.db.utils import IntegrityError
 import os
-from django.conf import settings
+from django.db.models import FloatField, Func
 from django_q.tasks import async_task
 
 CONGESTION_TYPES = {
@@ -36,124 +42,77 @@ CONGESTION_TYPES = {
     'linear': RoadType.LINEAR,
 }
 
-
-def get_network_directory(roadnetwork):
-    return os.path.join(
-        settings.BASE_DIR, 'visualization', str(roadnetwork.id))
+NODE_KEYS = ('id', 'x', 'y', 'name')
 
 # ............................................................................#
 #                   VIEW OF UPLOADING A PROJECT IN THE DATABASE               #
 # ............................................................................#
 
 def upload_node_func(roadnetwork, filepath):
-    dtype = {'id': int, 'x': float, 'y': float}
-    # Read file with GeoPandas.
+    """Imports the nodes of a road network from a CSV, GeoParquet,
+    FlatGeobuf, GeoPackage or GeoJSON file (see readers.iter_chunks).
+
+    The file is read and imported by chunks (see NodeChunkImporter), the
+    progress is reported in the BackgroundTask of the road network. If the
+    import fails, the nodes already imported are deleted.
+    """
+    report = progress_reporter(road_network=roadnetwork)
+    total = count_features(filepath)
+    # Read only the columns used, whatever the format of the file (the
+    # coordinates are converted to the CRS of the road network, unless it is
+    # abstract).
+    srid = None if roadnetwork.simple else roadnetwork.srid
     try:
-        gdf = gpd.read_file(filepath, dtype=dtype)
-        gdf['id'] = gdf['id'].astype(int)
+        chunks = iter_chunks(filepath, NODE_KEYS, srid=srid)
+        first_chunk = next(chunks, None)
     except Exception as e:
-        try:
-            df = pd.read_csv(filepath, dtype=dtype)
-            df['geometry'] = None
-            gdf = gpd.GeoDataFrame(df)
-            del df
-        except Exception as e1:
-            return 'Cannot read file.\n\nError message:\n{}'.format(e1)
+        return 'Cannot read file.\n\nError message:\n{}'.format(e)
+    if first_chunk is None:
+        return 'No valid node to import.\n'
 
     # Check that column id is here.
-    if not 'id' in gdf.columns:
+    if not 'id' in first_chunk.columns:
         return (
             'Cannot import file.\n\nError message:\nThe following field '
             'is mandatory: id'
         )
+    if (first_chunk.geom_type.isnull().all()
+            and not ('x' in first_chunk.columns
+                     and 'y' in first_chunk.columns)):
+        # The nodes have no geometry (the file is probably a CSV), the
+        # coordinates are read from the x and y columns.
+        return (
+            'Cannot import file.\n\nError message:\nThe following fields'
+            ' are mandatory: x, y'
+        )
 
-    if len(gdf) and gdf.geom_type.isnull().all():
-        # The edges have no geometry (the file is probably as CSV).
-        # We create the geometries from the x and y coordinates.
-        if not 'x' in gdf.columns or not 'y' in gdf.columns:
-            return (
-                'Cannot import file.\n\nError message:\nThe following fields'
-                ' are mandatory: x, y'
-            )
-        try:
-            gdf['geometry'] = gdf.apply(
-                lambda row: geom.Point(
-                    [float(row['x']), float(row['y'])])
-                , axis=1)
-        except ValueError:
-            return (
-                'Cannot import file.\n\nError message:\nInvalid values in '
-                'column x or y'
-            )
-
-    message = ''
-    invalids = gdf.geom_type != 'Point'
-    if invalids.any():
-        #  The any() function is used to check whether any element is True, potentially over an axis
-        # Returns False unless there at least one element within a series or along a Dataframe axis 
-        # that is True or equivalent (e.g. non-zero or non-empty).
-        message += (
-            'Discarding {} invalid geometries (only Points are allowed).\n'
-        ).format(invalids.sum())
-        gdf = gdf.loc[~invalids]
-
-    if not len(gdf):
-        message += 'No valid node to import.\n'
-        return message
-
-    if gdf['id'].nunique() != len(gdf):
-        counts = gdf['id'].value_counts()
-        duplicates = counts.loc[counts > 1].index.astype(str)
-        message += (
-            'Duplicate node ids (only the last one is imported): {}\n'
-        ).format(', '.join(duplicates))
-        gdf = gdf.groupby('id').last()
-    else:
-        gdf.set_index('id', inplace=True)
-
-    gdf['gis-geometry'] = gdf['geometry'].apply(lambda g: GEOSGeometry(str(g)))
-    
-    nodes_to_import = list()
-    invalid_nodes = list()
-
-    def handle_nan(value):
-        if value and np.isnan(value):
-            return None
-        else:
-            return value
-            
-    for node_id, row in gdf.iterrows():
-        try:
-            node = Node(
-                node_id=node_id,
-                network=roadnetwork,
-                location=row['gis-geometry'],
-                name=row.get('name', ''),
-            )
-        except Exception as e:
-            invalid_nodes.append(str(node_id))
-        else:
-            nodes_to_import.append(node)
-    if invalid_nodes:
-        message += (
-            'The following nodes could not be imported correctly: {}\n'
-        ).format(', '.join(invalid_nodes))
-
-    if not nodes_to_import:
-        message += 'No node were imported.\n'
-        return message
-
-    # Create the nodes in bulk.
+    importer = NodeChunkImporter(roadnetwork)
+    nb_read = 0
+    count = 0
     try:
-        Node.objects.bulk_create(nodes_to_import)
+        # Each chunk is committed separately so that the progress updates are
+        # visible while the import is running.
+        for gdf in itertools.chain([first_chunk], chunks):
+            nb_read += len(gdf)
+            columns, size = importer.prepare(gdf)
+            if size:
+                count += bulk_load_columns(Node, columns, size)
+            report('Importing nodes', nb_read, total)
     except Exception as e:
-        message += (
+        # The nodes imported have no edges yet, they are deleted without
+        # cascade.
+        delete_in_chunks(Node.objects.filter(network=roadnetwork), report)
+        bump_network_version(roadnetwork.id)
+        return importer.get_message() + (
             'Failed to import nodes.\n\nError message:\n{}'
         ).format(e)
-        return message
 
-    message += 'Successfully imported {} nodes.'.format(
-        len(nodes_to_import))
+    message = importer.get_message()
+    if not count:
+        message += 'No valid node to import.\n'
+        return message
+    bump_network_version(roadnetwork.id)
+    message += 'Successfully imported {} nodes.'.format(count)
     return message
 
 
@@ -171,18 +130,11 @@ def upload_node(request, pk):
         return redirect('road_network_details', roadnetwork.pk)
 
     if request.method == 'POST':
-        # We need to include the files when creating the form
-        form = NodeForm(request.POST, request.FILES)
-        if form.is_valid():
-            # Getting data from the fielfield input
-            datafile = request.FILES['my_file']
-
-            # Save file on disk (we cannot send large files as arguments of
-            # async tasks).
-            filename = '{}-{}'.format(uuid.uuid4(), datafile.name)
-            filepath = os.path.join(settings.MEDIA_ROOT, filename)
-            with open(filepath, 'wb') as f:
-                f.write(datafile.read())
+        # The file is either sent with the form or uploaded in parts
+        # beforehand (see uploads.py); it is saved on disk because large files
+        # cannot be sent as arguments of async tasks.
+        filepath = save_request_file(request)
+        if filepath is not None:
             task_id = async_task(upload_node_func, roadnetwork, filepath,
                                  hook=str_hook)
             description = 'Importing nodes'
@@ -199,156 +151,339 @@ def upload_node(request, pk):
         form = NodeForm()
         return render(request, template, {'form': form})
 
-"""
-def upload_edge_func(roadnetwork, filepath):
-    # Read file with GeoPandas.
-    dtype = {'id': int, 'source': int, 'target': int, 'road_type': int,
-             'length': float, 'speed': float, 'outflow': float,
-             'param1': float, 'param2': float, 'param3': float}
-    mandatory_keys = ['id', 'source', 'target', 'road_type', 'length']
-    try:
-        gdf = gpd.read_file(filepath, dtype=dtype)
-        for col, typ in dtype.items():
-            gdf[col] = gdf[col].astype(typ)
-    except Exception as e:
-        try:
-            df = pd.read_csv(filepath, dtype=dtype)
-            df['geometry'] = None
-            gdf = gpd.GeoDataFrame(df)
-            del df
-        except Exception as e1:
-            return 'Cannot read file.\n\nError message:\n{}'.format(e)
 
-    # Check that all mandatory keys are here.
-    if not all(key in gdf.columns for key in mandatory_keys):
-        return (
-            'Cannot import file.\n\nError message:\nThe following fields'
-            ' are mandatory: {}'
-        ).format(', '.join(mandatory_keys))
-
-    message = ''
-    # Merge with source and target nodes.
-    nodes = Node.objects.filter(network=roadnetwork).values(
-        'id', 'node_id', 'location')
-    nodes_df = pd.DataFrame(nodes)
-    gdf = gdf.merge(nodes_df, left_on='source', right_on='node_id', how='left',
-                    suffixes=('', '_source'))
-    gdf.rename(columns={'location': 'location_source'}, inplace=True)
-    gdf = gdf.merge(nodes_df, left_on='target', right_on='node_id', how='left',
-                    suffixes=('', '_target'))
-    gdf.rename(columns={'location': 'location_target'}, inplace=True)
-    # Check if some sources or targets are invalid.
-    invalids = gdf['id_source'].isnull()
-    if invalids.any():
-        invalid_source_ids = gdf.loc[invalids, 'source'].unique().astype(str)
-        message += 'Invalid source ids: {}\n'.format(
-            ', '.join(invalid_source_ids))
-        gdf = gdf.loc[~invalids]
-    invalids = gdf['id_target'].isnull()
-    if invalids.any():
-        invalid_target_ids = gdf.loc[invalids, 'target'].unique().astype(str)
-        message += 'Invalid target ids: {}\n'.format(
-            ', '.join(invalid_target_ids))
-        gdf = gdf.loc[~invalids]
+# Number of edges read from the import file and sent to the database at once.
+EDGE_CHUNK_SIZE = 50000
 
-    if len(gdf) and gdf.geom_type.isnull().all():
-        # The edges have no geometry (the file is probably as CSV).
-        # We create the geometries from the nodes.
-        message += 'Creating edge geometries from the node coordinates.\n'
-        gdf['geometry'] = gdf.apply(
-            lambda row: geom.LineString(
-                [row['location_source'], row['location_target']]),
-            axis=1)
-
-    invalids = gdf.geom_type != 'LineString'
-    if invalids.any():
-        message += (
-            'Discarding {} invalid geometries (only LineStrings are allowed).'
-            '\n'
-        ).format(invalids.sum())
-        gdf = gdf.loc[~invalids]
+EDGE_MANDATORY_KEYS = ('id', 'source', 'target', 'road_type', 'length')
+EDGE_FLOAT_KEYS = ('speed', 'outflow', 'param1', 'param2', 'param3')
+EDGE_KEYS = EDGE_MANDATORY_KEYS + EDGE_FLOAT_KEYS + ('lanes', 'name')
 
-    if not len(gdf):
-        message += 'No valid edge to import.\n'
+# Maximum number of invalid ids listed in the result of an import.
+MAX_LISTED_IDS = 100
+
+
+def get_node_map(roadnetwork):
+    """Returns a DataFrame with the primary key and the coordinates of the
+    nodes of a road network, indexed by node id.
+    """
+    nodes = Node.objects.filter(network=roadnetwork).annotate(
+        x=Func('location', function='ST_X', output_field=FloatField()),
+        y=Func('location', function='ST_Y', output_field=FloatField()),
+    ).values_list('node_id', 'id', 'x', 'y')
+    return pd.DataFrame.from_records(
+        nodes.iterator(), columns=['node_id', 'id', 'x', 'y'],
+        index='node_id')
+
+
+def to_numeric(series):
+    return pd.to_numeric(series, errors='coerce')
+
+
+def record(ids, values):
+    """Adds the non-null values of a Series to a set of ids."""
+    ids.update(values.dropna().unique().tolist())
+
+
+def format_ids(ids):
+    ids = sorted(ids)
+    text = ', '.join('{:.15g}'.format(i) for i in ids[:MAX_LISTED_IDS])
+    if len(ids) > MAX_LISTED_IDS:
+        text += ', ... ({} in total)'.format(len(ids))
+    return text
+
+
+def get_point_coordinates(gdf):
+    """Returns the x and y coordinates of the features of a chunk: the
+    coordinates of the Point geometries, or the x and y columns for the
+    features without geometry (NaN for the other features).
+    """
+    x = pd.Series(np.nan, index=gdf.index)
+    y = pd.Series(np.nan, index=gdf.index)
+    points = (gdf.geom_type == 'Point').to_numpy()
+    if points.any():
+        x[points] = gdf.geometry[points].x
+        y[points] = gdf.geometry[points].y
+    missing = gdf.geometry.isna().to_numpy()
+    if missing.any() and 'x' in gdf.columns and 'y' in gdf.columns:
+        x[missing] = to_numeric(gdf['x'])[missing]
+        y[missing] = to_numeric(gdf['y'])[missing]
+    return x, y
+
+
+class NodeChunkImporter:
+    """Converts chunks of a node import file to the columns of the Node
+    table.
+
+    The invalid rows are discarded and recorded, to be reported at the end of
+    the import.
+    """
+
+    def __init__(self, roadnetwork):
+        self.roadnetwork = roadnetwork
+        self.srid = Node._meta.get_field('location').srid
+        self.imported_ids = set()
+        self.duplicate_ids = set()
+        self.nb_invalid_ids = 0
+        self.nb_invalid_geometries = 0
+
+    def prepare(self, gdf):
+        """Returns the columns of the valid nodes of a chunk (as expected by
+        bulk_load_columns) and the number of nodes.
+        """
+        gdf = gdf.reset_index(drop=True)
+        gdf['id'] = to_numeric(gdf['id'])
+        invalids = gdf['id'].isnull()
+        self.nb_invalid_ids += invalids.sum()
+
+        x, y = get_point_coordinates(gdf)
+        invalid_geometries = ~invalids & (x.isnull() | y.isnull())
+        self.nb_invalid_geometries += invalid_geometries.sum()
+        invalids |= invalid_geometries
+
+        # The nodes with an id already imported (in this chunk or in a
+        # previous one) are discarded.
+        ids = gdf['id'].where(~invalids)
+        duplicates = ~invalids & (
+            ids.duplicated(keep='first') | ids.isin(self.imported_ids))
+        record(self.duplicate_ids, gdf.loc[duplicates, 'id'])
+        invalids |= duplicates
+
+        valids = ~invalids.to_numpy()
+        if not valids.any():
+            return dict(), 0
+        gdf = gdf.loc[valids]
+        ids = gdf['id'].to_numpy(dtype=np.int64)
+        self.imported_ids.update(ids.tolist())
+        # The locations are encoded as EWKB from the coordinate arrays.
+        columns = {
+            'node_id': ids,
+            'network': self.roadnetwork.id,
+            'location': points_to_ewkb(
+                x.to_numpy()[valids], y.to_numpy()[valids], self.srid),
+            'name': (
+                gdf['name'].fillna('').astype(str).to_numpy(dtype=object)
+                if 'name' in gdf.columns else ''),
+        }
+        return columns, len(ids)
+
+    def get_message(self):
+        message = ''
+        if self.nb_invalid_ids:
+            message += 'Discarding {} nodes with an invalid id.\n'.format(
+                self.nb_invalid_ids)
+        if self.nb_invalid_geometries:
+            message += (
+                'Discarding {} invalid geometries (only Points are allowed).\n'
+            ).format(self.nb_invalid_geometries)
+        if self.duplicate_ids:
+            message += (
+                'Duplicate node ids (only the first one is imported): {}\n'
+            ).format(format_ids(self.duplicate_ids))
         return message
 
-    # Merge with road types.
-    roadtypes = RoadType.objects.filter(network=roadnetwork).values(
-        'id', 'road_type_id')
-    roadtype_df = pd.DataFrame(roadtypes)
-    gdf = gdf.merge(
-        roadtype_df, left_on='road_type', right_on='road_type_id', how='left',
-        suffixes=('', '_roadtype'))
-    invalid_roadtype_ids = set()
-    # Check if some roadtypes are invalid.
-    invalids = gdf['road_type_id'].isnull()
-    if invalids.any():
-        invalid_roadtype_ids = gdf.loc[
-            invalids, 'road_type_id'].unique().astype(str)
-        message += 'Invalid road type ids: {}\n'.format(
-            ', '.join(invalid_roadtype_ids))
+
+class EdgeChunkImporter:
+    """Converts chunks of an edge import file to the columns of the Edge
+    table.
+
+    The source and target nodes and the road types are resolved with
+    in-memory maps built once for the whole import. The invalid rows are
+    discarded and recorded, to be reported at the end of the import.
+    """
+
+    def __init__(self, roadnetwork):
+        self.roadnetwork = roadnetwork
+        self.nodes = get_node_map(roadnetwork)
+        self.road_types = pd.Series(dict(
+            RoadType.objects.filter(network=roadnetwork).values_list(
+                'road_type_id', 'id')), dtype=np.float64)
+        self.srid = Edge._meta.get_field('geometry').srid
+        self.imported_ids = set()
+        self.invalid_sources = set()
+        self.invalid_targets = set()
+        self.invalid_road_types = set()
+        self.invalid_lengths = set()
+        self.duplicate_ids = set()
+        self.nb_invalid_ids = 0
+        self.nb_invalid_geometries = 0
+        self.nb_created_geometries = 0
+
+    def prepare(self, gdf):
+        """Returns the columns of the valid edges of a chunk (as expected by
+        bulk_load_columns) and the number of edges.
+        """
+        gdf = gdf.reset_index(drop=True)
+        for key in EDGE_MANDATORY_KEYS:
+            gdf[key] = to_numeric(gdf[key])
+
+        invalids = gdf['id'].isnull()
+        self.nb_invalid_ids += invalids.sum()
         gdf = gdf.loc[~invalids]
 
-    if gdf['id'].nunique() != len(gdf):
-        counts = gdf['id'].value_counts()
-        duplicates = counts.loc[counts > 1].index.astype(str)
-        message += (
-            'Duplicate edge ids (only the last one is imported): {}\n'
-        ).format(', '.join(duplicates))
-        gdf = gdf.groupby('id').last()
-    else:
-        gdf.set_index('id', inplace=True)
-
-    gdf['gis-geometry'] = gdf['geometry'].apply(lambda g: GEOSGeometry(str(g)))
-    edges_to_import = list()
-    invalid_edges = list()
-    def handle_nan(value):
-        if value and np.isnan(value):
-            return None
+        source = gdf['source'].map(self.nodes['id'])
+        record(self.invalid_sources, gdf.loc[source.isnull(), 'source'])
+        target = gdf['target'].map(self.nodes['id'])
+        record(self.invalid_targets, gdf.loc[target.isnull(), 'target'])
+        road_type = gdf['road_type'].map(self.road_types)
+        record(self.invalid_road_types,
+               gdf.loc[road_type.isnull(), 'road_type'])
+        invalids = source.isnull() | target.isnull() | road_type.isnull()
+
+        missing = gdf.geometry.isna()
+        invalid_geometries = ~missing & (gdf.geom_type != 'LineString')
+        self.nb_invalid_geometries += invalid_geometries.sum()
+        invalid_lengths = gdf['length'].isnull()
+        record(self.invalid_lengths, gdf.loc[invalid_lengths, 'id'])
+        invalids |= invalid_geometries | invalid_lengths
+
+        # The edges with an id already imported (in this chunk or in a
+        # previous one) are discarded.
+        ids = gdf['id'].where(~invalids)
+        duplicates = ~invalids & (
+            ids.duplicated(keep='first') | ids.isin(self.imported_ids))
+        record(self.duplicate_ids, gdf.loc[duplicates, 'id'])
+        invalids |= duplicates
+
+        valids = ~invalids.to_numpy()
+        if not valids.any():
+            return dict(), 0
+        gdf = gdf.loc[valids]
+        source = source.to_numpy()[valids]
+        target = target.to_numpy()[valids]
+        road_type = road_type.to_numpy()[valids]
+        missing = missing.to_numpy()[valids]
+        ids = gdf['id'].to_numpy(dtype=np.int64)
+        self.imported_ids.update(ids.tolist())
+
+        # The edges without geometry are straight lines between their source
+        # and target nodes.
+        self.nb_created_geometries += missing.sum()
+        source_nodes = self.nodes.loc[
+            gdf.loc[missing, 'source'].astype(np.int64)]
+        target_nodes = self.nodes.loc[
+            gdf.loc[missing, 'target'].astype(np.int64)]
+        segments = segments_to_ewkb(
+            source_nodes['x'].to_numpy(), source_nodes['y'].to_numpy(),
+            target_nodes['x'].to_numpy(), target_nodes['y'].to_numpy(),
+            self.srid)
+        if missing.all():
+            geometry = segments
         else:
-            return value
-    for edge_id, row in gdf.iterrows():
-        try:
-            edge = Edge(
-                edge_id=edge_id,
-                network=roadnetwork,
-                geometry=row['gis-geometry'],
-                length=row['length'],
-                road_type_id=row['id_roadtype'],
-                source_id=row['id_source'],
-                target_id=row['id_target'],
-                speed=handle_nan(row.get('speed')),
-                lanes=handle_nan(row.get('lanes')),
-                name=row.get('name', ''),
-                outflow=handle_nan(row.get('outflow')),
-                param1=handle_nan(row.get('param1')),
-                param2=handle_nan(row.get('param2')),
-                param3=handle_nan(row.get('param3')),
-            )
-        except Exception as e:
-            invalid_edges.append(str(edge_id))
-        else:
-            edges_to_import.append(edge)
-    if invalid_edges:
-        message += (
-            'The following edges could not be imported correctly: {}\n'
-        ).format(', '.join(invalid_edges))
-
-    if not edges_to_import:
-        message += 'No edge were imported.\n'
+            geometry = gdf.geometry.to_numpy(dtype=object)
+            geometry[missing] = segments
+
+        columns = {
+            'edge_id': ids,
+            'network': self.roadnetwork.id,
+            'source': source.astype(np.int64),
+            'target': target.astype(np.int64),
+            'road_type': road_type.astype(np.int64),
+            'geometry': geometry,
+            'length': gdf['length'].to_numpy(dtype=np.float64),
+            'lanes': (
+                to_numeric(gdf['lanes']).to_numpy(dtype=np.float64)
+                if 'lanes' in gdf.columns else None),
+            'name': (
+                gdf['name'].to_numpy(dtype=object)
+                if 'name' in gdf.columns else ''),
+        }
+        for key in EDGE_FLOAT_KEYS:
+            columns[key] = (
+                to_numeric(gdf[key]).to_numpy(dtype=np.float64)
+                if key in gdf.columns else None)
+        return columns, len(ids)
+
+    def get_message(self):
+        message = ''
+        if self.nb_invalid_ids:
+            message += 'Discarding {} edges with an invalid id.\n'.format(
+                self.nb_invalid_ids)
+        if self.invalid_sources:
+            message += 'Invalid source ids: {}\n'.format(
+                format_ids(self.invalid_sources))
+        if self.invalid_targets:
+            message += 'Invalid target ids: {}\n'.format(
+                format_ids(self.invalid_targets))
+        if self.invalid_road_types:
+            message += 'Invalid road type ids: {}\n'.format(
+                format_ids(self.invalid_road_types))
+        if self.nb_invalid_geometries:
+            message += (
+                'Discarding {} invalid geometries (only LineStrings are '
+                'allowed).\n'
+            ).format(self.nb_invalid_geometries)
+        if self.invalid_lengths:
+            message += 'Edges with an invalid length: {}\n'.format(
+                format_ids(self.invalid_lengths))
+        if self.duplicate_ids:
+            message += (
+                'Duplicate edge ids (only the first one is imported): {}\n'
+            ).format(format_ids(self.duplicate_ids))
+        if self.nb_created_geometries:
+            message += (
+                'Created {} edge geometries from the node coordinates.\n'
+            ).format(self.nb_created_geometries)
         return message
 
-    # Create the edges in bulk.
+
+def upload_edge_func(roadnetwork, filepath, chunk_size=EDGE_CHUNK_SIZE):
+    """Imports the edges of a road network from a CSV, GeoParquet,
+    FlatGeobuf, GeoPackage or GeoJSON file (see readers.iter_chunks).
+
+    The file is read and imported by chunks of `chunk_size` edges, so that
+    large networks are imported without holding the whole file in memory. The
+    progress is reported in the BackgroundTask of the road network. If the
+    import fails, the edges already imported are deleted.
+    """
+    report = progress_reporter(road_network=roadnetwork)
+    total = count_features(filepath)
+    # Coordinates are converted to the CRS of the road network, unless it is
+    # abstract.
+    srid = None if roadnetwork.simple else roadnetwork.srid
     try:
-        Edge.objects.bulk_create(edges_to_import)
+        chunks = iter_chunks(filepath, EDGE_KEYS, chunk_size, srid)
+        first_chunk = next(chunks, None)
     except Exception as e:
-        message += (
+        return 'Cannot read file.\n\nError message:\n{}'.format(e)
+    if first_chunk is None:
+        return 'No valid edge to import.\n'
+
+    # Check that all mandatory keys are here.
+    if not all(key in first_chunk.columns for key in EDGE_MANDATORY_KEYS):
+        return (
+            'Cannot import file.\n\nError message:\nThe following fields'
+            ' are mandatory: {}'
+        ).format(', '.join(EDGE_MANDATORY_KEYS))
+
+    importer = EdgeChunkImporter(roadnetwork)
+    nb_read = 0
+    count = 0
+    try:
+        # Each chunk is committed separately so that the progress updates are
+        # visible while the import is running.
+        for gdf in itertools.chain([first_chunk], chunks):
+            nb_read += len(gdf)
+            columns, size = importer.prepare(gdf)
+            if size:
+                count += bulk_load_columns(Edge, columns, size)
+            report('Importing edges', nb_read, total)
+    except Exception as e:
+        delete_in_chunks(Edge.objects.filter(network=roadnetwork), report)
+        bump_network_version(roadnetwork.id)
+        return importer.get_message() + (
             'Failed to import edges.\n\nError message:\n{}'
         ).format(e)
-        return message
 
-    message += 'Successfully imported {} edges.'.format(
-        len(edges_to_import))
+    message = importer.get_message()
+    if not count:
+        message += 'No valid edge to import.\n'
+        return message
+    bump_network_version(roadnetwork.id)
+    message += 'Successfully imported {} edges.'.format(count)
+    # The visualization is pre-computed so that opening the map never waits
+    # for it.
+    start_visualization_task(roadnetwork)
     return message
 
 
@@ -369,16 +504,11 @@ def upload_edge(request, pk):
             request, "A task is in progress for this road network.")
         return redirect('road_network_details', roadnetwork.pk)
     if request.method == 'POST':
-        form = EdgeForm(request.POST, request.FILES)
-        if form.is_valid():
-            datafile = request.FILES['my_file']
-            # Save file on disk (we cannot send large files as arguments of
-            # async tasks).
-            filename = '{}-{}'.format(uuid.uuid4(), datafile.name)
-            filepath = os.path.join(settings.MEDIA_ROOT, filename)
-            with open(filepath, 'wb') as f:
-                f.write(datafile.read())
-            # async_task ne prend pas la fonction avec les parametres tous ensemble ==> a regarder
+        # The file is either sent with the form or uploaded in parts
+        # beforehand (see uploads.py); it is saved on disk because large files
+        # cannot be sent as arguments of async tasks.
+        filepath = save_request_file(request)
+        if filepath is not None:
             task_id = async_task(upload_edge_func, roadnetwork, filepath,
                                  hook=str_hook)
             description = 'Importing edges'
@@ -387,7 +517,6 @@ def upload_edge(request, pk):
                                      road_network=roadnetwork)
             db_task.save()
             messages.success(request, "Task successfully started.")
-            
         else:
             messages.error(
                 request, "Invalid request. Did you upload the file correctly?")
@@ -395,7 +524,30 @@ def upload_edge(request, pk):
     else:
         form = EdgeForm()
         return render(request, template, {'form': form})
-"""
+
+
+
+VISUALIZATION_TASK = 'Generating the visualization'
+
+
+def is_visualization_running(roadnetwork):
+    return BackgroundTask.objects.filter(
+        road_network=roadnetwork, description=VISUALIZATION_TASK,
+        status=BackgroundTask.INPROGRESS,
+    ).exists()
+
+
+def start_visualization_task(roadnetwork):
+    """Starts a background task pre-computing the visualization of a road
+    network (see tiles.build_visualization)."""
+    # The function is given by its path as the tiles module depends on this
+    # one.
+    task_id = async_task('metro_app.tiles.build_visualization', roadnetwork,
+                         hook=str_hook)
+    BackgroundTask.objects.create(
+        project=roadnetwork.project, id=task_id,
+        description=VISUALIZATION_TASK, road_network=roadnetwork)
+
 
 def get_offset_polygon(linestring, width, oneway=True, drive_right=True):
     """Returns a polygon of a given width, representing a road defined by a
@@ -428,15 +580,100 @@ def get_offset_polygon(linestring, width, oneway=True, drive_right=True):
     # splitted_polygons = split(polygon, linestring)
     if drive_right:
         # Returns the right-hand side of the split.
-        return split(polygon, linestring)[0]
+        return split(polygon, linestring).geoms[0]
     else:
         # Returns the left-hand side of the split.
-        return split(polygon, linestring)[-1]
+        return split(polygon, linestring).geoms[-1]
+
+
+# Methods to compute the polygons of two-way roads in get_offset_polygons.
+BUFFER = 'buffer'
+OFFSET_CURVE = 'offset_curve'
+
+
+def offset_curve_polygons(linestrings, distances):
+    """Returns the polygons between LineStrings and their offset curves.
+
+    The polygons are built from the coordinates of the LineStrings followed by
+    the coordinates of the offset curves in reverse order, for all the
+    geometries at once. Offset curves which are not a single LineString
+    (e.g. on sharp turns) get a single-sided buffer instead.
+    """
+    offsets = shapely.offset_curve(linestrings, distances, join_style='mitre')
+    simple = shapely.get_type_id(offsets) == shapely.GeometryType.LINESTRING
+    polygons = np.empty(len(linestrings), dtype=object)
+    polygons[~simple] = shapely.buffer(
+        linestrings[~simple], distances[~simple], single_sided=True,
+        cap_style='flat', join_style='mitre')
+    if not simple.any():
+        return polygons
+    line_coords, line_index = shapely.get_coordinates(
+        linestrings[simple], return_index=True)
+    offset_coords, offset_index = shapely.get_coordinates(
+        offsets[simple], return_index=True)
+    coords = np.concatenate([line_coords, offset_coords[::-1]])
+    index = np.concatenate([line_index, offset_index[::-1]])
+    part = np.concatenate([np.zeros(len(line_index), dtype=np.int8),
+                           np.ones(len(offset_index), dtype=np.int8)])
+    # Sort by geometry, then line before offset curve (the sort is stable so
+    # the order of the coordinates is kept).
+    order = np.lexsort((part, index))
+    rings = shapely.linearrings(coords[order], indices=index[order])
+    polygons[simple] = shapely.polygons(rings)
+    return polygons
+
+
+def get_offset_polygons(linestrings, widths, oneway, drive_right=True,
+                        method=BUFFER):
+    """Returns polygons representing roads defined by LineStrings, computed
+    for all the roads at once (see get_offset_polygon for a single road).
+
+    The polygons of the oneway roads are centered on their LineString and the
+    polygons of the two-way roads are on the right-hand side (or left-hand
+    side) of their LineString, so that the two directions are side by side.
+    :param linestrings: Geometries of the roads, in EPSG:3857.
+    :param widths: Width of the roads, in meters.
+    :param oneway: Whether the roads are oneway.
+    :param drive_right: If True, the polygons of the two-way roads are offset
+       toward the right, to represent right-hand traffic.
+    :param method: Computation of the polygons of two-way roads, BUFFER for a
+       single-sided buffer (on the same side as the split of the buffer in
+       get_offset_polygon) or OFFSET_CURVE for the polygon between the
+       LineString and its offset curve (faster, but the joins are not
+       smoothed).
+    :type linestrings: geopandas.GeoSeries
+    :type widths: numpy.ndarray
+    :type oneway: numpy.ndarray
+    :type drive_right: boolean
+    :type method: str
+    :returns: Polygon geometries representing the roads.
+    :rtype: numpy.ndarray
+    """
+    linestrings = np.asarray(linestrings.values, dtype=object)
+    widths = np.asarray(widths, dtype=np.float64)
+    oneway = np.asarray(oneway, dtype=bool)
+    polygons = np.empty(len(linestrings), dtype=object)
+    polygons[oneway] = shapely.buffer(
+        linestrings[oneway], widths[oneway], cap_style='flat',
+        join_style='mitre')
+    # Double the width as the polygon represents the road in both directions
+    # (see get_offset_polygon). The polygons are on the same side as the
+    # split of get_offset_polygon: the first part of the split (drive_right)
+    # is the side of the positive distances of the single-sided buffer.
+    distances = 2 * widths[~oneway] * (1 if drive_right else -1)
+    if method == OFFSET_CURVE:
+        polygons[~oneway] = offset_curve_polygons(
+            linestrings[~oneway], distances)
+    else:
+        polygons[~oneway] = shapely.buffer(
+            linestrings[~oneway], distances, single_sided=True,
+            cap_style='flat', join_style='mitre')
+    return polygons
 
 
 def make_network_visualization(road_network_id, node_radius=6, lane_width=3,
                                node_color='lightgray', edge_width_ratio=1,
-                               max_lanes=5):
+                               max_lanes=5, offset_method=BUFFER):
     """Generates an HTML file with the Leaflet.js representation of a network.
     :param road_network_id: Id of the road network to represent.
     :param node_radius: Radius of the nodes of the road network, in meters. It
@@ -451,11 +688,14 @@ def make_network_visualization(road_network_id, node_radius=6, lane_width=3,
        max_lanes are represented with a width equal to edges_width_ratio *
        node_radius / 2. Edges with a number of lanes smaller than max_lanes
        have a width proportional to their number of lanes.
+    :param offset_method: Computation of the polygons of two-way edges (see
+       get_offset_polygons).
     :type road_network_id: integer
     :type node_radius: numeric
     :type node_color: str
     :type edge_width_ratio: float
     :type max_lanes: integer
+    :type offset_method: str
     :returns: Absolute path of the HTML file generated.
     :rtype: str
     """
@@ -542,16 +782,14 @@ def make_network_visualization(road_network_id, node_radius=6, lane_width=3,
                             edges_gdf.target + '_' + edges_gdf.source)
 
         # Replace the geometry of the edges with an offset polygon of
-        # corresponding width. time : +16s
-        col_list = ['geometry', 'oneway', 'width']
-        edges_gdf['geometry'] = edges_gdf[col_list].apply(
-            lambda row: get_offset_polygon(
-                linestring=row['geometry'],
-                width=row['width'],
-                drive_right=True,
-                oneway=row['oneway']
+        # corresponding width, computed for all the edges at once.
+        edges_gdf['geometry'] = gpd.GeoSeries(
+            get_offset_polygons(
+                edges_gdf.geometry, edges_gdf['width'].to_numpy(),
+                edges_gdf['oneway'].to_numpy(), drive_right=True,
+                method=offset_method,
             ),
-            axis=1,
+            index=edges_gdf.index, crs=edges_gdf.crs,
         )
         edges_gdf = edges_gdf.sort_values(
             by="source", ascending=True, ignore_index=True)
@@ -580,8 +818,9 @@ def make_network_visualization(road_network_id, node_radius=6, lane_width=3,
                 [20 / max_diff, 0, 0, 20 / max_diff, -center_x, -center_y])
         #-----------------------------#
 
-        # Create and save edges.geojson file edges_gdf
-        directory = get_network_directory(roadnetwork)
+        # Create and save edges.geojson file edges_gdf, in the directory of
+        # the version of the road network read before the edges.
+        directory = get_version_directory(roadnetwork)
         if not os.path.isdir(directory):
             os.makedirs(directory)
 
@@ -591,9 +830,14 @@ def make_network_visualization(road_network_id, node_radius=6, lane_width=3,
         # Add bounds for javascript code
         edges["total_bounds"] = total_bounds
     
-        with open(os.path.join(directory, "edges.geojson"), 'w') as file:
+        # The file is written under a temporary name so that it is never
+        # read incomplete.
+        path = os.path.join(directory, "edges.geojson")
+        with open(path + '.tmp', 'w') as file:
             # Saving the file
             json.dump(edges, file)
+        os.replace(path + '.tmp', path)
+        evict_versions(roadnetwork)
 
         # edges_gdf.to_file(
         #    os.path.join(directory, "edges.geojson"), driver='GeoJSON')
@@ -609,115 +853,3 @@ def read_od_pair_file(file):
         return HttpResponse("Error: Uploaded file format not recongnized")
 
     return file
-
-def upload_edge(request, pk):
-    template = "networks/edge.html"
-    roadnetwork = RoadNetwork.objects.get(id=pk)
-    roadtypes = RoadType.objects.select_related('network').filter(
-                                                             network_id=pk)
-    nodes = Node.objects.select_related('network').filter(network_id=pk)
-    edges = Edge.objects.select_related().filter(network_id=pk)
-    # node_id_dict = {node.node_id: node for node in nodes}
-    # road_type_id_dict = {roadtype.road_type_id: roadtype
-    #                     for roadtype in roadtypes}
-    list_edge_instance = []
-    if edges.count() > 0:
-        messages.warning(request, "Fail ! Network contains \
-                            already edges data.")
-        return redirect('road_network_details', roadnetwork.pk)
-
-    if nodes.count() == 0 or roadtypes.count() == 0:
-        messages.warning(request, "Fail ! First import node or road type file \
-                            before importing edge.")
-        return redirect('road_network_details', roadnetwork.pk)
-    form = EdgeForm()
-    if request.method == 'POST':
-        node_id_dict = {node.node_id: node for node in nodes}
-        road_type_id_dict = {roadtype.road_type_id: roadtype
-                             for roadtype in roadtypes}
-
-        form = EdgeForm(request.POST, request.FILES)
-        if form.is_valid():
-            datafile = request.FILES['my_file']
-            if datafile.name.endswith('.geojson'):
-                objects = json.load(datafile)
-
-            elif datafile.name.endswith('.csv'):
-                edges = pd.read_csv(datafile,)
-                nodes = Node.objects.filter(network_id=pk).values()
-                nodes = pd.DataFrame(nodes)
-                # merge origin coordonates
-                edges = edges.merge(nodes[['node_id', 'location']],
-                                    left_on='source', right_on='node_id')
-
-                # merge destination coordinates
-                edges = edges.merge(
-                    nodes[['node_id', 'location']], left_on='target',
-                    right_on='node_id')
-                edges['geometry'] = edges.apply(lambda x:
-                                                [x['location_x'],
-                                                 x['location_y']], axis=1)
-                edges.drop(['node_id_x', 'node_id_y', 'location_x',
-                            'location_y'], axis=1, inplace=True)
-                edges['geometry'] = edges['geometry'].apply(geom.LineString)
-                edges = gpd.GeoDataFrame(edges)
-                datafile = edges.to_json()
-                objects = json.loads(datafile)
-
-            else:
-                messages.error(request, "You file does not respect Metropolis \
-                                format guidelines")
-                return render(request, template, {'form': form})
-
-            for object in objects['features']:
-                objet_type = object['geometry']['type']
-                if objet_type == 'LineString':
-                    properties = object['properties']
-                    geometry = object['geometry']
-                    location = GEOSGeometry(
-                        LineString(geometry['coordinates']), srid=4326)
-
-                    target = properties.get('target')
-                    source = properties.get('source')
-                    road_type = properties.get('road_type')
-                    try:
-                        target = node_id_dict[target]
-                        source = node_id_dict[source]
-                        roadtype = road_type_id_dict[road_type]
-                    except KeyError:
-                        pass
-                        # messages.error(request, "There is a problem at this \
-                        #               source_id {}, target_id {} and \
-                        #               roadtype_id {}".format(source,
-                        #                                    target, roadtype))
-                        # return render(request, template, {'form': form})
-                    else:
-                        edge = Edge(
-                                edge_id=properties['id'],
-                                param1=properties.get('param1', None),
-                                param2=properties.get('param2', None),
-                                param3=properties.get('param3', None),
-                                speed=properties.get('speed', None),
-                                length=properties['length'],
-                                lanes=properties.get('lanes', None),
-                                geometry=location,
-                                name=properties.get('name', ''),
-                                road_type=roadtype,
-                                target=target,
-                                source=source,
-                                network=roadnetwork)
-                        list_edge_instance.append(edge)
-                else:
-                    messages.error(request, "The uploaded file is not \
-                                   the edge one, please select the good one !")
-                    return render(request, template, {'form': form})
-
-            Edge.objects.bulk_create(list_edge_instance)
-
-            if list_edge_instance:
-                messages.success(request, 'Your edge file has been \
-                             successfully imported !')
-
-        return redirect('road_network_details', roadnetwork.pk)
-    else:
-        return render(request, template, {'form': form})
\ No newline at end of file
@@ -6,9 +6,11 @@ from metro_app.forms import ODPairFileForm, ODMatrixForm
 from metro_app.filters import ODPairFilter
 from metro_app.tables import ODPairTable
 from django_q.tasks import async_task
+from metro_app.bulk import bulk_load
 from metro_app.hooks import str_hook
+from metro_app.uploads import save_request_file
 import csv
-from django_tables2 import RequestConfig
+from metro_app.pagination import paginate_table
 
 
 def list_of_od_matrix(request, pk):
@@ -23,20 +25,26 @@ def list_of_od_matrix(request, pk):
     }
     return render(request, 'list.html', context)
 
-def async_task_for_od_pair_file(file, od_matrix_id):
-    if file.name.endswith('.csv'):
-        file = file.read().decode('utf-8').splitlines()
-        data = csv.DictReader(file)
-    elif file.name.endswith('.tsv'):
-        file = file.read().decode('utf-8').splitlines()
-        data = csv.DictReader(file, delimiter='\t')
+def async_task_for_od_pair_file(filepath, od_matrix_id):
+    if filepath.endswith('.csv'):
+        delimiter = ','
+    elif filepath.endswith('.tsv'):
+        delimiter = '\t'
     else:
         return "Error: Uploaded file format not recongnized"
+    # The file is read line by line.
+    with open(filepath, newline='', encoding='utf-8') as file:
+        return import_od_pairs(
+            csv.DictReader(file, delimiter=delimiter), od_matrix_id)
 
+
+def import_od_pairs(data, od_matrix_id):
+    """Imports the OD pairs of an OD matrix from an iterable of rows (dicts
+    with keys origin, destination and size)."""
     od_matrix = ODMatrix.objects.get(id=od_matrix_id)
     zoneset = od_matrix.zone_set
     zones = Zone.objects.filter(zone_set=zoneset)
-    zone_instance_dict = {zone.zone_id: zone for zone in zones}
+    zone_instance_dict = dict(zones.values_list('zone_id', 'id'))
     
     compteur = 0
     od_matrix_size=0
@@ -52,16 +60,13 @@ def async_task_for_od_pair_file(file, od_matrix_id):
             # compteur = compteur+1
         else:
             od_matrix_size += int(row['size'])
-            od_pair_instance = ODPair(
-                origin=origin,
-                destination=destination,
-                size=row['size'],
-                matrix=od_matrix,
-            )
+            od_pair_instance = (
+                origin, destination, int(row['size']), od_matrix.id)
             list_od_pair_instance.append(od_pair_instance)
     if list_od_pair_instance:
         try:
-            ODPair.objects.bulk_create(list_od_pair_instance)
+            bulk_load(ODPair, ('origin', 'destination', 'size', 'matrix'),
+                      list_od_pair_instance)
         except Exception:
             return "There is a problem with your file"
         else:
@@ -86,11 +91,13 @@ def upoload_od_pair(request, pk):
         return redirect('od_matrix_details', pk)
   
     if request.method == 'POST':
-        form = ODPairFileForm(request.POST, request.FILES)
-        if form.is_valid():
-            my_file = request.FILES['my_file']
+        # The file is either sent with the form or uploaded in parts
+        # beforehand (see uploads.py); it is saved on disk because large files
+        # cannot be sent as arguments of async tasks.
+        filepath = save_request_file(request)
+        if filepath is not None:
             task_id = async_task(async_task_for_od_pair_file,
-                                    my_file, pk, hook=str_hook )
+                                    filepath, pk, hook=str_hook )
             description  = "Importing OD Pair"
             db_task = BackgroundTask(
                 project=od_matrix.project,
@@ -103,7 +110,7 @@ def upoload_od_pair(request, pk):
             return redirect('od_matrix_details', pk)
         else:
             messages.error(request, 'You file does not respect Metropolisormat guidelines')
-            return render(request, template, {'form': form})
+            return render(request, template, {'form': ODPairFileForm()})
     else:
         form = ODPairFileForm()
         return render(request, template, {'form': form})
@@ -208,9 +215,7 @@ def od_pair_table(request, pk):
     od_matrix = ODMatrix.objects.get(id=pk)
     od_pair = ODPair.objects.select_related().filter(matrix=od_matrix)
     filter = ODPairFilter(request.GET, queryset=od_pair)
-    table = ODPairTable(filter.qs)
-    RequestConfig(request).configure(table)  # For sorting table column
-    table.paginate(page=request.GET.get("page", 1), per_page=15)
+    table, pagination = paginate_table(request, ODPairTable, filter.qs)
 
     current_path = request.get_full_path()
     network_attribute = current_path.split("/")[4]
@@ -218,6 +223,7 @@ def od_pair_table(request, pk):
     context = {
         "table": table,
         "filter": filter,
+        "pagination": pagination,
         'od_matrix': od_matrix,
         "network_attribute": network_attribute
     }
@@ -0,0 +1,214 @@
+"""
+Keyset pagination of the data tables (django_tables2) of large querysets.
+
+The tables of edges, nodes, zones, agents, OD pairs and zone-node relations
+can have millions of rows. They are not paginated with OFFSET (which reads
+and skips all the rows of the previous pages) and an exact COUNT(*):
+- the rows are ordered by the sort column of the table (`sort` parameter)
+  then by primary key, and a page is selected with a filter on the sort
+  value and primary key of the last row of the previous page (`after`
+  parameter) or of the first row of the next page (`before` parameter), so
+  that only the rows of the page are read from the index;
+- the number of rows is the estimate of the query planner (from the
+  statistics of PostgreSQL) when it is larger than
+  APPROXIMATE_COUNT_THRESHOLD.
+
+The columns which cannot be used as a key (geometries, properties) cannot be
+sorted: the rows are then ordered by primary key.
+"""
+import base64
+import binascii
+import json
+
+from django.contrib.gis.db.models import GeometryField
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import F, Q
+
+# Number of rows of each page.
+PER_PAGE = 15
+# Above this number of rows, the count of the rows is estimated.
+APPROXIMATE_COUNT_THRESHOLD = 100000
+
+JSON_TYPES = (bool, int, float, str)
+
+
+def estimate_count(queryset):
+    """Returns the number of rows of a queryset estimated by the query
+    planner of PostgreSQL, without running the query.
+    """
+    connection = connections[queryset.db]
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def get_count(queryset):
+    """Returns the number of rows of a queryset and True if the number is an
+    estimate.
+    """
+    if connections[queryset.db].vendor == 'postgresql':
+        estimate = estimate_count(queryset)
+        if estimate > APPROXIMATE_COUNT_THRESHOLD:
+            return estimate, True
+    return queryset.count(), False
+
+
+def get_sort_field(table_class, sort):
+    """Returns the model field of the column sorted by a `sort` parameter of
+    django_tables2 (name of the column, prefixed by '-' for a descending
+    order), or None if the column cannot be used as a key.
+    """
+    column = table_class.base_columns.get(sort.lstrip('-'))
+    if column is None or column.orderable is False:
+        return None
+    accessor = str(column.accessor or sort.lstrip('-'))
+    try:
+        field = table_class._meta.model._meta.get_field(accessor)
+    except FieldDoesNotExist:
+        return None
+    if (not field.concrete or field.many_to_many
+            or isinstance(field, GeometryField)):
+        return None
+    return field
+
+
+def after_filter(field, value, pk, descending=False):
+    """Returns the filter of the rows after the row with the given sort value
+    and primary key, in the order (field, pk) (NULL values are last in
+    ascending order and first in descending order, as in PostgreSQL).
+    """
+    gt = 'lt' if descending else 'gt'
+    pk_after = Q(**{'pk__{}'.format(gt): pk})
+    if field is None:
+        return pk_after
+    name = field.attname
+    if value is None:
+        condition = Q(**{'{}__isnull'.format(name): True}) & pk_after
+        if descending:
+            condition |= Q(**{'{}__isnull'.format(name): False})
+        return condition
+    condition = (Q(**{'{}__{}'.format(name, gt): value})
+                 | Q(**{name: value}) & pk_after)
+    if field.null and not descending:
+        condition |= Q(**{'{}__isnull'.format(name): True})
+    return condition
+
+
+def encode_cursor(sort, field, row):
+    value = None if field is None else getattr(row, field.attname)
+    if value is not None and not isinstance(value, JSON_TYPES):
+        value = str(value)
+    data = json.dumps([sort, value, row.pk]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(sort, field, cursor):
+    """Returns the sort value and primary key of a cursor, or None if the
+    cursor is invalid or was created for another sort column.
+    """
+    try:
+        cursor_sort, value, pk = json.loads(base64.urlsafe_b64decode(cursor))
+        if cursor_sort != sort or not isinstance(pk, int):
+            return None
+        if value is not None and field is not None:
+            value = field.to_python(value)
+    except (binascii.Error, TypeError, ValueError, ValidationError):
+        return None
+    return value, pk
+
+
+class KeysetPage:
+    """Rows of a page, given to a django_tables2 table as a QuerySet-like
+    object: the rows are already ordered, so order_by leaves them unchanged
+    (the table still marks the sorted column).
+    """
+
+    def __init__(self, model, rows):
+        self.model = model
+        self.rows = rows
+
+    def count(self):
+        return len(self.rows)
+
+    def order_by(self, *args):
+        return self
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, key):
+        return self.rows[key]
+
+
+def page_url(request, **cursors):
+    params = request.GET.copy()
+    for name in ('after', 'before'):
+        params.pop(name, None)
+    params.update(cursors)
+    return '?{}'.format(params.urlencode())
+
+
+def paginate_table(request, table_class, queryset, per_page=PER_PAGE):
+    """Returns a table with a page of the rows of a queryset and the
+    pagination context of the template (see module docstring).
+
+    :param table_class: django_tables2 table of the model of the queryset.
+    :param queryset: All the rows of the table (filtered).
+    :type table_class: django_tables2.Table
+    :type queryset: django.db.models.QuerySet
+    :returns: The table and a dictionary with the number of rows (`count`),
+       whether it is an estimate (`approximate`) and the URLs of the previous
+       and next pages (`previous_url`, `next_url`, None on the first and last
+       pages).
+    :rtype: tuple
+    """
+    sort = request.GET.get('sort', '')
+    field = get_sort_field(table_class, sort)
+    if field is None:
+        sort = ''
+    descending = sort.startswith('-')
+    ordering = ['-pk' if descending else 'pk']
+    if field is not None:
+        # The position of the NULL values of PostgreSQL (see after_filter),
+        # explicit for the other databases.
+        if descending:
+            ordering.insert(0, F(field.attname).desc(nulls_first=True))
+        else:
+            ordering.insert(0, F(field.attname).asc(nulls_last=True))
+    after = decode_cursor(sort, field, request.GET.get('after', ''))
+    before = decode_cursor(sort, field, request.GET.get('before', ''))
+    rows = queryset.order_by(*ordering)
+    if after is not None:
+        rows = rows.filter(after_filter(field, *after, descending))
+    elif before is not None:
+        # The rows before the cursor are the rows after it in reverse order.
+        rows = rows.reverse().filter(
+            after_filter(field, *before, not descending))
+    rows = list(rows[:per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if before is not None:
+        rows.reverse()
+    has_previous = after is not None or (before is not None and has_more)
+    has_next = before is not None or has_more
+    count, approximate = get_count(queryset)
+    pagination = {
+        'count': count,
+        'approximate': approximate,
+        'previous_url': page_url(
+            request, before=encode_cursor(sort, field, rows[0])
+        ) if has_previous and rows else None,
+        'next_url': page_url(
+            request, after=encode_cursor(sort, field, rows[-1])
+        ) if has_next and rows else None,
+    }
+    table = table_class(KeysetPage(queryset.model, rows), order_by=sort or ())
+    return table, pagination
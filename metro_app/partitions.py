@@ -0,0 +1,171 @@
+"""
+Partitioning of the result tables by run (PostgreSQL only).
+
+The result tables (EdgeResults, AgentResults, AgentRoadPath, AggregateResult)
+hold hundreds of millions of rows and are always queried run by run. With
+partition_result_tables (see the partition_results command), each table is
+converted to a table declaratively partitioned by LIST (run_id):
+- each run has its own partition of each table, created when the run is
+  created, so that the queries of a run only scan its partitions;
+- the rows of runs without partition go to a DEFAULT partition;
+- deleting a run drops its partitions instead of deleting its rows one by
+  one (see signals.py).
+
+The tables are created by the migrations as regular tables: the conversion
+is done once, after the migrations, and the later migrations (new columns,
+new indexes) apply to all the partitions. The primary key of a partitioned
+table must contain the partition key, so it becomes (id, run_id); the ids are
+still generated by the sequence of the table.
+"""
+import re
+
+from django.db import connection, transaction
+
+from .models import AgentResults, AgentRoadPath, AggregateResult, EdgeResults
+
+PARTITIONED_MODELS = (EdgeResults, AgentResults, AgentRoadPath,
+                      AggregateResult)
+
+
+def quote(name):
+    return connection.ops.quote_name(name)
+
+
+def get_partition_name(model, run_id):
+    return '{}_run_{}'.format(model._meta.db_table, run_id)
+
+
+def is_partitioned(model):
+    """Returns True if the table of a model is partitioned."""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table '
+            'WHERE partrelid = to_regclass(%s)',
+            [quote(model._meta.db_table)]
+        )
+        return cursor.fetchone() is not None
+
+
+def create_run_partitions(run_id):
+    """Creates the partitions of a run in the partitioned result tables."""
+    with connection.cursor() as cursor:
+        for model in PARTITIONED_MODELS:
+            if not is_partitioned(model):
+                continue
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS {} PARTITION OF {} '
+                'FOR VALUES IN (%s)'.format(
+                    quote(get_partition_name(model, run_id)),
+                    quote(model._meta.db_table)),
+                [int(run_id)]
+            )
+
+
+def drop_run_partitions(run_id):
+    """Drops the partitions of a run (and all its results) in the partitioned
+    result tables.
+    """
+    with connection.cursor() as cursor:
+        for model in PARTITIONED_MODELS:
+            if is_partitioned(model):
+                cursor.execute('DROP TABLE IF EXISTS {}'.format(
+                    quote(get_partition_name(model, run_id))))
+
+
+def move_indexes(cursor, source, target):
+    """Moves the indexes (except the primary key) and the foreign keys of a
+    table to another table with the same columns.
+    """
+    cursor.execute(
+        'SELECT i.indexname, i.indexdef FROM pg_indexes i '
+        'WHERE i.tablename = %s AND i.indexname NOT IN ('
+        '    SELECT conname FROM pg_constraint'
+        '    WHERE conrelid = to_regclass(%s) AND contype IN (\'p\', \'u\')'
+        ')',
+        [source, quote(source)]
+    )
+    for name, definition in cursor.fetchall():
+        cursor.execute('DROP INDEX {}'.format(quote(name)))
+        cursor.execute(re.sub(
+            r' ON (ONLY )?(\S+\.)?{} '.format(re.escape(quote(source))),
+            ' ON {} '.format(quote(target)),
+            definition,
+        ))
+    cursor.execute(
+        'SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint '
+        'WHERE conrelid = to_regclass(%s) AND contype = \'f\'',
+        [quote(source)]
+    )
+    for name, definition in cursor.fetchall():
+        cursor.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(
+            quote(source), quote(name)))
+        cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+            quote(target), quote(name), definition))
+
+
+@transaction.atomic
+def partition_table(model, run_ids):
+    """Converts the table of a model to a table partitioned by run, with one
+    partition for each of the given runs and a default partition. The rows
+    of the table are copied to the partitions.
+
+    :returns: Number of rows copied.
+    :rtype: integer
+    """
+    table = model._meta.db_table
+    old_table = table + '_unpartitioned'
+    pk = model._meta.pk.column
+    run = model._meta.get_field('run').column
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(
+            quote(table), quote(old_table)))
+        cursor.execute(
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING '
+            'CONSTRAINTS) PARTITION BY LIST ({})'.format(
+                quote(table), quote(old_table), quote(run)))
+        cursor.execute('ALTER TABLE {} ADD PRIMARY KEY ({}, {})'.format(
+            quote(table), quote(pk), quote(run)))
+        move_indexes(cursor, old_table, table)
+        cursor.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(
+            quote(table + '_default'), quote(table)))
+        for run_id in run_ids:
+            cursor.execute(
+                'CREATE TABLE {} PARTITION OF {} FOR VALUES IN (%s)'.format(
+                    quote(get_partition_name(model, run_id)), quote(table)),
+                [int(run_id)]
+            )
+        cursor.execute('INSERT INTO {} SELECT * FROM {}'.format(
+            quote(table), quote(old_table)))
+        count = cursor.rowcount
+        # The sequence of the ids would be dropped with the old table.
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)',
+                       [quote(old_table), pk])
+        sequence, = cursor.fetchone()
+        if sequence is not None:
+            cursor.execute('ALTER SEQUENCE {} OWNED BY {}.{}'.format(
+                sequence, quote(table), quote(pk)))
+        cursor.execute('DROP TABLE {}'.format(quote(old_table)))
+    return count
+
+
+def partition_result_tables(run_ids, stdout=None):
+    """Converts the result tables which are not partitioned yet (see
+    partition_table).
+
+    :returns: The names of the tables converted.
+    :rtype: list of str
+    """
+    if connection.vendor != 'postgresql':
+        raise ValueError('Partitioning requires PostgreSQL.')
+    converted = list()
+    for model in PARTITIONED_MODELS:
+        if is_partitioned(model):
+            continue
+        count = partition_table(model, run_ids)
+        converted.append(model._meta.db_table)
+        if stdout is not None:
+            stdout.write('{}: {} rows moved to {} partitions.'.format(
+                model._meta.db_table, count, len(run_ids) + 1))
+    return converted
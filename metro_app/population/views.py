@@ -3,6 +3,7 @@ from django.contrib import messages
 from metro_app.forms import PopulationForm, PopulationSegmentForm
 from metro_app.models import (Project, Population, PopulationSegment, 
                               Agent, BackgroundTask)
+from metro_app.deletion import start_deletion_task
                               
 
 
@@ -83,7 +84,10 @@ def population_details(request, pk):
 def delete_population(request, pk):
     population = Population.objects.get(id=pk)
     if request.method == 'POST':
-        population.delete()
+        start_deletion_task(Population, {'pk': population.id},
+                            population.project,
+                            'Deleting population {}'.format(population.name))
+        messages.success(request, 'Population deletion started')
         return redirect('list_of_populations', population.project.pk)
 
     context = {
@@ -0,0 +1,197 @@
+"""
+Reading of the import files of nodes, edges and zones.
+
+The files are read by chunks, with only the columns used by the importer
+(column projection), so that large files are never held in memory at once:
+- CSV and TSV files are read with pandas (the features have no geometry);
+- GeoParquet files are read by record batches with pyarrow, only the
+  requested columns are decoded;
+- the other formats (FlatGeobuf, GeoPackage, GeoJSON, Shapefile, ...) are read
+  feature by feature with Fiona, the fields not requested are ignored.
+
+The format is found from the extension of the file or, for the other
+extensions (or files without extension), from its first bytes (see
+get_file_format).
+
+When the file has a CRS, the geometries are converted to the SRID given by the
+importer.
+"""
+import itertools
+import json
+import os
+
+import fiona
+import geopandas as gpd
+import pandas as pd
+from pyproj import CRS
+
+# Number of features read at once.
+CHUNK_SIZE = 50000
+
+CSV = 'csv'
+TSV = 'tsv'
+PARQUET = 'parquet'
+# Formats read by Fiona.
+OGR = 'ogr'
+
+EXTENSIONS = {
+    '.csv': CSV,
+    '.txt': CSV,
+    '.tsv': TSV,
+    '.parquet': PARQUET,
+    '.geoparquet': PARQUET,
+    '.fgb': OGR,
+    '.gpkg': OGR,
+    '.geojson': OGR,
+    '.json': OGR,
+    '.shp': OGR,
+    '.zip': OGR,
+}
+# First bytes of the binary formats read by Fiona (FlatGeobuf, GeoPackage,
+# zipped Shapefile).
+OGR_SIGNATURES = (b'fgb', b'SQLite format 3', b'PK')
+# Number of bytes read to find the format of a file.
+SNIFF_SIZE = 4096
+
+
+def sniff_file_format(filepath):
+    """Returns the format of a file from its first bytes."""
+    with open(filepath, 'rb') as f:
+        head = f.read(SNIFF_SIZE)
+    if head.startswith(b'PAR1'):
+        return PARQUET
+    if head.startswith(OGR_SIGNATURES) or head.lstrip()[:1] in (b'{', b'['):
+        return OGR
+    try:
+        first_line = head.decode('utf-8').splitlines()[0]
+    except (UnicodeDecodeError, IndexError):
+        return OGR
+    return TSV if '\t' in first_line else CSV
+
+
+def get_file_format(filepath):
+    """Returns the format of a file (CSV, TSV, PARQUET or OGR), from its
+    extension or, if the extension is unknown, from its content.
+    """
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+    return sniff_file_format(filepath)
+
+
+def get_parquet_file(filepath):
+    # pyarrow is only imported when a GeoParquet file is read.
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError('Reading GeoParquet files requires pyarrow.')
+    return pq.ParquetFile(filepath)
+
+
+def get_parquet_geometry(parquet_file):
+    """Returns the name and the CRS of the primary geometry column of a
+    GeoParquet file (None if the file has no geometry).
+    """
+    metadata = parquet_file.schema_arrow.metadata or dict()
+    if b'geo' not in metadata:
+        return None, None
+    geo = json.loads(metadata[b'geo'])
+    column = geo['primary_column']
+    # The default CRS of GeoParquet is longitude / latitude on WGS84.
+    crs = geo['columns'][column].get('crs', 'OGC:CRS84')
+    if isinstance(crs, dict):
+        crs = CRS.from_json_dict(crs)
+    elif crs is not None:
+        crs = CRS.from_user_input(crs)
+    return column, crs
+
+
+def count_features(filepath):
+    """Returns the number of features of a file, or None if it cannot be
+    found without reading the file.
+    """
+    try:
+        file_format = get_file_format(filepath)
+        if file_format in (CSV, TSV):
+            with open(filepath, 'rb') as f:
+                return max(sum(1 for _ in f) - 1, 0)
+        if file_format == PARQUET:
+            return get_parquet_file(filepath).metadata.num_rows
+        with fiona.open(filepath) as source:
+            return len(source)
+    except Exception:
+        return None
+
+
+def to_srid(gdf, srid):
+    if srid is not None and gdf.crs is not None and gdf.crs.to_epsg() != srid:
+        gdf = gdf.to_crs(epsg=srid)
+    return gdf
+
+
+def iter_csv_chunks(filepath, columns, chunk_size, sep=','):
+    usecols = None if columns is None else (lambda c: c in columns)
+    for df in pd.read_csv(filepath, sep=sep, usecols=usecols,
+                          chunksize=chunk_size):
+        df['geometry'] = None
+        yield gpd.GeoDataFrame(df)
+
+
+def iter_parquet_chunks(filepath, columns, chunk_size, srid):
+    parquet_file = get_parquet_file(filepath)
+    geometry_column, crs = get_parquet_geometry(parquet_file)
+    names = parquet_file.schema_arrow.names
+    if columns is not None:
+        names = [name for name in names
+                 if name in columns or name == geometry_column]
+    for batch in parquet_file.iter_batches(batch_size=chunk_size,
+                                           columns=names):
+        df = batch.to_pandas()
+        if geometry_column in df.columns:
+            geometry = gpd.GeoSeries.from_wkb(
+                df.pop(geometry_column), crs=crs)
+            yield to_srid(gpd.GeoDataFrame(df, geometry=geometry), srid)
+        else:
+            df['geometry'] = None
+            yield gpd.GeoDataFrame(df)
+
+
+def iter_fiona_chunks(filepath, columns, chunk_size, srid):
+    ignore_fields = None
+    if columns is not None:
+        with fiona.open(filepath) as source:
+            ignore_fields = [field for field in source.schema['properties']
+                             if field not in columns]
+    with fiona.open(filepath, ignore_fields=ignore_fields) as source:
+        crs = source.crs_wkt or None
+        features = iter(source)
+        while batch := list(itertools.islice(features, chunk_size)):
+            gdf = gpd.GeoDataFrame.from_features(batch, crs=crs)
+            yield to_srid(gdf, srid)
+
+
+def iter_chunks(filepath, columns=None, chunk_size=CHUNK_SIZE, srid=None):
+    """Yields the features of a file as GeoDataFrames of at most
+    `chunk_size` rows.
+
+    :param filepath: Path of the file (see get_file_format).
+    :param columns: Names of the columns to read (the geometry is always
+       read), all the columns are read if None.
+    :param chunk_size: Maximum number of features of each GeoDataFrame.
+    :param srid: SRID to which the geometries are converted.
+    :type filepath: str
+    :type columns: iterable of str
+    :type chunk_size: integer
+    :type srid: integer
+    """
+    if columns is not None:
+        columns = set(columns)
+    file_format = get_file_format(filepath)
+    if file_format == CSV:
+        return iter_csv_chunks(filepath, columns, chunk_size)
+    if file_format == TSV:
+        return iter_csv_chunks(filepath, columns, chunk_size, sep='\t')
+    if file_format == PARQUET:
+        return iter_parquet_chunks(filepath, columns, chunk_size, srid)
+    return iter_fiona_chunks(filepath, columns, chunk_size, srid)
+
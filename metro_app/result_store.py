@@ -0,0 +1,263 @@
+"""
+Columnar store of the results of a run.
+
+When the `columnar_results` setting is enabled, the edge results and the agent
+paths of a run are not stored in the database but as NumPy arrays (.npy files)
+in the `results` directory of the output directory of the run:
+- edge_ids.npy, edge_user_ids.npy: primary key and user id of the edges (one
+  per row of the edge matrices);
+- breakpoints.npy: times of the columns of the edge matrices (in seconds);
+- travel_time.npy, speed.npy, congestion.npy: edge x time matrices;
+- travel_time_by_interval.npy, speed_by_interval.npy,
+  congestion_by_interval.npy: time x edge copies of the matrices (as float32),
+  so that the results of all the edges for one interval are contiguous (see
+  get_interval_values);
+- edge_order.npy: indices sorting edge_ids, to find the rows of edges from
+  their primary keys;
+- path_agent_ids.npy, path_edge_ids.npy, path_time.npy, path_travel_time.npy:
+  one entry per edge taken by an agent, sorted by agent.
+
+The arrays are read with memory mapping, so a slice of the results (e.g. one
+time interval or the path of one agent) is read without loading the whole
+files. The rows can be copied to the EdgeResults and AgentRoadPath tables on
+demand (see simulation_io.materialize_results).
+"""
+import os
+import shutil
+
+import numpy as np
+from django.conf import settings
+
+EDGE_FIELDS = ('travel_time', 'speed', 'congestion')
+PATH_FIELDS = (
+    ('agent_ids', np.int64),
+    ('edge_ids', np.int64),
+    ('time', np.float64),
+    ('travel_time', np.float64),
+)
+
+
+def get_result_directory(run):
+    return os.path.join(
+        settings.BASE_DIR, 'output_dir', str(run.id), 'results'
+    )
+
+
+# Suffix of the interval-major copies of the edge matrices.
+INTERVAL_SUFFIX = '_by_interval'
+# Number of edges transposed at once in the interval-major copies.
+TRANSPOSE_BLOCK = 65536
+
+
+def has_result_store(run):
+    return os.path.isdir(get_result_directory(run))
+
+
+def get_filename(directory, name):
+    return os.path.join(directory, '{}.npy'.format(name))
+
+
+class ArrayWriter:
+    """Write a 1-dimensional array to a .npy file by appending values, when
+    the size of the array is not known in advance.
+
+    The values are written to a raw file and the .npy file is created when the
+    writer is closed.
+    """
+
+    def __init__(self, filename, dtype):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self.file = open(filename + '.raw', 'wb')
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        values.tofile(self.file)
+        self.size += len(values)
+
+    def close(self):
+        self.file.close()
+        header = {
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (self.size, ),
+        }
+        with open(self.filename, 'wb') as f, \
+                open(self.filename + '.raw', 'rb') as raw:
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(raw, f)
+        os.remove(self.filename + '.raw')
+
+
+class ResultStoreWriter:
+    """Write the results of a run to its columnar store.
+
+    The arrays are written in a temporary directory which replaces the store of
+    the run when the writer is closed, so that a partially-written store is
+    never read.
+
+    :param run: Run of the results.
+    :param edge_ids: Primary keys of the edges, in the order of the simulator.
+    :param edge_user_ids: Ids of the edges, as used by the users, in the same
+       order.
+    :param breakpoints: Times at which the edge results are sampled (in
+       seconds).
+    """
+
+    def __init__(self, run, edge_ids, edge_user_ids, breakpoints):
+        self.directory = get_result_directory(run)
+        self.tmp_directory = self.directory + '.tmp'
+        shutil.rmtree(self.tmp_directory, ignore_errors=True)
+        os.makedirs(self.tmp_directory)
+        np.save(get_filename(self.tmp_directory, 'edge_ids'),
+                np.asarray(edge_ids, dtype=np.int64))
+        np.save(get_filename(self.tmp_directory, 'edge_user_ids'),
+                np.asarray(edge_user_ids, dtype=np.int64))
+        np.save(get_filename(self.tmp_directory, 'breakpoints'),
+                np.asarray(breakpoints, dtype=np.float64))
+        shape = (len(edge_ids), len(breakpoints))
+        self.edge_arrays = {
+            field: np.lib.format.open_memmap(
+                get_filename(self.tmp_directory, field), mode='w+',
+                dtype=np.float64, shape=shape)
+            for field in EDGE_FIELDS
+        }
+        self.path_writers = {
+            field: ArrayWriter(
+                get_filename(self.tmp_directory, 'path_' + field), dtype)
+            for field, dtype in PATH_FIELDS
+        }
+
+    def write_paths(self, agent_ids, edge_ids, times, travel_times):
+        """Append entries of agent paths (the agents must be written in
+        increasing order).
+        """
+        self.path_writers['agent_ids'].append(agent_ids)
+        self.path_writers['edge_ids'].append(edge_ids)
+        self.path_writers['time'].append(times)
+        self.path_writers['travel_time'].append(travel_times)
+
+    def write_edges(self, start, **values):
+        """Write the results of consecutive edges, starting at edge `start`.
+
+        The keyword arguments are matrices with one row per edge and one
+        column per breakpoint, for each field of EDGE_FIELDS.
+        """
+        for field, matrix in values.items():
+            self.edge_arrays[field][start:start + len(matrix)] = matrix
+
+    def write_interval_arrays(self):
+        """Write the interval-major copies of the edge matrices."""
+        for field, array in self.edge_arrays.items():
+            nb_edges, nb_breakpoints = array.shape
+            copy = np.lib.format.open_memmap(
+                get_filename(self.tmp_directory, field + INTERVAL_SUFFIX),
+                mode='w+', dtype=np.float32,
+                shape=(nb_breakpoints, nb_edges))
+            for start in range(0, nb_edges, TRANSPOSE_BLOCK):
+                stop = start + TRANSPOSE_BLOCK
+                copy[:, start:stop] = array[start:stop].T
+            copy.flush()
+        edge_ids = np.load(get_filename(self.tmp_directory, 'edge_ids'))
+        np.save(get_filename(self.tmp_directory, 'edge_order'),
+                np.argsort(edge_ids, kind='stable'))
+
+    def close(self):
+        for array in self.edge_arrays.values():
+            array.flush()
+        self.write_interval_arrays()
+        self.edge_arrays.clear()
+        for writer in self.path_writers.values():
+            writer.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.rename(self.tmp_directory, self.directory)
+
+    def abort(self):
+        self.edge_arrays.clear()
+        for writer in self.path_writers.values():
+            writer.file.close()
+        shutil.rmtree(self.tmp_directory, ignore_errors=True)
+
+
+def load_array(run, name):
+    """Return an array of the store of a run, as a read-only memory map."""
+    return np.load(get_filename(get_result_directory(run), name),
+                   mmap_mode='r')
+
+
+def get_edge_results(run, field, start=None, stop=None):
+    """Return the results of the edges of a run for a field of EDGE_FIELDS.
+
+    Only the results between the breakpoints of index `start` (included) and
+    `stop` (excluded) are read.
+
+    :returns: The user ids of the edges, the breakpoints and the matrix of
+       results (one row per edge, one column per breakpoint).
+    :rtype: tuple of numpy.ndarray
+    """
+    assert field in EDGE_FIELDS, 'Invalid field: {}'.format(field)
+    window = slice(start, stop)
+    return (
+        load_array(run, 'edge_user_ids'),
+        load_array(run, 'breakpoints')[window],
+        load_array(run, field)[:, window],
+    )
+
+
+def get_edge_rows(run, edge_ids):
+    """Return the rows of the edge matrices of a run of edges given by their
+    primary key (-1 for the edges without results).
+    """
+    store_ids = load_array(run, 'edge_ids')
+    filename = get_filename(get_result_directory(run), 'edge_order')
+    if os.path.exists(filename):
+        order = np.load(filename, mmap_mode='r')
+    else:
+        # Store written before the edge order was saved.
+        order = np.argsort(store_ids, kind='stable')
+    edge_ids = np.asarray(edge_ids, dtype=np.int64)
+    if not len(store_ids):
+        return np.full(len(edge_ids), -1)
+    positions = np.searchsorted(store_ids[order], edge_ids)
+    positions = np.minimum(positions, len(store_ids) - 1)
+    rows = np.asarray(order[positions])
+    return np.where(store_ids[rows] == edge_ids, rows, -1)
+
+
+def get_interval_values(run, field, interval, edge_ids):
+    """Return the results of edges given by their primary key for a field of
+    EDGE_FIELDS, at the breakpoint of index `interval` (NaN for the edges
+    without results).
+
+    :raises IndexError: If the interval does not exist.
+    :rtype: numpy.ndarray
+    """
+    assert field in EDGE_FIELDS, 'Invalid field: {}'.format(field)
+    rows = get_edge_rows(run, edge_ids)
+    directory = get_result_directory(run)
+    if os.path.exists(get_filename(directory, field + INTERVAL_SUFFIX)):
+        # One contiguous row of the interval-major copy.
+        values = load_array(run, field + INTERVAL_SUFFIX)[interval]
+    else:
+        values = load_array(run, field)[:, interval]
+    found = rows >= 0
+    result = np.full(len(rows), np.nan, dtype=np.float32)
+    result[found] = values[rows[found]]
+    return result
+
+
+def get_agent_path(run, agent_id):
+    """Return the path of an agent of a run, from its primary key.
+
+    :returns: The primary keys of the edges taken, the entry time on each
+       edge and the travel time on each edge (in seconds).
+    :rtype: tuple of numpy.ndarray
+    """
+    agent_ids = load_array(run, 'path_agent_ids')
+    start = np.searchsorted(agent_ids, agent_id, side='left')
+    stop = np.searchsorted(agent_ids, agent_id, side='right')
+    return tuple(
+        load_array(run, 'path_' + field)[start:stop]
+        for field in ('edge_ids', 'time', 'travel_time')
+    )
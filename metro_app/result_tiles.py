@@ -0,0 +1,99 @@
+"""
+Time-sliced results of the edges of a run, by map tile.
+
+The map animates the results of a run (speed, congestion, travel time of the
+edges) over the intervals of the period. Instead of loading the results of all
+the edges for all the intervals at once, the map requests the values of the
+edges of each visible tile (the vector tiles of tiles.py) for the current
+interval only. A result tile is a binary array of n edges:
+- the user ids of the edges (n little-endian uint32 or float64, as given by
+  the X-Edge-Id-Type header, see tiles.encode_feature_ids);
+- followed by the values of the field at the interval (n little-endian
+  float32, NaN if unknown).
+The values are joined to the features of the vector tiles by edge id, as
+feature states.
+
+With the columnar store of results, the values of an interval are read from
+the interval-major copies of the edge matrices (see result_store.py), so the
+results of one interval are contiguous on disk.
+"""
+from datetime import timedelta
+
+import numpy as np
+
+from .models import EdgeResults
+from .result_store import (EDGE_FIELDS, get_interval_values, has_result_store,
+                           load_array)
+from .tiles import encode_feature_ids, get_tile_edges
+
+
+def get_intervals(run):
+    """Returns the times of the intervals of the results of a run (in
+    seconds).
+
+    :rtype: numpy.ndarray
+    """
+    if has_result_store(run):
+        return np.asarray(load_array(run, 'breakpoints'))
+    times = EdgeResults.objects.filter(run=run).values_list(
+        'time', flat=True).distinct().order_by('time')
+    return np.array([time.total_seconds() for time in times])
+
+
+def get_interval_time(run, interval):
+    """Returns the time of the interval of index `interval` of the results of
+    a run, computed from its parameter set (the results are recorded every
+    period_interval from period_start to period_end, see
+    simulation_io.read_edge_results).
+
+    :raises IndexError: If the interval does not exist.
+    :rtype: datetime.timedelta
+    """
+    parameters = run.parameter_set
+    time = parameters.period_start + interval * parameters.period_interval
+    if interval < 0 or time > parameters.period_end:
+        raise IndexError('Invalid interval: {}'.format(interval))
+    return time
+
+
+def get_database_values(run, field, interval, edge_ids):
+    """Returns the results of edges given by their primary key for a field,
+    from the EdgeResults table (see result_store.get_interval_values).
+
+    :raises IndexError: If the interval does not exist.
+    """
+    time = get_interval_time(run, interval)
+    positions = {edge_id: i for i, edge_id in enumerate(edge_ids.tolist())}
+    values = np.full(len(edge_ids), np.nan, dtype=np.float32)
+    results = EdgeResults.objects.filter(
+        run=run, time=time, edge_id__in=list(positions)
+    ).values_list('edge_id', field)
+    for edge_id, value in results.iterator():
+        if isinstance(value, timedelta):
+            value = value.total_seconds()
+        values[positions[edge_id]] = value
+    return values
+
+
+def encode_result_tile(edge_ids, values):
+    """Returns the content of a result tile and the type of its edge ids."""
+    ids, id_type = encode_feature_ids(edge_ids)
+    return ids + np.asarray(values, dtype='<f4').tobytes(), id_type
+
+
+def get_result_tile(run, field, interval, z, x, y):
+    """Returns the results of the edges of the tile (z, x, y) of the road
+    network of a run, for a field of EDGE_FIELDS and the interval of index
+    `interval`.
+
+    :raises IndexError: If the interval does not exist.
+    :returns: The content of the result tile and the type of its edge ids.
+    :rtype: tuple
+    """
+    assert field in EDGE_FIELDS, 'Invalid field: {}'.format(field)
+    pks, edge_ids = get_tile_edges(run.network.road_network, z, x, y)
+    if has_result_store(run):
+        values = get_interval_values(run, field, interval, pks)
+    else:
+        values = get_database_values(run, field, interval, pks)
+    return encode_result_tile(edge_ids, values)
@@ -7,6 +7,7 @@ from metro_app.forms import (RoadNetworkForm, RoadTypeForm,
                             )
 from metro_app.filters import (EdgeFilter, NodeFilter, RoadTypeFilter)
 from metro_app.tables import (EdgeTable, NodeTable, RoadTypeTable)
+from metro_app.pagination import paginate_table
 from django_tables2 import RequestConfig
 from django.shortcuts import render, redirect
 from pyproj import CRS
@@ -15,6 +16,8 @@ from django.contrib import messages
 import csv
 from django_q.tasks import async_task
 from metro_app.hooks import str_hook
+from metro_app.visualization_cache import (bump_network_version,
+                                           remove_network_directory)
 from django.db import IntegrityError
 
 def create_road_network(request, pk):
@@ -87,6 +90,7 @@ def delete_road_network(request, pk):
     roadnetwork = RoadNetwork.objects.get(id=pk)
     if request.method == 'POST':
         roadnetwork.delete()
+        remove_network_directory(roadnetwork)
         return redirect('list_of_road_networks', roadnetwork.project.pk)
 
     context = {
@@ -177,6 +181,7 @@ def read_road_type_file(file, road_network_id):
             except IntegrityError:
                 return "There is a problem Id field. It shouldn't be empty."
             else:
+                bump_network_version(roadnetwork.id)
                 return "Your road type file has been successfully imported !"
         else:
             return "No data uploaded"
@@ -279,9 +284,7 @@ def edges_table(request, pk):
     roadnetwork = RoadNetwork.objects.get(id=pk)
     edges = Edge.objects.select_related().filter(network=roadnetwork)
     filter = EdgeFilter(request.GET, queryset=edges)
-    table = EdgeTable(filter.qs)
-    RequestConfig(request).configure(table)  # For sorting table column
-    table.paginate(page=request.GET.get("page", 1), per_page=15)
+    table, pagination = paginate_table(request, EdgeTable, filter.qs)
 
     current_path = request.get_full_path()
     network_attribute = current_path.split("/")[4]
@@ -289,6 +292,7 @@ def edges_table(request, pk):
     context = {
         "table": table,
         "filter": filter,
+        "pagination": pagination,
         "roadnetwork": roadnetwork,
         "network_attribute": network_attribute
                }
@@ -302,9 +306,7 @@ def nodes_table(request, pk):
     roadnetwork = RoadNetwork.objects.get(id=pk)
     nodes = Node.objects.select_related().filter(network=roadnetwork)
     filter = NodeFilter(request.GET, queryset=nodes)
-    table = NodeTable(filter.qs)
-    RequestConfig(request).configure(table)
-    # table.paginate(page=request.Get.get("page", 1), per_page=15)
+    table, pagination = paginate_table(request, NodeTable, filter.qs)
 
     current_path = request.get_full_path()
     network_attribute = current_path.split("/")[4]
@@ -312,6 +314,7 @@ def nodes_table(request, pk):
     context = {
         "table": table,
         "filter": filter,
+        "pagination": pagination,
         "roadnetwork": roadnetwork,
         "network_attribute": network_attribute
     }
@@ -4,10 +4,14 @@ from django.contrib import messages
 from metro_app.models import (Run, Project, Population, Network,
     ParameterSet, PopulationSegment, BackgroundTask, Agent)
 from metro_app.forms import RunForm
-from metro_app.simulation_io import to_input_json, from_output_json
+from metro_app.simulation_io import (to_input_json, load_run_output,
+                                     materialize_results)
+from metro_app.result_store import has_result_store
+from metro_app.deletion import start_deletion_task
 from django_q.tasks import async_task
 from metro_app.hooks import str_hook
 import os
+import uuid
 from django.conf import settings
 import subprocess
 
@@ -75,6 +79,7 @@ def run_details(request, pk):
     context = {
         'run': run,
         'tasks': tasks,
+        'has_result_store': has_result_store(run),
     }
     return render(request, 'details.html', context)
 
@@ -96,7 +101,12 @@ def update_run(request, pk):
 def delete_run(request, pk):
     run_to_delete = Run.objects.get(id=pk)
     if request.method == 'POST':
-        run_to_delete.delete()
+        # The results are deleted in the background (the result files are
+        # removed by the task).
+        start_deletion_task(Run, {'pk': run_to_delete.id},
+                            run_to_delete.project,
+                            'Deleting run {}'.format(run_to_delete.name))
+        messages.success(request, 'Run deletion started')
         return redirect('list_of_runs', run_to_delete.project.pk)
     
     context = {
@@ -120,6 +130,21 @@ def generate_run_input(request, pk):
     return redirect('run_details', pk)
 
 
+def materialize_run_results(request, pk):
+    run = Run.objects.get(id=pk)
+    task_id = async_task(materialize_results, run, hook=str_hook)
+    description = 'Copying results to the database'
+    db_task = BackgroundTask(
+        run=run,
+        project=run.project,
+        id=task_id,
+        description=description,
+    )
+    db_task.save()
+    messages.success(request, "Task successfully started")
+    return redirect('run_details', pk)
+
+
 def start_run(request, pk):
     run = Run.objects.get(id=pk)
     # to_input_json
@@ -135,8 +160,18 @@ def start_run(request, pk):
     # List all files in a directory using os.listdir
     if os.listdir(output_folder) and \
         os.path.isfile(os.path.join(output_folder, "results.json")):
-        from_output_json(run, os.path.join(output_folder, "results.json"))
-        #from_output_json(run, "./output_dir/results.json")
+        # The results are loaded by a background task which reports its
+        # progress to the BackgroundTask (its id is the group of the task).
+        task_id = uuid.uuid4()
+        BackgroundTask.objects.create(
+            id=task_id,
+            run=run,
+            project=run.project,
+            description='Loading the results',
+        )
+        async_task(load_run_output, run,
+                   os.path.join(output_folder, "results.json"), task_id,
+                   group=str(task_id), hook=str_hook)
     else:
         messages.error(request, "Simulateur doesn't give back the results.json folder")
         return redirect('run_details', run.pk)
@@ -0,0 +1,49 @@
+"""
+Signal receivers.
+
+Saving a node, an edge or a road type increments the version of its road
+network (see visualization_cache.py). The bulk operations (imports, deletions
+of querysets) do not send signals so they call bump_network_version
+themselves.
+
+When the result tables are partitioned by run (see partitions.py), the
+partitions of a run are created with the run and dropped before it is
+deleted.
+
+The pg_trgm extension, used by the trigram indexes of the names of nodes,
+edges and zones, is created before the migrations (see apps.py).
+"""
+from django.db import connections
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+
+from .models import Edge, Node, RoadType, Run
+from .partitions import create_run_partitions, drop_run_partitions
+from .visualization_cache import bump_network_version
+
+
+@receiver(post_save, sender=Node)
+@receiver(post_save, sender=Edge)
+@receiver(post_save, sender=RoadType)
+def bump_version_on_save(sender, instance, **kwargs):
+    bump_network_version(instance.network_id)
+
+
+@receiver(post_save, sender=Run)
+def create_partitions_on_save(sender, instance, created, **kwargs):
+    if created:
+        create_run_partitions(instance.id)
+
+
+@receiver(pre_delete, sender=Run)
+def drop_partitions_on_delete(sender, instance, **kwargs):
+    # The rows of the run are removed with its partitions, the cascade
+    # deletion then finds no row.
+    drop_run_partitions(instance.id)
+
+
+def create_extensions(sender, using, **kwargs):
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
@@ -1,9 +1,19 @@
+import itertools
 import json
 from datetime import timedelta
+import ijson
 import numpy as np
 import os
+from django.db import transaction
+from django.db.models import Max, Sum
 
+from metro_app.bulk import (bulk_load, bulk_load_columns, iter_column_rows,
+                            iter_instances)
+from metro_app.deletion import delete_in_chunks
+from metro_app.hooks import progress_reporter
 from metro_app.models import *
+from metro_app.result_store import (ResultStoreWriter, has_result_store,
+                                    load_array)
 
 
 """Generate `size` values from random distribution `distr`, with given mean and
@@ -17,6 +27,11 @@ Supported distributions are:
 """
 
 
+# Number of rows read from the database at once when exporting or importing
+# large tables.
+CHUNK_SIZE = 10000
+
+
 def get_input_directory(run):
     return os.path.join(
         settings.BASE_DIR, 'input_dir', str(run.id)
@@ -48,216 +63,395 @@ def generate_values(rng, distr, mean, std, size):
         raise f'Unsupported distribution: {distr}'
 
 
-"""Generate a list of agents for a given population segment and store them in
-the database.
+AGENT_COLUMNS = (
+    'agent_id', 'population', 'origin_zone', 'destination_zone',
+    'mode_choice_model', 'mode_choice_u', 'mode_choice_mu', 't_star', 'delta',
+    'beta', 'gamma', 'desired_arrival', 'vehicle', 'dep_time_car_choice_model',
+    'dep_time_car_u', 'dep_time_car_mu', 'dep_time_car_constant', 'car_vot',
+)
+
+
+# Maximum number of agents in a shard of a population (see
+# get_population_shards).
+SHARD_SIZE = 500000
+
+
+"""Split the agents of a population in shards which can be generated
+independently.
+
+Each shard is a range [start, stop) of the agents of a population segment,
+after expansion of its OD pairs, with at most `shard_size` agents. The shards
+are returned as a list of tuples (population_segment, start, stop, first_id),
+where `first_id` is the id of the first agent of the shard: the agent ids of
+the population are consecutive, starting at 1, in the order of the shards.
+The shards only depend on the population, not on the number of workers used to
+generate them.
 """
-def generate_agents(population):
-    
-    agents = list()
-    i = 0
-    rng = np.random.default_rng(population.random_seed)
-    
-    for population_segment in population.populationsegment_set.all():
-        preferences = population_segment.preferences
-        od_matrix = population_segment.od_matrix
-        size = od_matrix.size
-
-        # Generate random values.
-        if preferences.mode_choice_model == preferences.DETERMINISTIC_MODE:
-            mode_choice_u = rng.uniform(0, 1, size=size)
-        elif preferences.mode_choice_model == preferences.LOGIT_MODE:
-            mode_choice_u = rng.uniform(0, 1, size=size)
-            mode_choice_mu = generate_values(
-                rng,
-                preferences.mode_choice_mu_distr,
-                preferences.mode_choice_mu_mean,
-                preferences.mode_choice_mu_std,
-                size,
-            )
-        elif preferences.mode_choice_model == preferences.FIRST_MODE:
-            # Nothing to do.
-            pass
-        else:
-            msg = 'Unsupported distribution for mode choice: {}'
-            raise msg.format(preferences.mode_choice_model)
-        t_star = generate_values(
-            rng,
-            preferences.t_star_distr,
-            preferences.t_star_mean,
-            preferences.t_star_std,
-            size,
-        )
-        delta = generate_values(
-            rng,
-            preferences.delta_distr,
-            preferences.delta_mean,
-            preferences.delta_std,
-            size,
-        )
-        beta = generate_values(
+def get_population_shards(population, shard_size=SHARD_SIZE):
+    shards = list()
+    first_id = 1
+    segments = population.populationsegment_set.select_related(
+        'preferences').order_by('id')
+    for population_segment in segments:
+        size = population_segment.od_matrix.odpair_set.aggregate(
+            size=Sum('size'))['size'] or 0
+        for start in range(0, size, shard_size):
+            stop = min(start + shard_size, size)
+            shards.append((population_segment, start, stop, first_id + start))
+        first_id += size
+    return shards
+
+
+def get_shard_rng(population, nb_shards, index):
+    """Return the random-number generator of a shard of a population.
+
+    The seed of each shard is derived from the random seed of the population,
+    so the agents of a shard are the same whatever the process generating it.
+    """
+    seeds = np.random.SeedSequence(population.random_seed).spawn(nb_shards)
+    return np.random.default_rng(seeds[index])
+
+
+def get_shard_od_pairs(od_pairs, start, stop):
+    """Return the origin and destination zones of the agents `start` to
+    `stop` (excluded) of the expansion of OD pairs (each pair repeated `size`
+    times).
+
+    Only the pairs overlapping the range of the shard are expanded, so the
+    work of a shard does not depend on the size of the population segment.
+
+    :param od_pairs: Array of (origin, destination, size) rows.
+    :type od_pairs: numpy.ndarray
+    :returns: The arrays of origins and destinations.
+    :rtype: tuple
+    """
+    ends = np.cumsum(od_pairs[:, 2])
+    # Index of the pair of the first agent and after the pair of the last.
+    first = np.searchsorted(ends, start, side='right')
+    last = np.searchsorted(ends, stop - 1, side='right') + 1
+    pairs = od_pairs[first:last]
+    # Number of agents of each pair in [start, stop).
+    sizes = (np.minimum(ends[first:last], stop)
+             - np.maximum(ends[first:last] - pairs[:, 2], start))
+    return np.repeat(pairs[:, 0], sizes), np.repeat(pairs[:, 1], sizes)
+
+
+"""Generate the columns of the agents of a shard (see get_population_shards),
+as a dictionary mapping the names of AGENT_COLUMNS to arrays of values (or to a
+single value shared by all the agents).
+
+The random values are drawn as arrays and the origin-destination pairs are
+expanded with np.repeat (see get_shard_od_pairs), so no Python object is
+created per agent.
+"""
+def generate_shard_agents(rng, population_segment, start, stop, first_id):
+    preferences = population_segment.preferences
+    od_pairs = np.array(
+        list(population_segment.od_matrix.odpair_set.order_by(
+            'id').values_list('origin_id', 'destination_id', 'size')),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    size = stop - start
+    origins, destinations = get_shard_od_pairs(od_pairs, start, stop)
+
+    columns = {
+        'agent_id': np.arange(first_id, first_id + size),
+        'population': population_segment.population_id,
+        'origin_zone': origins,
+        'destination_zone': destinations,
+        'mode_choice_model': preferences.mode_choice_model,
+        'mode_choice_u': None,
+        'mode_choice_mu': None,
+        'desired_arrival': preferences.desired_arrival,
+        'vehicle': preferences.vehicle_id,
+        'dep_time_car_choice_model': preferences.dep_time_car_choice_model,
+        'dep_time_car_u': None,
+        'dep_time_car_mu': None,
+        'dep_time_car_constant': None,
+    }
+
+    # Generate random values.
+    if preferences.mode_choice_model == preferences.DETERMINISTIC_MODE:
+        columns['mode_choice_u'] = rng.uniform(0, 1, size=size)
+    elif preferences.mode_choice_model == preferences.LOGIT_MODE:
+        columns['mode_choice_u'] = rng.uniform(0, 1, size=size)
+        columns['mode_choice_mu'] = generate_values(
             rng,
-            preferences.beta_distr,
-            preferences.beta_mean,
-            preferences.beta_std,
+            preferences.mode_choice_mu_distr,
+            preferences.mode_choice_mu_mean,
+            preferences.mode_choice_mu_std,
             size,
         )
-        gamma = generate_values(
+    elif preferences.mode_choice_model == preferences.FIRST_MODE:
+        # Nothing to do.
+        pass
+    else:
+        msg = 'Unsupported distribution for mode choice: {}'
+        raise ValueError(msg.format(preferences.mode_choice_model))
+    # The durations are given in seconds to the bulk loader.
+    columns['t_star'] = generate_values(
+        rng,
+        preferences.t_star_distr,
+        preferences.t_star_mean,
+        preferences.t_star_std,
+        size,
+    )
+    columns['delta'] = generate_values(
+        rng,
+        preferences.delta_distr,
+        preferences.delta_mean,
+        preferences.delta_std,
+        size,
+    )
+    columns['beta'] = generate_values(
+        rng,
+        preferences.beta_distr,
+        preferences.beta_mean,
+        preferences.beta_std,
+        size,
+    ) / 3600.0
+    columns['gamma'] = generate_values(
+        rng,
+        preferences.gamma_distr,
+        preferences.gamma_mean,
+        preferences.gamma_std,
+        size,
+    ) / 3600.0
+    if preferences.dep_time_car_choice_model == preferences.LOGIT_DEP_TIME:
+        columns['dep_time_car_u'] = rng.uniform(0, 1, size=size)
+        columns['dep_time_car_mu'] = generate_values(
             rng,
-            preferences.gamma_distr,
-            preferences.gamma_mean,
-            preferences.gamma_std,
+            preferences.dep_time_car_mu_distr,
+            preferences.dep_time_car_mu_mean,
+            preferences.dep_time_car_mu_std,
             size,
         )
-        if preferences.dep_time_car_choice_model == preferences.LOGIT_DEP_TIME:
-            dep_time_car_u = rng.uniform(0, 1, size=size)
-            dep_time_car_mu = generate_values(
-                rng,
-                preferences.dep_time_car_mu_distr,
-                preferences.dep_time_car_mu_mean,
-                preferences.dep_time_car_mu_std,
-                size,
-            )
-        elif preferences.dep_time_car_choice_model == preferences.CONSTANT_DEP_TIME:
-            dep_time_car_constant = generate_values(
-                rng,
-                preferences.dep_time_car_constant_distr,
-                preferences.dep_time_car_constant_mean,
-                preferences.dep_time_car_constant_std,
-                size,
-            )
-        else:
-            msg = 'Unsupported distribution for departure time: {}'
-            raise msg.format(preferences.dep_time_car_choice_model)
-        car_vot = generate_values(
+    elif preferences.dep_time_car_choice_model == preferences.CONSTANT_DEP_TIME:
+        columns['dep_time_car_constant'] = generate_values(
             rng,
-            preferences.car_vot_distr,
-            preferences.car_vot_mean,
-            preferences.car_vot_std,
+            preferences.dep_time_car_constant_distr,
+            preferences.dep_time_car_constant_mean,
+            preferences.dep_time_car_constant_std,
             size,
         )
+    else:
+        msg = 'Unsupported distribution for departure time: {}'
+        raise ValueError(msg.format(preferences.dep_time_car_choice_model))
+    # The minus is here because the simulator expects the travel utility
+    # coefficient (not travel cost coefficient).
+    columns['car_vot'] = -generate_values(
+        rng,
+        preferences.car_vot_distr,
+        preferences.car_vot_mean,
+        preferences.car_vot_std,
+        size,
+    ) / 3600.0
+    return columns
 
-        for od_pair in od_matrix.odpair_set.all():
-            for _ in range(od_pair.size):
-                agent = Agent(
-                    agent_id=i + 1,
-                    population=population,
-                    origin_zone=od_pair.origin,
-                    destination_zone=od_pair.destination,
-                    mode_choice_model=preferences.mode_choice_model,
-                    t_star=timedelta(seconds=t_star[i]),
-                    delta=timedelta(seconds=delta[i]),
-                    beta=beta[i] / 3600.0,
-                    gamma=gamma[i] / 3600.0,
-                    desired_arrival=preferences.desired_arrival,
-                    vehicle=preferences.vehicle,
-                    dep_time_car_choice_model=preferences.dep_time_car_choice_model,
-                    # The minus is here because the simulator expects the travel
-                    # utility coefficient (not travel cost coefficient).
-                    car_vot=-car_vot[i] / 3600.0,
-                )
-                if preferences.mode_choice_model == preferences.DETERMINISTIC_MODE:
-                    agent.mode_choice_u = mode_choice_u[i]
-                elif preferences.mode_choice_model == preferences.LOGIT_MODE:
-                    agent.mode_choice_u = mode_choice_u[i]
-                    agent.mode_choice_mu = mode_choice_mu[i]
-                if preferences.dep_time_car_choice_model == preferences.LOGIT_DEP_TIME:
-                    agent.dep_time_car_u = dep_time_car_u[i]
-                    agent.dep_time_car_mu = dep_time_car_mu[i]
-                elif preferences.dep_time_car_choice_model == preferences.CONSTANT_DEP_TIME:
-                    agent.dep_time_car_constant = timedelta(
-                        seconds=dep_time_car_constant[i])
-                agents.append(agent)
-                i += 1
-    
+
+def generate_shard_columns(population, shards, index):
+    """Return the columns of the agents of a shard of a population (see
+    generate_shard_agents).
+    """
+    population_segment, start, stop, first_id = shards[index]
+    rng = get_shard_rng(population, len(shards), index)
+    return generate_shard_agents(
+        rng, population_segment, start, stop, first_id)
+
+
+def load_shard_agents(population, shards, index):
+    """Generate the agents of a shard of a population and store them in the
+    database.
+    """
+    _, start, stop, _ = shards[index]
+    columns = generate_shard_columns(population, shards, index)
+    bulk_load_columns(Agent, columns, stop - start)
+
+
+def iter_virtual_agents(population):
+    """Yield the agents of a population as unsaved Agent instances, in the
+    order of their ids, without reading or writing the Agent table (see
+    Population.virtual).
+
+    The shards are generated one at a time, so that the memory usage does not
+    depend on the size of the population.
+    """
+    shards = get_population_shards(population)
+    for index, (_, start, stop, _) in enumerate(shards):
+        columns = generate_shard_columns(population, shards, index)
+        yield from iter_instances(
+            Agent, list(columns), iter_column_rows(columns, stop - start))
+
+
+def get_population_size(population):
+    return sum(stop - start for _, start, stop, _ in
+               get_population_shards(population))
+
+
+"""Generate the agents of a population and store them in the database.
+
+The agents are generated shard by shard (see get_population_shards) as columns
+which are sent to the bulk loader without creating Agent instances. All the
+agents are stored in a single transaction.
+The agents are identical to the ones generated by the tasks of
+generate_agents_shard. Nothing is stored for virtual populations.
+"""
+def generate_agents(population):
+    if population.virtual:
+        population.generated = True
+        population.save()
+        return ('Virtual population: the agents are generated when the input '
+                'of the runs is exported')
     try:
-        Agent.objects.bulk_create(agents)
+        with transaction.atomic():
+            shards = get_population_shards(population)
+            for index in range(len(shards)):
+                load_shard_agents(population, shards, index)
     except Exception as e:
         return "Couldn't save agent due to his error: {}".format(e)
     else:
         population.generated = True
         population.save()
         return "Agents successfully created"
-   
 
+
+"""Generate the agents of a shard of a population and store them in the
+database.
+
+The shards of a population can be generated in parallel by different django-q
+workers (see hooks.agent_shard_hook). Any agent already stored with the ids of
+the shard is replaced so that the task can be retried.
 """
-Create a JSON input file readable by the simulator from a Run.
-"""
-def to_input_json(run):
-    network = dict()
-    road_network = run.network.road_network
-    if road_network is not None:
-        graph = dict()
-        graph["edge_property"] = "directed"
-        # Read nodes.
-        graph['nodes'] = list(road_network.node_set.all().values('id'))
-        node_map = dict()
-        for i, node in enumerate(graph['nodes']):
-            node_map[node['id']] = i
-        # Read edges.
-        graph['edges'] = list()
-        edges = road_network.edge_set.all().select_related(
-                'road_type', 'source', 'target')
-        for edge in edges:
-            source = node_map[edge.source.id]
-            target = node_map[edge.target.id]
-            edge_data = {
-                'id': edge.id,
-                'base_speed': edge.get_speed_in_m_per_s(),
-                'length': edge.get_length_in_meters(),
-                'lanes': edge.get_lanes(),
-                'speed_density': edge.get_speed_density(),
-            }
-            if (outflow := edge.get_outflow_in_m_per_s()) is not None:
-                edge_data['bottleneck_outflow'] = outflow
-            graph['edges'].append([source, target, edge_data])
+def generate_agents_shard(population, index, nb_shards):
+    assert not population.virtual, 'The agents of virtual populations are ' \
+        'not stored'
+    shards = get_population_shards(population)
+    assert len(shards) == nb_shards, \
+        'The population was modified during the generation of the agents'
+    _, start, stop, first_id = shards[index]
+    with transaction.atomic():
+        population.agent_set.filter(
+            agent_id__gte=first_id, agent_id__lt=first_id + stop - start,
+        ).delete()
+        load_shard_agents(population, shards, index)
+    return 'Generated agents {} to {}'.format(
+        first_id, first_id + stop - start - 1)
 
-    # Read vehicles.
-    vehicles = list()
-    vehicle_map = dict()
-    for i, vehicle in enumerate(run.project.vehicle_set.all()):
-        vehicle_map[vehicle.id] = i
-        speed_function = vehicle.get_speed_input()
-        vehicles.append({
-            'name': vehicle.name,
-            'length': vehicle.length,
-            'speed_function': speed_function,
-        })
 
-    agents = list()
-    valid_vehicles = set()
-    for agent in run.population.agent_set.all().select_related(
-            'vehicle', 'origin_zone', 'destination_zone'):
+def write_json_list(file, items):
+    """Write the elements of `items` to `file` as a JSON array, one element at
+    a time.
+
+    The output is identical to the one of `json.dump` but the elements do not
+    need to be held in memory at the same time.
+    """
+    file.write('[')
+    for i, item in enumerate(items):
+        if i:
+            file.write(', ')
+        file.write(json.dumps(item))
+    file.write(']')
+
+
+def get_ordered_edges(road_network):
+    """Return the edges of a road network in the order of the simulator: the
+    i-th edge of the simulator input is the i-th edge of this queryset.
+    """
+    return road_network.edge_set.order_by('id')
+
+
+def get_edge_index_filename(run):
+    return os.path.join(get_input_directory(run), 'edge_index.npy')
+
+
+def iter_edges_input(road_network, node_map, edge_ids):
+    """Yield the edges of a road network, in the format of the simulator.
+
+    The primary keys of the edges are appended to `edge_ids`, in the same
+    order.
+    """
+    edges = get_ordered_edges(road_network).select_related('road_type')
+    for edge in edges.iterator(chunk_size=CHUNK_SIZE):
+        edge_ids.append(edge.id)
+        source = node_map[edge.source_id]
+        target = node_map[edge.target_id]
+        edge_data = {
+            'id': edge.id,
+            'base_speed': edge.get_speed_in_m_per_s(),
+            'length': edge.get_length_in_meters(),
+            'lanes': edge.get_lanes(),
+            'speed_density': edge.get_speed_density(),
+        }
+        if (outflow := edge.get_outflow_in_m_per_s()) is not None:
+            edge_data['bottleneck_outflow'] = outflow
+        yield [source, target, edge_data]
+
+
+def get_agent_node(node_map, agent, node_id, zone_pk):
+    """Returns the index in the input of the simulator of the node connected
+    to the origin or destination zone of an agent (see
+    Agent.get_origin_node_id).
+
+    :raises ValueError: If the zone is not connected to a node of the road
+       network.
+    """
+    if node_id not in node_map:
+        raise ValueError(
+            'The zone {} of the agent {} is not connected to a node of the '
+            'road network'.format(Zone.objects.get(pk=zone_pk).zone_id,
+                                  agent.agent_id))
+    return node_map[node_id]
+
+
+def iter_agents_input(run, node_map, vehicle_map):
+    """Yield the agents of the population of a run, in the format of the
+    simulator.
+
+    The agents of virtual populations are generated on the fly.
+
+    :raises ValueError: If the origin or destination zone of an agent is not
+       connected to a node of the road network.
+    """
+    period = run.parameter_set.get_period()
+    # The zone-node map is built with a single query so that the origin and
+    # destination of the agents are resolved without hitting the database.
+    network = run.network
+    if run.population.virtual:
+        agents = iter_virtual_agents(run.population)
+    else:
+        agents = run.population.agent_set.order_by('id').iterator(
+            chunk_size=CHUNK_SIZE)
+    for agent in agents:
         modes = list()
+        car_origin = get_agent_node(
+            node_map, agent, agent.get_origin_node_id(network),
+            agent.origin_zone_id)
+        car_destination = get_agent_node(
+            node_map, agent, agent.get_destination_node_id(network),
+            agent.destination_zone_id)
         # Add Car mode.
-        car_origin = node_map[agent.get_origin_node(run.network).node_id]
-        car_destination = node_map[agent.get_destination_node(run.network).node_id]
-        vehicle_id = vehicle_map[agent.vehicle.id]
         try:
+            vehicle_id = vehicle_map[agent.vehicle_id]
             car = {
                 'origin': car_origin,
                 'destination': car_destination,
                 'vehicle': vehicle_id,
-                'departure_time_period': run.parameter_set.get_period(),
+                'departure_time_period': period,
                 'departure_time_model': agent.get_car_dep_time_model(),
                 'utility_model': agent.get_car_utility_model(),
             }
             modes.append({'Car': [0, car]})
-            valid_vehicles.add(vehicle_id)
         except KeyError:
             pass
-        agents.append({
+        yield {
             'modes': modes,
             'mode_choice': agent.get_mode_choice_model(),
             'schedule_utility': agent.get_schedule_delay_utility(),
-        })
+        }
 
-    # Keep only the vehicles with at least one agent.
-    #  vehicles = [vehicles[i] for i in valid_vehicles]
-    network['road_network'] = {
-        'graph': graph,
-        'vehicles': vehicles,
-    }
 
+def get_parameters_input(run):
+    """Return the parameters of a run, in the format of the simulator."""
     parameters = dict()
     parameters['period'] = run.parameter_set.get_period()
     parameters['learning_model'] = run.parameter_set.get_learning_model()
@@ -277,121 +471,563 @@ def to_input_json(run):
     }
     network_params = {'road_network': rn_params}
     parameters['network'] = network_params
+    return parameters
 
-    simulation = {
-        'network': network,
-        'agents': agents,
-        'parameters': parameters,
-    }
+
+"""
+Create a JSON input file readable by the simulator from a Run.
+
+The file is written incrementally: nodes, edges and agents are read from the
+database by chunks of CHUNK_SIZE rows (with server-side cursors on PostgreSQL)
+and written as soon as they are read, so that the memory usage does not depend
+on the size of the population or of the road network.
+The edge index of the run is saved next to the input file (see
+get_edge_index).
+"""
+def to_input_json(run):
+    road_network = run.network.road_network
+    # Read nodes.
+    node_ids = road_network.node_set.order_by('id').values_list(
+        'id', flat=True)
+    node_map = dict()
+    for i, node_id in enumerate(node_ids.iterator(chunk_size=CHUNK_SIZE)):
+        node_map[node_id] = i
+
+    # Read vehicles.
+    vehicles = list()
+    vehicle_map = dict()
+    for i, vehicle in enumerate(run.project.vehicle_set.all()):
+        vehicle_map[vehicle.id] = i
+        speed_function = vehicle.get_speed_input()
+        vehicles.append({
+            'name': vehicle.name,
+            'length': vehicle.length,
+            'speed_function': speed_function,
+        })
+
+    parameters = get_parameters_input(run)
 
     # Create and save agents in json file
     directory = get_input_directory(run)
     if not os.path.isdir(directory):
         os.makedirs(directory)
-    
-    with open(os.path.join(directory, "simulation.json"), 'w') as file:
-        # Saving the file
-        json.dump(simulation, file)
 
-    # return json.dumps(simulation)
+    filename = os.path.join(directory, "simulation.json")
+    try:
+        with open(filename, 'w') as file:
+            # The layout is the one of json.dump applied to the dictionary
+            # {'network': {'road_network': {'graph': graph,
+            #                               'vehicles': vehicles}},
+            #  'agents': agents, 'parameters': parameters}.
+            file.write('{"network": {"road_network": {"graph": ')
+            file.write('{"edge_property": "directed", "nodes": ')
+            write_json_list(file, ({'id': node_id} for node_id in node_map))
+            file.write(', "edges": ')
+            edge_ids = list()
+            write_json_list(
+                file, iter_edges_input(road_network, node_map, edge_ids))
+            file.write('}, "vehicles": ')
+            file.write(json.dumps(vehicles))
+            file.write('}}, "agents": ')
+            write_json_list(
+                file, iter_agents_input(run, node_map, vehicle_map))
+            file.write(', "parameters": ')
+            file.write(json.dumps(parameters))
+            file.write('}')
+    except BaseException:
+        # No partial input file is left for the simulator.
+        os.remove(filename)
+        raise
 
+    # Save the edge index (primary key of the edges in the order of the
+    # simulator) to map the edge indices of the output to edges.
+    np.save(get_edge_index_filename(run), np.array(edge_ids, dtype=np.int64))
 
-"""
-Load the output of a run in the database.
-"""
-def from_output_json(run, filename):
-    with open(filename) as f:
-        output = json.load(f)
 
-    # Read agent-specific results.
-    agent_results = list()
-    agents = run.population.agent_set.all()
-    assert len(agents) == len(output['agent_results']), \
-        'Invalid number of agent-specific results'
-    for (sim_res, agent) in zip(output['agent_results'], agents):
-        dt = timedelta(seconds=sim_res['departure_time'])
-        at = timedelta(seconds=sim_res['arrival_time'])
-        res = AgentResults(
-            agent=agent,
-            run=run,
-            utility=sim_res['utility'],
-            departure_time=dt,
-            arrival_time=at,
-            travel_time=at - dt,
-            real_cost=0.0,
-            surplus=sim_res['pre_day_results']['expected_utility'],
-        )
-        if 'Car' in sim_res['mode_results']:
-            res.mode = AgentResults.CAR
-            res.car_exp_arrival_time = timedelta(
-                seconds=sim_res['pre_day_results']['choices']['Car']['expected_arrival_time'])
-        agent_results.append(res)
-    AgentResults.objects.bulk_create(agent_results)
-
-    # Read agent paths.
-    agent_paths = list()
-    edges = run.network.road_network.edge_set.all()
-    for (sim_res, agent) in zip(output['agent_results'], agents):
-        if not 'Car' in sim_res['mode_results']:
-            continue
-        route = sim_res['mode_results']['Car']['route']
-        breakpoints = sim_res['mode_results']['Car']['road_breakpoints']
-        for i in range(len(route)):
-            edge = edges[route[i]]
-            if i + 1 < len(route):
-                tt = breakpoints[i + 1] - breakpoints[i]
-            else:
-                tt = sim_res['arrival_time'] - breakpoints[i]
-            path_entry = AgentRoadPath(
-                agent=agent,
-                run=run,
-                edge=edge,
-                time=timedelta(seconds=breakpoints[i]),
-                travel_time=timedelta(seconds=tt),
+def get_edge_index(run):
+    """Return the primary keys and the lengths of the edges of a run, in the
+    order of the simulator, as two lists.
+
+    The primary keys are read from the edge index saved with the input file of
+    the run. For runs exported before edge indices were saved, the edges are
+    sorted with the ordering of the export (get_ordered_edges).
+    The edges are read with a single query.
+    """
+    edges = get_ordered_edges(run.network.road_network).values_list(
+        'id', 'length')
+    rows = np.array(list(edges.iterator(chunk_size=CHUNK_SIZE)),
+                    dtype=[('id', np.int64), ('length', np.float64)])
+    ids = rows['id']
+    lengths = rows['length']
+    filename = get_edge_index_filename(run)
+    if os.path.isfile(filename):
+        index = np.load(filename)
+        # The ids are sorted so the position of the edges of the index are
+        # found with a binary search.
+        positions = np.searchsorted(ids, index)
+        assert (positions < len(ids)).all() \
+            and (ids[positions.clip(max=len(ids) - 1)] == index).all(), \
+            'The edge index does not match the edges of the road network'
+        ids = index
+        lengths = lengths[positions]
+    return ids.tolist(), lengths.tolist()
+
+
+def iter_batches(iterable, size):
+    """Yield lists of at most `size` consecutive elements of `iterable`."""
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+AGENT_RESULTS_COLUMNS = (
+    'agent', 'run', 'mode', 'departure_time', 'arrival_time', 'travel_time',
+    'utility', 'real_cost', 'surplus', 'car_exp_arrival_time',
+)
+AGENT_ROAD_PATH_COLUMNS = ('agent', 'run', 'edge', 'time', 'travel_time')
+EDGE_RESULTS_COLUMNS = (
+    'edge', 'run', 'time', 'congestion', 'travel_time', 'speed',
+)
+
+
+def get_agent_results(run, agent_id, sim_res):
+    """Return the AgentResults row of an agent from its simulator output (see
+    AGENT_RESULTS_COLUMNS).
+    """
+    dt = sim_res['departure_time']
+    at = sim_res['arrival_time']
+    if 'Car' in sim_res['mode_results']:
+        mode = AgentResults.CAR
+        car_exp_arrival_time = \
+            sim_res['pre_day_results']['choices']['Car']['expected_arrival_time']
+    else:
+        mode = None
+        car_exp_arrival_time = None
+    return (
+        agent_id,
+        run.id,
+        mode,
+        dt,
+        at,
+        at - dt,
+        sim_res['utility'],
+        0.0,
+        sim_res['pre_day_results']['expected_utility'],
+        car_exp_arrival_time,
+    )
+
+
+def iter_agent_path(run, agent_id, sim_res, edge_ids):
+    """Yield the AgentRoadPath rows of an agent from its simulator output (see
+    AGENT_ROAD_PATH_COLUMNS).
+
+    `edge_ids` is the list of the primary keys of the edges, in the order of
+    the simulator (see get_edge_index).
+    """
+    if not 'Car' in sim_res['mode_results']:
+        return
+    route = sim_res['mode_results']['Car']['route']
+    breakpoints = sim_res['mode_results']['Car']['road_breakpoints']
+    for i in range(len(route)):
+        if i + 1 < len(route):
+            tt = breakpoints[i + 1] - breakpoints[i]
+        else:
+            tt = sim_res['arrival_time'] - breakpoints[i]
+        yield (agent_id, run.id, edge_ids[route[i]], breakpoints[i], tt)
+
+
+def sample_ttfs(ttfs, breakpoints, interpolate=False):
+    """Evaluate travel-time functions of the simulator at breakpoints.
+
+    All the functions are evaluated at once: the points of the piecewise
+    functions are concatenated in a single array and the point used for each
+    (edge, breakpoint) pair is found with a single binary search. A constant
+    function is handled as a piecewise function with a single point.
+
+    :param ttfs: Travel-time functions, as read in the simulator output
+       (either {'Constant': y} or {'Piecewise': {'points': [{'x': x, 'y': y},
+       ...]}}).
+    :param breakpoints: Increasing times at which the functions are evaluated
+       (in seconds).
+    :param interpolate: If True, the travel times are linearly interpolated
+       between the points of the functions. Otherwise, the travel time of the
+       last point before the breakpoint is used (or the one of the first point
+       for breakpoints before the first point).
+    :type ttfs: list of dict
+    :type breakpoints: numpy.ndarray
+    :type interpolate: bool
+    :returns: Travel times, with one row per function and one column per
+       breakpoint.
+    :rtype: numpy.ndarray
+    """
+    xs = list()
+    ys = list()
+    sizes = list()
+    for ttf in ttfs:
+        if 'Piecewise' in ttf:
+            points = ttf['Piecewise']['points']
+            xs.extend(point['x'] for point in points)
+            ys.extend(point['y'] for point in points)
+            sizes.append(len(points))
+        else:
+            xs.append(-np.inf)
+            ys.append(ttf['Constant'])
+            sizes.append(1)
+    xs = np.array(xs, dtype=np.float64)
+    ys = np.array(ys, dtype=np.float64)
+    sizes = np.array(sizes, dtype=np.int64)
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    nb_ttfs = len(sizes)
+    nb_breakpoints = len(breakpoints)
+    # The x values are replaced by their rank among the breakpoints (the
+    # number of breakpoints strictly lower than x) so that the functions can be
+    # searched together with integer keys, which are sorted by function then
+    # by x.
+    ranks = np.searchsorted(breakpoints, xs, side='left')
+    ttf_index = np.repeat(np.arange(nb_ttfs), sizes)
+    keys = ttf_index * (nb_breakpoints + 1) + ranks
+    queries = (
+        np.arange(nb_ttfs)[:, np.newaxis] * (nb_breakpoints + 1)
+        + np.arange(nb_breakpoints)[np.newaxis, :]
+    )
+    # Position of the first point after each breakpoint.
+    after = np.searchsorted(keys, queries, side='right')
+    # Position of the last point before each breakpoint (or of the first
+    # point of the function if there is none).
+    before = np.maximum(after - 1, starts[:, np.newaxis])
+    travel_times = ys[before]
+    if interpolate:
+        has_next = (after > starts[:, np.newaxis]) \
+            & (after < ends[:, np.newaxis])
+        nxt = np.where(has_next, after, before)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # The x value of constant functions is -inf.
+            dx = xs[nxt] - xs[before]
+            ratio = np.where(
+                has_next & (dx > 0),
+                (breakpoints[np.newaxis, :] - xs[before]) / dx,
+                0.0,
             )
-            agent_paths.append(path_entry)
-    AgentRoadPath.objects.bulk_create(agent_paths)
+        travel_times = travel_times + ratio * (ys[nxt] - travel_times)
+    return travel_times
+
 
-    # Read edge travel times.
+def iter_edge_results(run, edge_ids, lengths, travel_times, breakpoints):
+    """Yield the EdgeResults rows of edges from their travel times at each
+    breakpoint (see EDGE_RESULTS_COLUMNS and sample_ttfs).
+    """
+    nb_edges, nb_breakpoints = travel_times.shape
+    speeds = np.asarray(lengths)[:, np.newaxis] / travel_times
+    return zip(
+        np.repeat(edge_ids, nb_breakpoints).tolist(),
+        itertools.repeat(run.id),
+        np.tile(breakpoints, nb_edges).tolist(),
+        # TODO: congestion.
+        itertools.repeat(0.0),
+        travel_times.ravel().tolist(),
+        speeds.ravel().tolist(),
+    )
+
+
+"""
+Load the output of a run in the database.
+
+The output file is parsed as a stream: agent results and edge weights are read
+and stored by batches of `batch_size` agents or edges, so that the memory usage
+does not depend on the size of the output.
+If not None, `progress` is called after each batch with a description of the
+current step, the number of agents or edges processed so far and their total
+number.
+The travel times of the edges are sampled at each interval of the period (see
+sample_ttfs), with linear interpolation if `interpolate_ttfs` is True.
+If `columnar` is True (default is the `COLUMNAR_RESULTS` setting), the edge
+results and the agent paths are written to the columnar store of the run (see
+metro_app.result_store) instead of the database.
+Each batch is stored in its own transaction, so that the progress is visible
+while the output is read. If the output cannot be read completely, the
+results of the run are deleted.
+"""
+def from_output_json(run, filename, batch_size=CHUNK_SIZE, progress=None,
+                     interpolate_ttfs=False, columnar=None):
+    if columnar is None:
+        columnar = settings.COLUMNAR_RESULTS
+    population = run.population
+    if population.virtual:
+        # Only the results of the materialized agents are stored (see
+        # materialize_agents).
+        nb_agents = get_population_size(population)
+        pks = dict(population.agent_set.values_list('agent_id', 'id'))
+        agent_ids = (pks.get(i) for i in range(1, nb_agents + 1))
+    else:
+        agents = population.agent_set.order_by('id')
+        nb_agents = agents.count()
+        agent_ids = agents.values_list('id', flat=True).iterator(
+            chunk_size=batch_size)
+    edge_ids, edge_lengths = get_edge_index(run)
     breakpoints = np.arange(
         run.parameter_set.period_start.total_seconds(),
         run.parameter_set.period_end.total_seconds() + 1,
         run.parameter_set.period_interval.total_seconds(),
     )
-    edge_results = list()
-    # TODO: For now, we only take the edge weights of the first vehicle.
-    for i, ttf in enumerate(output['weights']['road_network'][0]):
-        edge = edges[i]
-        length = edge.length
-        if 'Piecewise' in ttf:
-            points = ttf['Piecewise']['points']
-            n = len(points)
-            j = 0
-            for bp in breakpoints:
-                while j + 1 < n and points[j + 1]['x'] <= bp:
-                    j += 1
-                res = EdgeResults(
-                    edge=edge,
-                    run=run,
-                    time=timedelta(seconds=bp),
-                    congestion=0.0, # TODO
-                    travel_time=timedelta(seconds=points[j]['y']),
-                    speed=length / points[j]['y'],
+    store = None
+    if columnar:
+        user_ids = dict(
+            run.network.road_network.edge_set.values_list('id', 'edge_id'))
+        store = ResultStoreWriter(
+            run, edge_ids, [user_ids[edge_id] for edge_id in edge_ids],
+            breakpoints)
+        del user_ids
+    try:
+        read_agent_results(run, filename, agent_ids, nb_agents, edge_ids,
+                           store, batch_size, progress)
+        read_edge_results(run, filename, edge_ids, edge_lengths,
+                          breakpoints, store, batch_size, progress,
+                          interpolate_ttfs)
+    except BaseException:
+        if store is not None:
+            store.abort()
+        delete_run_results(run, progress)
+        raise
+    if store is not None:
+        store.close()
+
+
+def delete_run_results(run, progress=None):
+    """Delete the agent results, agent paths and edge results of a run, by
+    chunks (see deletion.delete_in_chunks).
+    """
+    report = progress or (lambda step, count, total=None: None)
+    for model in (AgentResults, AgentRoadPath, EdgeResults):
+        delete_in_chunks(model.objects.filter(run=run), report)
+
+
+"""
+Load the output of a run in the database (see from_output_json), reporting
+the progress to the BackgroundTask of id `task_id`.
+
+The function is run as a background task so it returns a message describing
+the result.
+"""
+def load_run_output(run, filename, task_id):
+    from_output_json(run, filename, progress=progress_reporter(id=task_id))
+    return 'Results successfully loaded'
+
+
+def read_agent_results(run, filename, agent_ids, nb_agents, edge_ids, store,
+                       batch_size, progress):
+    """Read the agent-specific results and the agent paths of the output of a
+    run (see from_output_json).
+
+    `agent_ids` yields the primary key of the agent of each result, in the
+    order of the output, or None if the result must not be stored.
+    """
+    with open(filename, 'rb') as f:
+        sim_results = ijson.items(
+            f, 'agent_results.item', use_float=True)
+        count = 0
+        # The agent ids come first so that zip does not consume an
+        # additional result when all the agents have been read.
+        for batch in iter_batches(zip(agent_ids, sim_results), batch_size):
+            count += len(batch)
+            batch = [
+                (agent_id, sim_res) for agent_id, sim_res in batch
+                if agent_id is not None
+            ]
+            with transaction.atomic():
+                bulk_load(
+                    AgentResults,
+                    AGENT_RESULTS_COLUMNS,
+                    (
+                        get_agent_results(run, agent_id, sim_res)
+                        for agent_id, sim_res in batch
+                    ),
+                    batch_size=batch_size,
                 )
-                edge_results.append(res)
-        else:
-            tt = ttf['Constant']
-            for bp in breakpoints:
-                res = EdgeResults(
-                    edge=edge,
-                    run=run,
-                    time=timedelta(seconds=bp),
-                    congestion=0.0, # TODO
-                    travel_time=timedelta(seconds=tt),
-                    speed=length / tt,
+                paths = itertools.chain.from_iterable(
+                    iter_agent_path(run, agent_id, sim_res, edge_ids)
+                    for agent_id, sim_res in batch
                 )
-                edge_results.append(res)
-    EdgeResults.objects.bulk_create(edge_results)
+                if store is not None:
+                    rows = list(paths)
+                    if rows:
+                        agent, _, edge, time, travel_time = zip(*rows)
+                        store.write_paths(agent, edge, time, travel_time)
+                else:
+                    bulk_load(AgentRoadPath, AGENT_ROAD_PATH_COLUMNS, paths,
+                              batch_size=batch_size)
+            if progress is not None:
+                progress('Agent results', count, nb_agents)
+        assert count == nb_agents and next(sim_results, None) is None, \
+            'Invalid number of agent-specific results'
+
+
+def read_edge_results(run, filename, edge_ids, edge_lengths, breakpoints,
+                      store, batch_size, progress, interpolate_ttfs):
+    """Read the travel-time functions of the edges of the output of a run
+    (see from_output_json).
+    """
+    nb_edges = len(edge_ids)
+    with open(filename, 'rb') as f:
+        # TODO: For now, we only take the edge weights of the first
+        # vehicle (they are the first nb_edges weights of the file).
+        ttfs = itertools.islice(
+            ijson.items(
+                f, 'weights.road_network.item.item', use_float=True),
+            nb_edges,
+        )
+        count = 0
+        for batch in iter_batches(ttfs, batch_size):
+            travel_times = sample_ttfs(
+                batch, breakpoints, interpolate=interpolate_ttfs)
+            lengths = edge_lengths[count:count + len(batch)]
+            if store is not None:
+                store.write_edges(
+                    count,
+                    travel_time=travel_times,
+                    speed=np.asarray(lengths)[:, np.newaxis] / travel_times,
+                    # TODO: congestion.
+                    congestion=np.zeros_like(travel_times),
+                )
+            else:
+                with transaction.atomic():
+                    bulk_load(
+                        EdgeResults,
+                        EDGE_RESULTS_COLUMNS,
+                        iter_edge_results(
+                            run,
+                            edge_ids[count:count + len(batch)],
+                            lengths,
+                            travel_times,
+                            breakpoints,
+                        ),
+                        batch_size=batch_size,
+                    )
+            count += len(batch)
+            if progress is not None:
+                progress('Edge results', count, nb_edges)
+
+
+def get_output_filename(run):
+    return os.path.join(
+        settings.BASE_DIR, 'output_dir', str(run.id), 'results.json'
+    )
+
+
+"""
+Store a slice of the agents of a virtual population in the database.
+
+The slice is given by a range of agent ids (`first_id` and `last_id`, both
+included) and / or by the primary keys of an origin and a destination zone.
+Only the shards containing agents of the slice are generated, and the agents
+already stored are skipped.
+The results of the new agents are then read from the output of each run of
+the population which is still available.
+
+The function is run as a background task so it returns a message describing
+the result.
+"""
+def materialize_agents(population, first_id=None, last_id=None, origin=None,
+                       destination=None, batch_size=CHUNK_SIZE):
+    existing_ids = np.array(
+        list(population.agent_set.values_list('agent_id', flat=True)),
+        dtype=np.int64,
+    )
+    last_pk = population.agent_set.aggregate(last=Max('id'))['last'] or 0
+    shards = get_population_shards(population)
+    nb_agents = sum(stop - start for _, start, stop, _ in shards)
+    count = 0
+    with transaction.atomic():
+        for index, (_, start, stop, shard_first_id) in enumerate(shards):
+            shard_last_id = shard_first_id + stop - start - 1
+            if first_id is not None and shard_last_id < first_id:
+                continue
+            if last_id is not None and shard_first_id > last_id:
+                continue
+            columns = generate_shard_columns(population, shards, index)
+            ids = columns['agent_id']
+            mask = ~np.isin(ids, existing_ids)
+            if first_id is not None:
+                mask &= ids >= first_id
+            if last_id is not None:
+                mask &= ids <= last_id
+            if origin is not None:
+                mask &= columns['origin_zone'] == origin
+            if destination is not None:
+                mask &= columns['destination_zone'] == destination
+            columns = {
+                name: values[mask] if isinstance(values, np.ndarray)
+                else values
+                for name, values in columns.items()
+            }
+            count += bulk_load_columns(
+                Agent, columns, int(mask.sum()), batch_size=batch_size)
+
+        # Read the results of the new agents.
+        pks = dict(population.agent_set.filter(id__gt=last_pk).values_list(
+            'agent_id', 'id'))
+        for run in population.run_set.all():
+            filename = get_output_filename(run)
+            if not pks or not os.path.isfile(filename):
+                continue
+            edge_ids, _ = get_edge_index(run)
+            read_agent_results(
+                run, filename, (pks.get(i) for i in range(1, nb_agents + 1)),
+                nb_agents, edge_ids, None, batch_size, None)
+    return '{} agents successfully materialized'.format(count)
+
+
+"""
+Copy the edge results and the agent paths of the columnar store of a run to
+the database (see metro_app.result_store).
+
+The function is run as a background task so it returns a message describing
+the result.
+"""
+def materialize_results(run, batch_size=CHUNK_SIZE):
+    if not has_result_store(run):
+        return 'The run has no columnar results'
+    if (EdgeResults.objects.filter(run=run).exists()
+            or AgentRoadPath.objects.filter(run=run).exists()):
+        return 'The results of the run are already in the database'
+    edge_ids = load_array(run, 'edge_ids')
+    breakpoints = load_array(run, 'breakpoints')
+    travel_times = load_array(run, 'travel_time')
+    speeds = load_array(run, 'speed')
+    congestions = load_array(run, 'congestion')
+    nb_breakpoints = len(breakpoints)
+    path_arrays = [
+        load_array(run, 'path_' + field)
+        for field in ('agent_ids', 'edge_ids', 'time', 'travel_time')
+    ]
+    with transaction.atomic():
+        for start in range(0, len(edge_ids), batch_size):
+            window = slice(start, start + batch_size)
+            nb_edges = len(edge_ids[window])
+            bulk_load(
+                EdgeResults,
+                EDGE_RESULTS_COLUMNS,
+                zip(
+                    np.repeat(edge_ids[window], nb_breakpoints).tolist(),
+                    itertools.repeat(run.id),
+                    np.tile(breakpoints, nb_edges).tolist(),
+                    congestions[window].ravel().tolist(),
+                    travel_times[window].ravel().tolist(),
+                    speeds[window].ravel().tolist(),
+                ),
+                batch_size=batch_size,
+            )
+        for start in range(0, len(path_arrays[0]), batch_size):
+            window = slice(start, start + batch_size)
+            agent, edge, time, travel_time = (
+                array[window].tolist() for array in path_arrays)
+            bulk_load(
+                AgentRoadPath,
+                AGENT_ROAD_PATH_COLUMNS,
+                zip(agent, itertools.repeat(run.id), edge, time, travel_time),
+                batch_size=batch_size,
+            )
+    return 'Results successfully copied to the database'
 
 
 """
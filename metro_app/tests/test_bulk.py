@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+import numpy as np
+from django.db import models
+from django.test import SimpleTestCase
+
+from metro_app.bulk import COPY_NULL, copy_formatter, format_array
+
+
+class TestDurationFormat(SimpleTestCase):
+
+    def test_copy_formatter_small_duration(self):
+        formatter = copy_formatter(models.DurationField())
+        self.assertEquals(formatter(1e-05), '0.000010 seconds')
+
+    def test_copy_formatter_large_duration(self):
+        formatter = copy_formatter(models.DurationField())
+        self.assertEquals(formatter(1e16), '10000000000000000.000000 seconds')
+
+    def test_copy_formatter_timedelta(self):
+        formatter = copy_formatter(models.DurationField())
+        self.assertEquals(formatter(timedelta(minutes=1, microseconds=5)),
+                          '60.000005 seconds')
+
+    def test_format_array_durations(self):
+        values = np.array([1e-05, 1e16, np.nan, -30.5])
+        self.assertEquals(
+            format_array(models.DurationField(), values),
+            ['0.000010 seconds', '10000000000000000.000000 seconds',
+             COPY_NULL, '-30.500000 seconds'],
+        )
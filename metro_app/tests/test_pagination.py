@@ -0,0 +1,94 @@
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import LineString, Point
+from django.test import RequestFactory, TestCase
+
+from metro_app.models import Edge, Node, Project, RoadNetwork, RoadType
+from metro_app.pagination import paginate_table
+from metro_app.tables import EdgeTable
+
+PER_PAGE = 3
+# Sort values of the edges, with ties and NULLs across the page boundaries.
+SPEEDS = [50, None, 30, 50, None, 50, 30, 70, None, 50, 50]
+NAMES = ['b', None, 'a', 'b', 'b', None, 'a', None, 'c', 'b', 'a']
+
+
+class TestKeysetPagination(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user('owner')
+        project = Project.objects.create(owner=owner, name='project')
+        roadnetwork = RoadNetwork.objects.create(
+            project=project, name='network')
+        road_type = RoadType.objects.create(
+            network=roadnetwork, road_type_id=1)
+        source, target = [
+            Node.objects.create(network=roadnetwork, node_id=i,
+                                location=Point(i, 0))
+            for i in range(2)
+        ]
+        for i, (speed, name) in enumerate(zip(SPEEDS, NAMES)):
+            Edge.objects.create(
+                network=roadnetwork, source=source, target=target,
+                road_type=road_type, edge_id=i, name=name,
+                geometry=LineString((0, 0), (1, 0)), length=1, speed=speed,
+            )
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def get_page(self, query):
+        request = self.factory.get('/edges/' + query)
+        table, pagination = paginate_table(
+            request, EdgeTable, Edge.objects.all(), per_page=PER_PAGE)
+        return [row.record.pk for row in table.rows], pagination
+
+    def get_expected_order(self, sort):
+        # NULL values are last in ascending order (as in PostgreSQL).
+        name = sort.lstrip('-')
+
+        def key(edge):
+            value = getattr(edge, name) if name else None
+            return (value is None, value or 0, edge.pk)
+
+        pks = [edge.pk for edge in sorted(Edge.objects.all(), key=key)]
+        return pks[::-1] if sort.startswith('-') else pks
+
+    def walk_pages(self, sort):
+        """Returns the pages from the first to the last one (following the
+        next links) and from the last to the first one (following the
+        previous links).
+        """
+        forward = list()
+        rows, pagination = self.get_page('?sort={}'.format(sort))
+        forward.append(rows)
+        while pagination['next_url']:
+            rows, pagination = self.get_page(pagination['next_url'])
+            forward.append(rows)
+        backward = [rows]
+        while pagination['previous_url']:
+            rows, pagination = self.get_page(pagination['previous_url'])
+            backward.append(rows)
+        return forward, backward[::-1]
+
+    def test_walk_pages(self):
+        for sort in ('', 'speed', '-speed', 'name', '-name'):
+            with self.subTest(sort=sort):
+                expected = self.get_expected_order(sort)
+                forward, backward = self.walk_pages(sort)
+                self.assertEquals(sum(forward, []), expected)
+                self.assertEquals(backward, forward)
+                self.assertTrue(all(len(page) == PER_PAGE
+                                    for page in forward[:-1]))
+
+    def test_count(self):
+        _, pagination = self.get_page('')
+        self.assertEquals(pagination['count'], len(SPEEDS))
+        self.assertFalse(pagination['approximate'])
+        self.assertIsNone(pagination['previous_url'])
+
+    def test_invalid_cursor(self):
+        # An invalid cursor shows the first page.
+        first_page, _ = self.get_page('?sort=speed')
+        rows, _ = self.get_page('?sort=speed&after=invalid')
+        self.assertEquals(rows, first_page)
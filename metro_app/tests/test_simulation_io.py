@@ -0,0 +1,63 @@
+import numpy as np
+from django.test import SimpleTestCase
+
+from metro_app.simulation_io import get_shard_od_pairs, sample_ttfs
+
+PIECEWISE = {'Piecewise': {'points': [
+    {'x': 0.0, 'y': 1.0},
+    {'x': 10.0, 'y': 2.0},
+    {'x': 20.0, 'y': 4.0},
+]}}
+CONSTANT = {'Constant': 7.0}
+# Before, on and between the points, and after the last point.
+BREAKPOINTS = np.array([-5.0, 0.0, 5.0, 10.0, 25.0])
+
+
+class TestSampleTtfs(SimpleTestCase):
+
+    def test_step_mode(self):
+        travel_times = sample_ttfs([PIECEWISE], BREAKPOINTS)
+        np.testing.assert_allclose(travel_times, [[1.0, 1.0, 1.0, 2.0, 4.0]])
+
+    def test_interpolate_mode(self):
+        travel_times = sample_ttfs([PIECEWISE], BREAKPOINTS, interpolate=True)
+        np.testing.assert_allclose(travel_times, [[1.0, 1.0, 1.5, 2.0, 4.0]])
+
+    def test_constant_function(self):
+        for interpolate in (False, True):
+            travel_times = sample_ttfs([CONSTANT], BREAKPOINTS, interpolate)
+            np.testing.assert_allclose(travel_times, [[7.0] * 5])
+
+    def test_several_functions(self):
+        # The points of a function must not be used for the next one.
+        travel_times = sample_ttfs([CONSTANT, PIECEWISE, CONSTANT],
+                                   BREAKPOINTS, interpolate=True)
+        np.testing.assert_allclose(travel_times, [
+            [7.0] * 5,
+            [1.0, 1.0, 1.5, 2.0, 4.0],
+            [7.0] * 5,
+        ])
+
+    def test_out_of_range_times(self):
+        breakpoints = np.array([-100.0, 1000.0])
+        for interpolate in (False, True):
+            travel_times = sample_ttfs([PIECEWISE], breakpoints, interpolate)
+            np.testing.assert_allclose(travel_times, [[1.0, 4.0]])
+
+
+class TestGetShardOdPairs(SimpleTestCase):
+
+    def test_shards_match_full_expansion(self):
+        # (origin, destination, size), with an empty pair.
+        od_pairs = np.array([[1, 2, 3], [3, 4, 0], [5, 6, 4], [7, 8, 2]])
+        origins = np.repeat(od_pairs[:, 0], od_pairs[:, 2])
+        destinations = np.repeat(od_pairs[:, 1], od_pairs[:, 2])
+        for shard_size in (1, 2, 3, 4, 9):
+            for start in range(0, 9, shard_size):
+                stop = min(start + shard_size, 9)
+                shard_origins, shard_destinations = get_shard_od_pairs(
+                    od_pairs, start, stop)
+                np.testing.assert_array_equal(shard_origins,
+                                              origins[start:stop])
+                np.testing.assert_array_equal(shard_destinations,
+                                              destinations[start:stop])
@@ -1,7 +1,10 @@
 from django.test import SimpleTestCase
 from django.urls import reverse, resolve
-from metro_app.views import index
+from metro_app.views import edge_tile, edge_tile_archive, index
 from metro_app.road_network.views import list_of_road_networks
+from metro_app.run.views import materialize_run_results
+from metro_app.uploads import upload_chunk
+from api.views import edge_attributes, edges_results_tile
 
 
 
@@ -14,3 +17,29 @@ class TestUrls(SimpleTestCase):
     def test_list_of_road_networks_url_resolve(self):
         url = reverse('list_of_road_networks', args = ['some-pk'])
         self.assertEquals(resolve(url).func, list_of_road_networks)
+
+    def test_materialize_run_results_url_resolve(self):
+        url = reverse('materialize_run_results', args = ['some-pk'])
+        self.assertEquals(resolve(url).func, materialize_run_results)
+
+    def test_upload_chunk_url_resolve(self):
+        url = reverse('upload_chunk',
+                      args = ['0f8fad5b-d9cb-469f-a165-70867728950e'])
+        self.assertEquals(resolve(url).func, upload_chunk)
+
+    def test_edge_tile_url_resolve(self):
+        url = reverse('edge_tile', args = ['some-pk', 3, 4, 2])
+        self.assertEquals(resolve(url).func, edge_tile)
+
+    def test_edge_tile_archive_url_resolve(self):
+        url = reverse('edge_tile_archive', args = ['some-pk'])
+        self.assertEquals(resolve(url).func, edge_tile_archive)
+
+    def test_edges_results_tile_url_resolve(self):
+        url = reverse('edges_results_tile',
+                      args = ['some-pk', 'speed', 12, 14, 8200, 5630])
+        self.assertEquals(resolve(url).func, edges_results_tile)
+
+    def test_edge_attributes_url_resolve(self):
+        url = reverse('edge_attributes', args = [3])
+        self.assertEquals(resolve(url).func, edge_attributes)
@@ -0,0 +1,397 @@
+"""
+Mapbox Vector Tiles of the edges of road networks.
+
+The tiles are generated by PostGIS (ST_AsMVT) from the Edge table, so that the
+map only loads the edges which are visible. The geometries are simplified
+depending on the zoom level (with a tolerance of one pixel of the tile) and,
+at low zoom levels, the edges shorter than one pixel are discarded and only
+the attributes used to draw the edges are kept. The other attributes are
+only added from DETAIL_ZOOM.
+
+The geometries are stored in the CRS of the road network (see
+RoadNetwork.srid), the tiles are in EPSG:3857.
+
+After the import of the edges, the tiles are pre-generated by a background
+task (see build_visualization) and stored in an MBTiles archive (a SQLite
+database) in the directory of the current version of the road network (see
+visualization_cache.py), so that the tiles requested by the map are read from
+the archive instead of being generated by PostGIS.
+"""
+import gzip
+import os
+import sqlite3
+
+import numpy as np
+from django.db import connection
+
+from .hooks import progress_reporter
+from .models import Edge, RoadType
+from .networks import make_network_visualization
+from .visualization_cache import evict_versions, get_version_directory
+
+# Size of a tile, in tile coordinates, and buffer around the tile.
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+MAX_ZOOM = 20
+# Zoom level from which all the edges and all their attributes are sent.
+DETAIL_ZOOM = 14
+# Name of the layer of the edges in the tiles.
+EDGE_LAYER = 'edges'
+DEFAULT_COLOR = '#808080'
+# Edges with more lanes are drawn as if they had MAX_LANES lanes.
+MAX_LANES = 5
+
+# Half of the circumference of the Earth in EPSG:3857, in meters.
+HALF_CIRCUMFERENCE = 20037508.342789244
+
+# Name of the tile archives in the directories of the versions.
+TILE_ARCHIVE = 'edges.mbtiles'
+# Zoom levels of the tile archives (the map scales the tiles of the maximum
+# zoom level for the higher zoom levels).
+ARCHIVE_MIN_ZOOM = 0
+ARCHIVE_MAX_ZOOM = 16
+
+EDGE_TILE_SQL = """
+WITH bounds AS (
+    SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom
+), edges AS (
+    SELECT
+        ST_Transform(ST_SetSRID(e.geometry, %(srid)s), 3857) AS geom,
+        e.*,
+        rt.color,
+        rt.default_lanes
+    FROM {edge} e
+    JOIN {road_type} rt ON rt.id = e.road_type_id, bounds
+    WHERE e.network_id = %(network)s
+        AND e.geometry && ST_SetSRID(ST_Transform(bounds.geom, %(srid)s),
+                                     %(column_srid)s)
+), features AS (
+    SELECT
+        ST_AsMVTGeom(
+            ST_Simplify(edges.geom, %(tolerance)s), bounds.geom,
+            %(extent)s, %(buffer)s
+        ) AS geom,
+        edges.edge_id,
+        COALESCE(edges.color, %(default_color)s) AS color,
+        LEAST(COALESCE(edges.lanes, edges.default_lanes, 1),
+              %(max_lanes)s) AS lanes,
+        NOT EXISTS (
+            SELECT 1 FROM {edge} r
+            WHERE r.source_id = edges.target_id
+                AND r.target_id = edges.source_id
+        ) AS oneway
+        {detail_columns}
+    FROM edges, bounds
+    WHERE %(detail)s OR ST_Length(edges.geom) >= %(tolerance)s
+)
+SELECT ST_AsMVT(features.*, %(layer)s, %(extent)s, 'geom')
+FROM features
+WHERE geom IS NOT NULL
+"""
+
+# Edges of a tile, with the same filters as EDGE_TILE_SQL.
+TILE_EDGES_SQL = """
+WITH bounds AS (
+    SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS geom
+)
+SELECT e.id, e.edge_id
+FROM {edge} e, bounds
+WHERE e.network_id = %(network)s
+    AND e.geometry && ST_SetSRID(ST_Transform(bounds.geom, %(srid)s),
+                                 %(column_srid)s)
+    AND (%(detail)s OR ST_Length(
+        ST_Transform(ST_SetSRID(e.geometry, %(srid)s), 3857)
+    ) >= %(tolerance)s)
+ORDER BY e.id
+"""
+
+# Tiles at zoom level DETAIL_ZOOM touched by the bounding boxes of the edges
+# (in EPSG:3857, the rows of tiles are numbered from the north).
+CANDIDATE_TILES_SQL = """
+WITH boxes AS (
+    SELECT Box2D(
+        ST_Transform(ST_SetSRID(e.geometry, %(srid)s), 3857)
+    ) AS box
+    FROM {edge} e
+    WHERE e.network_id = %(network)s
+), ranges AS (
+    SELECT
+        GREATEST(floor((ST_XMin(box) - %(margin)s + %(origin)s) / %(size)s),
+                 0)::integer AS min_x,
+        LEAST(floor((ST_XMax(box) + %(margin)s + %(origin)s) / %(size)s),
+              %(max_index)s)::integer AS max_x,
+        GREATEST(floor((%(origin)s - ST_YMax(box) - %(margin)s) / %(size)s),
+                 0)::integer AS min_y,
+        LEAST(floor((%(origin)s - ST_YMin(box) + %(margin)s) / %(size)s),
+              %(max_index)s)::integer AS max_y
+    FROM boxes
+)
+SELECT DISTINCT x, y
+FROM ranges,
+    generate_series(min_x, max_x) AS x,
+    generate_series(min_y, max_y) AS y
+"""
+
+DETAIL_COLUMNS = """,
+        edges.name,
+        edges.length,
+        edges.speed"""
+
+
+def get_tolerance(z):
+    """Returns the size of a pixel of a tile at zoom level z, in meters."""
+    return 2 * HALF_CIRCUMFERENCE / (2 ** z * TILE_EXTENT)
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def get_edge_tile(roadnetwork, z, x, y):
+    """Returns the Mapbox Vector Tile (z, x, y) of the edges of a road network
+    (which must not be abstract).
+
+    :returns: The content of the tile (empty if the tile has no edge).
+    :rtype: bytes
+    """
+    detail = z >= DETAIL_ZOOM
+    sql = EDGE_TILE_SQL.format(
+        edge=connection.ops.quote_name(Edge._meta.db_table),
+        road_type=connection.ops.quote_name(RoadType._meta.db_table),
+        detail_columns=DETAIL_COLUMNS if detail else '',
+    )
+    params = {
+        'z': z,
+        'x': x,
+        'y': y,
+        'srid': roadnetwork.srid,
+        'column_srid': Edge._meta.get_field('geometry').srid,
+        'network': roadnetwork.id,
+        'tolerance': get_tolerance(z),
+        'extent': TILE_EXTENT,
+        'buffer': TILE_BUFFER,
+        'default_color': DEFAULT_COLOR,
+        'max_lanes': MAX_LANES,
+        'detail': detail,
+        'layer': EDGE_LAYER,
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    return bytes(row[0]) if row and row[0] is not None else b''
+
+
+def get_tile_edges(roadnetwork, z, x, y):
+    """Returns the edges of a road network drawn in the tile (z, x, y) (see
+    get_edge_tile).
+
+    :returns: The primary keys and the user ids of the edges.
+    :rtype: tuple of numpy.ndarray
+    """
+    sql = TILE_EDGES_SQL.format(
+        edge=connection.ops.quote_name(Edge._meta.db_table))
+    params = {
+        'z': z,
+        'x': x,
+        'y': y,
+        'srid': roadnetwork.srid,
+        'column_srid': Edge._meta.get_field('geometry').srid,
+        'network': roadnetwork.id,
+        'tolerance': get_tolerance(z),
+        'detail': z >= DETAIL_ZOOM,
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    ids = np.array(rows, dtype=np.int64).reshape(len(rows), 2)
+    return ids[:, 0], ids[:, 1]
+
+
+def encode_feature_ids(edge_ids):
+    """Returns the user ids of edges as a little-endian binary array, to be
+    joined with the features of the tiles (whose id is the edge_id).
+
+    The ids are uint32 when they all fit, float64 otherwise (exact up to
+    2^53, like the numbers of JavaScript).
+
+    :returns: The content of the array and its type ('uint32' or 'float64').
+    :rtype: tuple
+    """
+    edge_ids = np.asarray(edge_ids, dtype=np.int64)
+    if not len(edge_ids) or (edge_ids.min() >= 0
+                             and edge_ids.max() <= np.iinfo(np.uint32).max):
+        return edge_ids.astype('<u4').tobytes(), 'uint32'
+    return edge_ids.astype('<f8').tobytes(), 'float64'
+
+
+def get_network_bounds(roadnetwork):
+    """Returns the bounds of the edges of a road network in EPSG:4326, as
+    [min_x, min_y, max_x, max_y] (None if the network has no edge).
+    """
+    sql = """
+        SELECT ST_XMin(b), ST_YMin(b), ST_XMax(b), ST_YMax(b)
+        FROM (
+            SELECT ST_Transform(
+                ST_SetSRID(ST_Extent(geometry)::geometry, %(srid)s), 4326
+            ) AS b
+            FROM {edge}
+            WHERE network_id = %(network)s
+        ) AS extent
+    """.format(edge=connection.ops.quote_name(Edge._meta.db_table))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {'srid': roadnetwork.srid,
+                             'network': roadnetwork.id})
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return list(row)
+
+
+def get_tile_archive_path(roadnetwork, version=None):
+    return os.path.join(
+        get_version_directory(roadnetwork, version), TILE_ARCHIVE)
+
+
+def get_candidate_tiles(roadnetwork):
+    """Returns the tiles (x, y) at zoom level DETAIL_ZOOM touched by the
+    bounding box of an edge of a road network, with a margin of TILE_BUFFER
+    pixels (the tiles with edges are among these tiles).
+    """
+    sql = CANDIDATE_TILES_SQL.format(
+        edge=connection.ops.quote_name(Edge._meta.db_table))
+    params = {
+        'srid': roadnetwork.srid,
+        'network': roadnetwork.id,
+        'origin': HALF_CIRCUMFERENCE,
+        'size': 2 * HALF_CIRCUMFERENCE / 2 ** DETAIL_ZOOM,
+        'margin': TILE_BUFFER * get_tolerance(DETAIL_ZOOM),
+        'max_index': 2 ** DETAIL_ZOOM - 1,
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def get_child_tiles(tiles, levels=1):
+    """Returns the tiles covering the tiles (x, y) at `levels` zoom levels
+    below.
+    """
+    n = 2 ** levels
+    return [
+        (n * x + i, n * y + j)
+        for x, y in tiles for i in range(n) for j in range(n)
+    ]
+
+
+def create_tile_archive(path, bounds, min_zoom, max_zoom):
+    """Creates an empty MBTiles archive and returns the connection to it."""
+    archive = sqlite3.connect(path)
+    archive.executescript("""
+        CREATE TABLE metadata (name TEXT, value TEXT);
+        CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER,
+                            tile_row INTEGER, tile_data BLOB);
+        CREATE UNIQUE INDEX tile_index
+            ON tiles (zoom_level, tile_column, tile_row);
+    """)
+    archive.executemany('INSERT INTO metadata VALUES (?, ?)', [
+        ('name', EDGE_LAYER),
+        ('format', 'pbf'),
+        ('minzoom', str(min_zoom)),
+        ('maxzoom', str(max_zoom)),
+        ('bounds', ','.join(str(value) for value in bounds)),
+    ])
+    return archive
+
+
+def write_tile_archive(roadnetwork, path, min_zoom=ARCHIVE_MIN_ZOOM,
+                       max_zoom=ARCHIVE_MAX_ZOOM, progress=None):
+    """Generates the tiles of the edges of a road network in an MBTiles
+    archive.
+
+    Only the tiles which can have edges are generated: up to DETAIL_ZOOM, the
+    parents of the tiles touched by the bounding box of an edge at
+    DETAIL_ZOOM (see get_candidate_tiles), which are found with a single
+    query (a parent without edges does not tell that its children have no
+    edge, as the short edges are discarded below DETAIL_ZOOM). From
+    DETAIL_ZOOM, the edges are never discarded so only the children of the
+    tiles with edges can have edges.
+
+    :returns: Number of tiles written.
+    :rtype: integer
+    """
+    bounds = get_network_bounds(roadnetwork)
+    candidates = get_candidate_tiles(roadnetwork)
+    archive = create_tile_archive(path, bounds, min_zoom, max_zoom)
+    count = 0
+    non_empty = list()
+    try:
+        for z in range(min_zoom, max_zoom + 1):
+            if z <= DETAIL_ZOOM:
+                shift = DETAIL_ZOOM - z
+                tiles = sorted({(x >> shift, y >> shift)
+                                for x, y in candidates})
+            elif z > min_zoom:
+                tiles = get_child_tiles(non_empty)
+            else:
+                tiles = get_child_tiles(candidates, z - DETAIL_ZOOM)
+            non_empty = list()
+            rows = list()
+            for x, y in tiles:
+                tile = get_edge_tile(roadnetwork, z, x, y)
+                if tile:
+                    non_empty.append((x, y))
+                    # MBTiles use the TMS scheme (y axis from the south).
+                    rows.append((z, x, 2 ** z - 1 - y, gzip.compress(tile)))
+            archive.executemany(
+                'INSERT INTO tiles VALUES (?, ?, ?, ?)', rows)
+            archive.commit()
+            count += len(rows)
+            if progress is not None:
+                progress('Generating map tiles', z + 1 - min_zoom,
+                         max_zoom + 1 - min_zoom)
+    finally:
+        archive.close()
+    return count
+
+
+def read_archive_tile(path, z, x, y):
+    """Returns a tile of an MBTiles archive (gzip-compressed), or None if the
+    archive has no such tile.
+    """
+    archive = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    try:
+        row = archive.execute(
+            'SELECT tile_data FROM tiles '
+            'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (z, x, 2 ** z - 1 - y)
+        ).fetchone()
+    finally:
+        archive.close()
+    return row[0] if row else None
+
+
+def build_visualization(roadnetwork):
+    """Pre-computes the visualization of a road network: the tile archive of
+    the geographic networks, the GeoJSON of the road polygons of the abstract
+    networks (see networks.make_network_visualization).
+    """
+    if roadnetwork.simple:
+        make_network_visualization(roadnetwork.id)
+        return 'Visualization successfully generated.'
+    # The archive is generated for the current version of the road network,
+    # read before the edges.
+    roadnetwork.refresh_from_db()
+    if not Edge.objects.filter(network=roadnetwork).exists():
+        return 'The road network has no edge.'
+    path = get_tile_archive_path(roadnetwork)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # The archive replaces the previous one only when it is complete.
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    count = write_tile_archive(
+        roadnetwork, tmp_path,
+        progress=progress_reporter(road_network=roadnetwork))
+    os.replace(tmp_path, path)
+    evict_versions(roadnetwork)
+    return 'Successfully generated {} map tiles.'.format(count)
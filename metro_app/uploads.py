@@ -0,0 +1,179 @@
+"""
+Resumable, multi-part uploads of import files.
+
+Large import files (nodes, edges, zones, OD pairs) are sent by the browser in
+parts (see static/js/chunked_upload.js):
+1. create_upload registers the upload (name and size of the file);
+2. each part is sent to upload_chunk with its offset in the file and its
+   SHA-256 checksum, and is appended to a staging file;
+3. after an interruption, upload_status returns the number of bytes received
+   so the upload can resume from there;
+4. the import form is submitted with the id of the completed upload and
+   save_request_file moves the staging file to MEDIA_ROOT, where the import
+   task reads it.
+
+The web server never holds more than one part of the file in memory.
+"""
+import hashlib
+import os
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from django.views.decorators.http import require_GET, require_POST
+
+from .models import FileUpload
+
+# Size of the parts sent by the browser, in bytes.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Size of the blocks read from the request and written to the staging file.
+BLOCK_SIZE = 64 * 1024
+# Uploads which have not been completed after this delay are deleted.
+UPLOAD_EXPIRATION = timedelta(days=1)
+
+
+def upload_json(upload):
+    return {
+        'id': str(upload.id),
+        'filename': upload.filename,
+        'size': upload.size,
+        'offset': upload.offset,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+    }
+
+
+def delete_upload(upload):
+    path = upload.get_staging_path()
+    if os.path.exists(path):
+        os.remove(path)
+    upload.delete()
+
+
+def delete_expired_uploads():
+    expired = FileUpload.objects.filter(
+        start_date__lt=timezone.now() - UPLOAD_EXPIRATION)
+    for upload in expired:
+        delete_upload(upload)
+
+
+@require_POST
+def create_upload(request):
+    """Registers a new upload, from the `filename` and `size` (in bytes)
+    fields of the request.
+    """
+    try:
+        size = int(request.POST['size'])
+        filename = get_valid_filename(
+            os.path.basename(request.POST['filename']))
+    except (KeyError, ValueError):
+        return JsonResponse(
+            {'error': 'The filename and size of the file are required.'},
+            status=400)
+    if size < 0 or not filename:
+        return JsonResponse({'error': 'Invalid file.'}, status=400)
+    delete_expired_uploads()
+    upload = FileUpload.objects.create(filename=filename[:255], size=size)
+    os.makedirs(os.path.dirname(upload.get_staging_path()), exist_ok=True)
+    open(upload.get_staging_path(), 'wb').close()
+    return JsonResponse(upload_json(upload), status=201)
+
+
+@require_GET
+def upload_status(request, pk):
+    """Returns the number of bytes received for an upload (used to resume an
+    interrupted upload).
+    """
+    upload = get_object_or_404(FileUpload, pk=pk)
+    return JsonResponse(upload_json(upload))
+
+
+@require_POST
+def upload_chunk(request, pk):
+    """Appends a part of the file to the staging file of an upload.
+
+    The body of the request is the raw content of the part. The offset of the
+    part in the file and its SHA-256 checksum (hexadecimal) are given in the
+    `X-Upload-Offset` and `X-Upload-Checksum` headers. A part whose offset is
+    not the number of bytes already received is rejected (status 409) and a
+    part whose checksum is invalid is discarded (status 400); in both cases,
+    the response gives the offset from which the upload must resume.
+    """
+    try:
+        offset = int(request.headers['X-Upload-Offset'])
+        checksum = request.headers['X-Upload-Checksum'].lower()
+    except (KeyError, ValueError):
+        return JsonResponse(
+            {'error': 'The offset and checksum of the part are required.'},
+            status=400)
+    with transaction.atomic():
+        # The row is locked so that two parts are never written at once.
+        upload = get_object_or_404(
+            FileUpload.objects.select_for_update(), pk=pk)
+        if offset != upload.offset:
+            data = upload_json(upload)
+            data['error'] = 'Invalid offset.'
+            return JsonResponse(data, status=409)
+        sha256 = hashlib.sha256()
+        with open(upload.get_staging_path(), 'r+b') as f:
+            f.seek(offset)
+            f.truncate()
+            size = offset
+            for block in iter(lambda: request.read(BLOCK_SIZE), b''):
+                size += len(block)
+                if size > upload.size:
+                    break
+                sha256.update(block)
+                f.write(block)
+            if size > upload.size or sha256.hexdigest() != checksum:
+                f.truncate(offset)
+                data = upload_json(upload)
+                data['error'] = (
+                    'The part exceeds the size of the file.'
+                    if size > upload.size else 'Invalid checksum.'
+                )
+                return JsonResponse(data, status=400)
+        upload.offset = size
+        upload.save()
+    return JsonResponse(upload_json(upload))
+
+
+def save_request_file(request):
+    """Saves the file of an import request in MEDIA_ROOT (the file path is
+    given to the import tasks, large files cannot be sent as arguments of
+    async tasks).
+
+    The file is either a completed multi-part upload, whose id is given in the
+    `upload_id` field, or a file sent with the form in the `my_file` field,
+    which is written on disk by chunks.
+
+    :returns: The path of the file, or None if the request has no valid file.
+    :rtype: str
+    """
+    upload_id = request.POST.get('upload_id')
+    if upload_id:
+        try:
+            upload = FileUpload.objects.get(pk=uuid.UUID(upload_id))
+        except (ValueError, FileUpload.DoesNotExist):
+            return None
+        if not upload.is_complete():
+            return None
+        filepath = os.path.join(
+            settings.MEDIA_ROOT, '{}-{}'.format(upload.id, upload.filename))
+        os.rename(upload.get_staging_path(), filepath)
+        upload.delete()
+        return filepath
+    datafile = request.FILES.get('my_file')
+    if datafile is None:
+        return None
+    filename = '{}-{}'.format(
+        uuid.uuid4(), get_valid_filename(os.path.basename(datafile.name)))
+    filepath = os.path.join(settings.MEDIA_ROOT, filename)
+    with open(filepath, 'wb') as f:
+        for chunk in datafile.chunks():
+            f.write(chunk)
+    return filepath
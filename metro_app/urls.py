@@ -2,7 +2,8 @@ from django.urls import path
 from .views import (create_project, delete_nodes, delete_edges, delete_roads_types,
                     delete_zones, project_details, update_project,
                     delete_project, index, visualization,
-                    edges_point_geojson, fetch_task,
+                    edges_point_geojson, fetch_task, edge_tile,
+                    edge_tile_archive,
                     )
 from metro_app.vehicle.views import (upload_vehicle, add_vehicle,
                                      update_vehicle, delete_vehicle,
@@ -47,9 +48,11 @@ from metro_app.parameters.views import (set_parameters, upload_parameters,
                                         list_of_parameters,)
 from metro_app.run.views import (create_run, update_run, run_details,
                                  delete_run, generate_run_input,
-                                 list_of_runs, start_run
+                                 list_of_runs, start_run,
+                                 materialize_run_results
                                  )
 from .networks import (upload_edge, upload_node)
+from .uploads import create_upload, upload_chunk, upload_status
 from .metrosim import upload_edges_results
 
 
@@ -89,11 +92,18 @@ urlpatterns = [
      path('roadnetwork/<str:pk>/details/', road_network_details, name='road_network_details'),
      path('roadnetwork/<str:pk>/upload_node/', upload_node, name='upload_node'),
      path('roadnetwork/<str:pk>/upload_edge/', upload_edge, name='upload_edge'),
+     path('upload/', create_upload, name='create_upload'),
+     path('upload/<uuid:pk>/', upload_status, name='upload_status'),
+     path('upload/<uuid:pk>/chunk/', upload_chunk, name='upload_chunk'),
      path('visualization/roadnetwork/<str:pk>/', visualization,
           name='network_visualization'),
      path('roadnetwork/<str:pk>/upload_road_type/', upload_road_type, name='upload_road_type'
           ),
      path('roadnetwork/<str:pk>/edges.geojson/', edges_point_geojson),
+     path('roadnetwork/<str:pk>/tiles/<int:z>/<int:x>/<int:y>.pbf',
+          edge_tile, name='edge_tile'),
+     path('roadnetwork/<str:pk>/edges.mbtiles', edge_tile_archive,
+          name='edge_tile_archive'),
      path('metrosim/roadnetwork/<str:pk>/upload_edges_results/',
           upload_edges_results),
      path('table/road_network/<str:pk>/edges/', edges_table, name='edges'),
@@ -185,6 +195,8 @@ urlpatterns = [
      path('run/<str:pk>/generate_run_input/', generate_run_input,
           name='generate_run_input'),
      path('run/<str:pk>/start_run/', start_run, name='start_run'),
+     path('run/<str:pk>/materialize_results/', materialize_run_results,
+          name='materialize_run_results'),
      path('table/population/<str:pk>/agent/', agent_table,
           name='agent_table'),
      path('table/network/<str:pk>/zone_node_relation/', zone_node_relation_table,
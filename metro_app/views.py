@@ -104,7 +104,9 @@ Django Views Modules
 """
 
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.http import (FileResponse, Http404, HttpResponse, JsonResponse,
+                         StreamingHttpResponse)
+from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth.models import User
 from django.template import loader
@@ -114,13 +116,19 @@ from .models import (Node, Edge, Project, RoadNetwork, RoadType, ZoneSet,
                      Zone, ODMatrix, ODPair, Vehicle, Preferences, Population,
                      Network, PopulationSegment, ParameterSet, Run,
                      BackgroundTask)
-from .networks import make_network_visualization, get_network_directory
+from .networks import is_visualization_running, start_visualization_task
+from .deletion import start_deletion_task
+from .tiles import (ARCHIVE_MAX_ZOOM, TILE_ARCHIVE, get_edge_tile,
+                    get_network_bounds, is_valid_tile, read_archive_tile)
+from .visualization_cache import (bump_network_version, get_artifact,
+                                  remove_network_directory)
 from .tables import (EdgeTable, NodeTable, RoadTypeTable, ZoneTable,
                      ODPairTable)
 from .filters import (EdgeFilter, NodeFilter, RoadTypeFilter, ZoneFilter,
                       ODPairFilter)
 
 import os
+import re
 from pyproj import CRS
 from pyproj.exceptions import CRSError
 from django_tables2 import RequestConfig
@@ -152,16 +160,11 @@ def delete_nodes(request, pk):
     roadnetwork = RoadNetwork.objects.get(id=pk)
     nodes = Node.objects.filter(network=roadnetwork)
     if request.method == 'POST':
-        nodes.delete()
-        # Let's also delete edges file inside visualization folder
-        try:
-            directory = get_network_directory(roadnetwork)
-            edges_file = os.path.join(directory, 'edges.geojson')
-            os.remove(edges_file)
-        except Exception:
-            pass
-
-        messages.success(request, 'Nodes successfully deleted!')
+        # The task increments the version of the network.
+        start_deletion_task(Node, {'network': roadnetwork.id},
+                            roadnetwork.project, 'Deleting nodes',
+                            road_network=roadnetwork)
+        messages.success(request, 'Node deletion started')
         return redirect('road_network_details', pk)
 
     context = {
@@ -174,16 +177,11 @@ def delete_edges(request, pk):
     roadnetwork = RoadNetwork.objects.get(id=pk)
     edges = Edge.objects.filter(network=roadnetwork)
     if request.method == 'POST':
-        edges.delete()
-        # Let's also delete edge file inside visualization folder
-        try:
-            directory = get_network_directory(roadnetwork)
-            edges_file = os.path.join(directory, 'edges.geojson')
-            os.remove(edges_file)
-        except Exception:
-            pass
-
-        messages.success(request, 'Edges sucessfully deleted!')
+        # The task increments the version of the network.
+        start_deletion_task(Edge, {'network': roadnetwork.id},
+                            roadnetwork.project, 'Deleting edges',
+                            road_network=roadnetwork)
+        messages.success(request, 'Edge deletion started')
         return redirect('road_network_details', pk)
 
     context = {
@@ -197,13 +195,8 @@ def delete_roads_types(request, pk):
     roads_types = RoadType.objects.filter(network=roadnetwork)
     if request.method == 'POST':
         roads_types.delete()
-        # Let's also delete edge file inside visualization folder
-        try:
-            directory = get_network_directory(roadnetwork)
-            edges_file = os.path.join(directory, 'edges.geojson')
-            os.remove(edges_file)
-        except Exception:
-            pass
+        # The visualization artifacts of the previous version are now stale.
+        bump_network_version(roadnetwork.id)
 
         messages.success(request, 'Roads types deleted!')
         return redirect('road_network_details', pk)
@@ -274,14 +267,12 @@ def update_project(request, pk):
 def delete_project(request, pk):
     project_to_delete = Project.objects.get(id=pk)
     if request.method == 'POST':
+        roadnetworks = list(
+            RoadNetwork.objects.filter(project=project_to_delete))
         project_to_delete.delete()
-        # Let's also delete edge file inside visualization folder
-        try:
-            directory = get_network_directory(roadnetwork)
-            edges_file = os.path.join(directory, 'edges.geojson')
-            os.remove(edges_file)
-        except Exception:
-            pass
+        # Let's also delete the visualization folders of the road networks.
+        for roadnetwork in roadnetworks:
+            remove_network_directory(roadnetwork)
 
         return redirect('home')
 
@@ -350,10 +341,39 @@ def visualization(request, pk):
         messages.warning(request, "Edges are not uploaded !")
         return redirect('road_network_details', roadnetwork.pk)
 
-    directory = get_network_directory(roadnetwork)
-    data_full_path = os.path.join(directory, "edges.geojson")
-    if not os.path.exists(data_full_path):
-        make_network_visualization(pk)
+    if not roadnetwork.simple:
+        # The edges are loaded by the map as vector tiles. The tile archive
+        # of the current version is generated if needed, the tiles of the
+        # previous version (or the tiles generated by PostGIS) are served
+        # meanwhile.
+        _, version = get_artifact(roadnetwork, TILE_ARCHIVE)
+        if (version != roadnetwork.version
+                and not is_visualization_running(roadnetwork)):
+            start_visualization_task(roadnetwork)
+        # The version in the URL prevents the browser from using the tiles
+        # of a previous version from its cache.
+        tile_url = reverse('edge_tile', args=[roadnetwork.pk, 0, 0, 0])
+        tile_url = request.build_absolute_uri(
+            tile_url[:-len('0/0/0.pbf')]) + '{{z}}/{{x}}/{{y}}.pbf?v={}'.format(
+                roadnetwork.version)
+        context = {"roadnetwork": roadnetwork,
+                   "tile_url": tile_url,
+                   "total_bounds": json.dumps(get_network_bounds(roadnetwork)),
+                   }
+        return render(request, 'index-visualization.html', context)
+
+    data_full_path, version = get_artifact(roadnetwork, "edges.geojson")
+    if version != roadnetwork.version:
+        # The visualization is generated in the background, not in the
+        # request.
+        if not is_visualization_running(roadnetwork):
+            start_visualization_task(roadnetwork)
+        if data_full_path is None:
+            messages.info(request, "The visualization is being generated, "
+                                   "please retry in a few moments.")
+            return redirect('road_network_details', roadnetwork.pk)
+        # The previous version is shown while the visualization is updated.
+        messages.info(request, "The visualization is being updated.")
     with open(data_full_path, "r") as f:
         file_js = json.load(f)
 
@@ -362,6 +382,86 @@ def visualization(request, pk):
                }
     return render(request, 'index-visualization.html', context)
 
+
+def edge_tile(request, pk, z, x, y):
+    """Returns a Mapbox Vector Tile of the edges of a road network (see
+    tiles.py)."""
+    roadnetwork = get_object_or_404(RoadNetwork, pk=pk)
+    if roadnetwork.simple or not is_valid_tile(z, x, y):
+        raise Http404
+    archive_path, version = get_artifact(roadnetwork, TILE_ARCHIVE)
+    if z <= ARCHIVE_MAX_ZOOM and archive_path is not None:
+        # Pre-generated tile (the tiles without edges are not stored).
+        tile = read_archive_tile(archive_path, z, x, y) or b''
+        response = HttpResponse(
+            tile, content_type='application/vnd.mapbox-vector-tile')
+        if tile:
+            response['Content-Encoding'] = 'gzip'
+    else:
+        version = roadnetwork.version
+        tile = get_edge_tile(roadnetwork, z, x, y)
+        response = HttpResponse(
+            tile, content_type='application/vnd.mapbox-vector-tile')
+    if version == roadnetwork.version:
+        response['Cache-Control'] = 'max-age=3600'
+    else:
+        # Stale tile, served while the tiles are generated.
+        response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def range_file_response(request, path, content_type):
+    """Returns a response with the content of a file, or with the byte range
+    of the file requested in the Range header of the request."""
+    size = os.path.getsize(path)
+    match = re.match(r'^bytes=(\d*)-(\d*)$',
+                     request.headers.get('Range', '').strip())
+    if match is None or match.groups() == ('', ''):
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['Accept-Ranges'] = 'bytes'
+        return response
+    start, end = match.groups()
+    if start:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    else:
+        # Last bytes of the file.
+        start = max(size - int(end), 0)
+        end = size - 1
+    if start > end:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+
+    def iter_range(block_size=64 * 1024):
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = f.read(min(block_size, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+
+    response = StreamingHttpResponse(
+        iter_range(), status=206, content_type=content_type)
+    response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def edge_tile_archive(request, pk):
+    """Returns the MBTiles archive of the tiles of the edges of a road
+    network, with support of HTTP range requests."""
+    roadnetwork = get_object_or_404(RoadNetwork, pk=pk)
+    archive_path, _ = get_artifact(roadnetwork, TILE_ARCHIVE)
+    if archive_path is None:
+        raise Http404
+    return range_file_response(
+        request, archive_path, 'application/vnd.sqlite3')
+
 # ........................................................................... #
 #             VIEW OF RETURNIGNG EDGES GeoJSON FILE                           #
 # ............................................................................#
@@ -372,8 +472,9 @@ def edges_point_geojson(request, pk):
     able to us it as a javascript variable and map it
     """
     roadnetwork = RoadNetwork.objects.get(id=pk)
-    directory = get_network_directory(roadnetwork)
-    filename = os.path.join(directory, "edges.geojson")
+    filename, _ = get_artifact(roadnetwork, "edges.geojson")
+    if filename is None:
+        raise Http404
     with open(filename) as edges:
         # edges = json.load(edges)
         # edges=json.dumps(edges)
@@ -0,0 +1,97 @@
+"""
+Versioned cache of the visualization artifacts of road networks.
+
+Each road network has a content version (RoadNetwork.version), incremented
+whenever its nodes, edges or road types are modified (see signals.py and
+bump_network_version). The artifacts of the visualization (GeoJSON of the
+abstract networks, tile archive of the geographic networks) are stored in one
+directory per version:
+
+    visualization/<road network id>/v<version>/
+
+so that an artifact is never overwritten while it is read. When the artifacts
+of the current version do not exist yet, the views serve the artifacts of the
+most recent previous version while they are generated (stale-while-rebuilding).
+Only the KEPT_VERSIONS most recent versions are kept on disk.
+"""
+import os
+import re
+import shutil
+
+from django.conf import settings
+from django.db.models import F
+
+from .models import RoadNetwork
+
+# Number of versions of the artifacts kept on disk.
+KEPT_VERSIONS = 3
+
+VERSION_DIRECTORY = re.compile(r'^v(\d+)$')
+
+
+def get_network_directory(roadnetwork):
+    return os.path.join(
+        settings.BASE_DIR, 'visualization', str(roadnetwork.id))
+
+
+def get_version_directory(roadnetwork, version=None):
+    """Returns the directory of the artifacts of a version of a road network
+    (by default, the current version).
+    """
+    if version is None:
+        version = roadnetwork.version
+    return os.path.join(
+        get_network_directory(roadnetwork), 'v{}'.format(version))
+
+
+def bump_network_version(network_id):
+    """Increments the version of a road network, so that the artifacts of the
+    previous versions are considered stale.
+    """
+    RoadNetwork.objects.filter(pk=network_id).update(
+        version=F('version') + 1)
+
+
+def get_versions(roadnetwork):
+    """Returns the versions with a directory on disk, most recent first."""
+    directory = get_network_directory(roadnetwork)
+    if not os.path.isdir(directory):
+        return list()
+    versions = list()
+    for name in os.listdir(directory):
+        match = VERSION_DIRECTORY.match(name)
+        if match is not None:
+            versions.append(int(match.group(1)))
+    return sorted(versions, reverse=True)
+
+
+def get_artifact(roadnetwork, filename):
+    """Returns the most recent version of an artifact of a road network.
+
+    :returns: The path of the artifact and its version (the artifact is stale
+       if it is not the current version of the road network), or (None, None)
+       if no version of the artifact exists.
+    :rtype: tuple
+    """
+    for version in get_versions(roadnetwork):
+        if version > roadnetwork.version:
+            continue
+        path = os.path.join(
+            get_version_directory(roadnetwork, version), filename)
+        if os.path.exists(path):
+            return path, version
+    return None, None
+
+
+def evict_versions(roadnetwork, keep=KEPT_VERSIONS):
+    """Removes the artifacts of the versions of a road network older than the
+    `keep` most recent versions.
+    """
+    for version in get_versions(roadnetwork)[keep:]:
+        shutil.rmtree(get_version_directory(roadnetwork, version),
+                      ignore_errors=True)
+
+
+def remove_network_directory(roadnetwork):
+    """Removes all the artifacts of a road network."""
+    shutil.rmtree(get_network_directory(roadnetwork), ignore_errors=True)
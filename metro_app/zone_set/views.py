@@ -1,24 +1,28 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.contrib.gis.geos import GEOSGeometry, Polygon, fromstr
-from shapely import geometry as geom
+from django.contrib.gis.geos import Polygon, fromstr
 from django.contrib import messages
-from django.conf import settings
 from metro_app.models import (Zone, ZoneSet, Project, BackgroundTask,)
 from metro_app.forms import ZoneFileForm, ZoneSetForm
 from metro_app.filters import ZoneFilter
 from metro_app.tables import ZoneTable
-from django_tables2 import RequestConfig
-from metro_app.hooks import str_hook
+from metro_app.pagination import paginate_table
+from metro_app.bulk import (bulk_load_columns, geometries_to_ewkb,
+                            points_to_ewkb)
+from metro_app.deletion import delete_in_chunks
+from metro_app.hooks import progress_reporter, str_hook
+from metro_app.networks import (format_ids, get_point_coordinates, record,
+                                to_numeric)
+from metro_app.readers import count_features, iter_chunks
+from metro_app.uploads import save_request_file
 from django_q.tasks import async_task
-import uuid
-import os
+import itertools
 import numpy as np
-import pandas as pd
-import geopandas as gpd
 from pyproj import CRS
 from pyproj.exceptions import CRSError
 import json
 
+ZONE_KEYS = ('id', 'x', 'y', 'radius', 'name')
+
 
 def list_of_zonesets(request, pk):
     current_project = Project.objects.get(id=pk)
@@ -102,123 +106,148 @@ def delete_zoneset(request, pk):
     }
     return render(request, 'delete.html', context)
 
-def async_task_for_zone_set_file(zoneset, filepath):
-    dtype = {'id': int, 'x': float, 'y': float}
-    # Read file with GeoPandas.
-    try:
-        gdf = gpd.read_file(filepath, dtype=dtype)
-        gdf['id'] = gdf['id'].astype(int)
-    except Exception as e:
-        try:
-            df = pd.read_csv(filepath, dtype=dtype)
-            df['geometry'] = None
-            gdf = gpd.GeoDataFrame(df)
-            del df
-        except Exception as e1:
-            return 'Cannot read file.\n\nError message:\n{}'.format(e1)
+class ZoneChunkImporter:
+    """Converts chunks of a zone import file to the columns of the Zone
+    table.
 
-    # Check that column id is here.
-    if not 'id' in gdf.columns:
-        return (
-            'Cannot import file.\n\nError message:\nThe following field '
-            'is mandatory: id'
-        )
+    The zones are Points (circles with a radius) or Polygons; the features
+    without geometry are Points at their x and y coordinates. The invalid rows
+    are discarded and recorded, to be reported at the end of the import.
+    """
 
-    if len(gdf) and gdf.geom_type.isnull().all():
-        # The edges have no geometry (the file is probably as CSV).
-        # We create the geometries from the x and y coordinates.
-        if not 'x' in gdf.columns or not 'y' in gdf.columns:
-            return (
-                'Cannot import file.\n\nError message:\nThe following fields'
-                ' are mandatory: x, y'
-            )
-        try:
-            gdf['geometry'] = gdf.apply(
-                lambda row: geom.Point(
-                    [float(row['x']), float(row['y'])])
-                , axis=1)
-        except ValueError:
-            return (
-                'Cannot import file.\n\nError message:\nInvalid values in '
-                'column x or y'
-            )
+    def __init__(self, zoneset):
+        self.zoneset = zoneset
+        self.centroid_srid = Zone._meta.get_field('centroid').srid
+        self.geometry_srid = Zone._meta.get_field('geometry').srid
+        self.imported_ids = set()
+        self.duplicate_ids = set()
+        self.nb_invalid_ids = 0
+        self.nb_invalid_geometries = 0
 
-    message = ''
-    invalids = ~gdf.geom_type.isin(('Point', 'Polygon'))
-    if invalids.any():
-        #  The any() function is used to check whether any element is True, potentially over an axis
-        # Returns False unless there at least one element within a series or along a Dataframe axis 
-        # that is True or equivalent (e.g. non-zero or non-empty).
-        message += (
-            'Discarding {} invalid geometries (only Points and Polygons are '
-            'allowed).\n'
-        ).format(invalids.sum())
-        gdf = gdf.loc[~invalids]
+    def prepare(self, gdf):
+        """Returns the columns of the valid zones of a chunk (as expected by
+        bulk_load_columns) and the number of zones.
+        """
+        gdf = gdf.reset_index(drop=True)
+        gdf['id'] = to_numeric(gdf['id'])
+        invalids = gdf['id'].isnull()
+        self.nb_invalid_ids += invalids.sum()
 
-    if not len(gdf):
-        message += 'No valid node to import.\n'
-        return message
+        # The centroids of the Points are their coordinates.
+        x, y = get_point_coordinates(gdf)
+        polygons = (gdf.geom_type == 'Polygon').to_numpy()
+        if polygons.any():
+            centroids = gdf.geometry[polygons].centroid
+            x[polygons] = centroids.x
+            y[polygons] = centroids.y
+        invalid_geometries = ~invalids & (x.isnull() | y.isnull())
+        self.nb_invalid_geometries += invalid_geometries.sum()
+        invalids |= invalid_geometries
 
-    if gdf['id'].nunique() != len(gdf):
-        counts = gdf['id'].value_counts()
-        duplicates = counts.loc[counts > 1].index.astype(str)
-        message += (
-            'Duplicate ids (only the last one is imported): {}\n'
-        ).format(', '.join(duplicates))
-        gdf = gdf.groupby('id').last()
-    else:
-        gdf.set_index('id', inplace=True)
+        # The zones with an id already imported (in this chunk or in a
+        # previous one) are discarded.
+        ids = gdf['id'].where(~invalids)
+        duplicates = ~invalids & (
+            ids.duplicated(keep='first') | ids.isin(self.imported_ids))
+        record(self.duplicate_ids, gdf.loc[duplicates, 'id'])
+        invalids |= duplicates
 
-    gdf['is_polygon'] = gdf.geom_type == 'Polygon'
+        valids = ~invalids.to_numpy()
+        if not valids.any():
+            return dict(), 0
+        gdf = gdf.loc[valids]
+        ids = gdf['id'].to_numpy(dtype=np.int64)
+        self.imported_ids.update(ids.tolist())
+        polygons = polygons[valids]
+        geometry = np.full(len(ids), None, dtype=object)
+        geometry[polygons] = geometries_to_ewkb(
+            gdf.geometry[polygons].to_numpy(), self.geometry_srid)
+        columns = {
+            'zone_id': ids,
+            'zone_set': self.zoneset.id,
+            'centroid': points_to_ewkb(
+                x.to_numpy()[valids], y.to_numpy()[valids],
+                self.centroid_srid),
+            'geometry': geometry,
+            'radius': (
+                to_numeric(gdf['radius']).to_numpy(dtype=np.float64)
+                if 'radius' in gdf.columns else 0.0),
+            'name': (
+                gdf['name'].to_numpy(dtype=object)
+                if 'name' in gdf.columns else ''),
+        }
+        return columns, len(ids)
 
-    gdf['gis-geometry'] = gdf['geometry'].apply(lambda g: GEOSGeometry(str(g)))
-    gdf['centroid'] = gdf.geometry.centroid
-    gdf['gis-centroid'] = gdf['centroid'].apply(lambda g: GEOSGeometry(str(g)))
-    
-    zones_to_import = list()
-    invalid_zones = list()
+    def get_message(self):
+        message = ''
+        if self.nb_invalid_ids:
+            message += 'Discarding {} zones with an invalid id.\n'.format(
+                self.nb_invalid_ids)
+        if self.nb_invalid_geometries:
+            message += (
+                'Discarding {} invalid geometries (only Points and Polygons '
+                'are allowed).\n'
+            ).format(self.nb_invalid_geometries)
+        if self.duplicate_ids:
+            message += (
+                'Duplicate ids (only the first one is imported): {}\n'
+            ).format(format_ids(self.duplicate_ids))
+        return message
 
-    def handle_nan(value):
-        if value and np.isnan(value):
-            return None
-        else:
-            return value
-    print(gdf)
-    for zone_id, row in gdf.iterrows():
-        try:
-            zone = Zone(
-                zone_id=zone_id,
-                zone_set=zoneset,
-                centroid=row['gis-centroid'],
-                geometry=row['gis-geometry'] if row['is_polygon'] else None,
-                radius=row.get('radius', 0.00),
-                name=row.get('name', ''),
-            )
-        except Exception as e:
-            invalid_zones.append(str(zone_id))
-        else:
-            zones_to_import.append(zone)
-            
-    if invalid_zones:
-        message += (
-            'The following zones could not be imported correctly: {}\n'
-        ).format(', '.join(invalid_zones))
 
-    if not zones_to_import:
-        message += 'No zone were imported.\n'
-        return message
+def async_task_for_zone_set_file(zoneset, filepath):
+    """Imports the zones of a zone set from a CSV, GeoParquet, FlatGeobuf,
+    GeoPackage or GeoJSON file, by chunks (see ZoneChunkImporter).
+    """
+    report = progress_reporter(zoneset_set=zoneset)
+    total = count_features(filepath)
+    # Read only the columns used, whatever the format of the file (the
+    # coordinates are converted to the CRS of the zone set).
+    try:
+        chunks = iter_chunks(filepath, ZONE_KEYS, srid=zoneset.srid)
+        first_chunk = next(chunks, None)
+    except Exception as e:
+        return 'Cannot read file.\n\nError message:\n{}'.format(e)
+    if first_chunk is None:
+        return 'No zone were imported.\n'
+
+    # Check that column id is here.
+    if not 'id' in first_chunk.columns:
+        return (
+            'Cannot import file.\n\nError message:\nThe following field '
+            'is mandatory: id'
+        )
+    if (first_chunk.geom_type.isnull().all()
+            and not ('x' in first_chunk.columns
+                     and 'y' in first_chunk.columns)):
+        # The zones have no geometry (the file is probably a CSV), the
+        # geometries are created from the x and y coordinates.
+        return (
+            'Cannot import file.\n\nError message:\nThe following fields'
+            ' are mandatory: x, y'
+        )
 
-    # Create the zones in bulk.
+    importer = ZoneChunkImporter(zoneset)
+    nb_read = 0
+    count = 0
     try:
-        Zone.objects.bulk_create(zones_to_import)
+        for gdf in itertools.chain([first_chunk], chunks):
+            nb_read += len(gdf)
+            columns, size = importer.prepare(gdf)
+            if size:
+                count += bulk_load_columns(Zone, columns, size)
+            report('Importing zones', nb_read, total)
     except Exception as e:
-        message += (
+        delete_in_chunks(Zone.objects.filter(zone_set=zoneset), report)
+        return importer.get_message() + (
             'Failed to import zones.\n\nError message:\n{}'
         ).format(e)
-        return message
 
-    message += 'Successfully imported {} zones.'.format(
-        len(zones_to_import))
+    message = importer.get_message()
+    if not count:
+        message += 'No zone were imported.\n'
+        return message
+    message += 'Successfully imported {} zones.'.format(count)
     return message
 
 def upload_zone(request, pk):
@@ -235,18 +264,11 @@ def upload_zone(request, pk):
         return redirect('zoneset_details', pk)
 
     if request.method == 'POST':
-        # File must be included when creating the form
-        form = ZoneFileForm(request.POST, request.FILES)
-        if form.is_valid():
-            # Getting data from the fielfield input
-            datafile = request.FILES['my_file']
-
-            # Save file on disk (we cannot send large files as arguments of
-            # async tasks).
-            filename = '{}-{}'.format(uuid.uuid4(), datafile.name)
-            filepath = os.path.join(settings.MEDIA_ROOT, filename)
-            with open(filepath, 'wb') as f:
-                f.write(datafile.read())
+        # The file is either sent with the form or uploaded in parts
+        # beforehand (see uploads.py); it is saved on disk because large files
+        # cannot be sent as arguments of async tasks.
+        filepath = save_request_file(request)
+        if filepath is not None:
             task_id = async_task(async_task_for_zone_set_file, zoneset,
                                  filepath, hook=str_hook)
             description = "Importing zones"
@@ -275,9 +297,7 @@ def zones_table(request, pk):
     zoneset = ZoneSet.objects.get(id=pk)
     zones = Zone.objects.select_related().filter(zone_set=zoneset)
     filter = ZoneFilter(request.GET, queryset=zones)
-    table = ZoneTable(filter.qs)
-    RequestConfig(request).configure(table)  # For sorting table column
-    # table.paginate(page=request.GET.get("page", 1), per_page=15)
+    table, pagination = paginate_table(request, ZoneTable, filter.qs)
 
     current_path = request.get_full_path()
     network_attribute = current_path.split("/")[4]
@@ -285,6 +305,7 @@ def zones_table(request, pk):
     context = {
         "table": table,
         "filter": filter,
+        "pagination": pagination,
         'zoneset': zoneset,
         "network_attribute": network_attribute
     }
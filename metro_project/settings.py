@@ -204,6 +204,10 @@ MESSAGE_LEVEL = message_constants.DEBUG
 # MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
 MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
 CRISPY_TEMPLATE_PACK = "bootstrap4"
+
+# Store the edge results and the agent paths of the runs as NumPy arrays in the
+# output directory instead of the database (see metro_app.result_store).
+COLUMNAR_RESULTS = settings.get('columnar_results', False)
 # DJANGO_TABLES2_PAGE_RANGE = 10
 
 redis_settings = settings.get('redis', dict())
@@ -0,0 +1,123 @@
+/*---------------------------------------------------*/
+/* ------------- Resumable multi-part upload --------*/
+/*---------------------------------------------------*/
+
+// The file of the import forms with a data-upload-url attribute is sent in
+// parts (with the SHA-256 checksum of each part), then the form is submitted
+// with the id of the upload instead of the file (see metro_app/uploads.py).
+// If the upload is interrupted, submitting the same file again resumes it
+// from the last part received.
+
+const MAX_RETRIES = 5;
+
+function uploadKey(file) {
+  return `upload:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+function toHex(buffer) {
+  return Array.from(new Uint8Array(buffer))
+    .map((b) => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function startUpload(form, file, csrfToken) {
+  const uploadUrl = form.dataset.uploadUrl;
+  const uploadId = localStorage.getItem(uploadKey(file));
+  if (uploadId) {
+    const response = await fetch(`${uploadUrl}${uploadId}/`);
+    if (response.ok) {
+      return response.json();
+    }
+  }
+  const data = new FormData();
+  data.append('filename', file.name);
+  data.append('size', file.size);
+  const response = await fetch(uploadUrl, {
+    method: 'POST', body: data, headers: {'X-CSRFToken': csrfToken},
+  });
+  if (!response.ok) {
+    throw new Error((await response.json()).error);
+  }
+  const upload = await response.json();
+  localStorage.setItem(uploadKey(file), upload.id);
+  return upload;
+}
+
+async function sendChunk(form, upload, file, csrfToken) {
+  const chunk = file.slice(upload.offset, upload.offset + upload.chunk_size);
+  const content = await chunk.arrayBuffer();
+  const checksum = toHex(await crypto.subtle.digest('SHA-256', content));
+  const response = await fetch(
+    `${form.dataset.uploadUrl}${upload.id}/chunk/`, {
+      method: 'POST',
+      body: content,
+      headers: {
+        'X-CSRFToken': csrfToken,
+        'X-Upload-Offset': upload.offset,
+        'X-Upload-Checksum': checksum,
+      },
+    });
+  // The response always contains the offset from which the upload resumes.
+  return [response.ok, await response.json()];
+}
+
+function showProgress(upload) {
+  const percent = upload.size ? 100 * upload.offset / upload.size : 100;
+  $('#progressBar').show().css({'margin-left': 0, 'margin-right': 0,
+                                'width': `${percent}%`});
+}
+
+async function uploadFile(form, file, csrfToken) {
+  let upload = await startUpload(form, file, csrfToken);
+  let retries = 0;
+  while (upload.offset < upload.size) {
+    showProgress(upload);
+    let ok, data;
+    try {
+      [ok, data] = await sendChunk(form, upload, file, csrfToken);
+    } catch (error) {
+      ok = false;
+      data = null;
+    }
+    if (ok) {
+      upload = data;
+      retries = 0;
+      continue;
+    }
+    if (++retries > MAX_RETRIES) {
+      throw new Error(data && data.error || 'The upload was interrupted.');
+    }
+    if (data && data.offset !== undefined) {
+      upload = data;
+    }
+    await new Promise((resolve) => setTimeout(resolve, 1000 * retries));
+  }
+  showProgress(upload);
+  localStorage.removeItem(uploadKey(file));
+  return upload;
+}
+
+$(document).ready(function() {
+  if (!window.crypto || !crypto.subtle) {
+    // The checksums cannot be computed: the file is sent with the form.
+    return;
+  }
+  $('form[data-upload-url]').on('submit', async function(event) {
+    const form = this;
+    const fileInput = form.querySelector('input[type="file"]');
+    if (!fileInput || !fileInput.files.length) {
+      return;
+    }
+    event.preventDefault();
+    const csrfToken = form.querySelector(
+      'input[name="csrfmiddlewaretoken"]').value;
+    try {
+      const upload = await uploadFile(form, fileInput.files[0], csrfToken);
+      form.querySelector('input[name="upload_id"]').value = upload.id;
+      // The file has been uploaded, it is not sent again with the form.
+      fileInput.value = '';
+      form.submit();
+    } catch (error) {
+      alert(`Upload failed: ${error.message}`);
+    }
+  });
+});
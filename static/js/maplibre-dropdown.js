@@ -23,17 +23,6 @@
       "11:00", "11:15", "11:30", "11:45",
       "12:00"]
   
-  async function GetFieldAttribute(field) {
-    // Get url of the current network
-    const current_url = window.location.href // document.url
-    const network_id = parseInt(current_url.split('/')[5]) // Get network id
-  
-    let get_field_request = await fetch(
-      `${window.location.protocol}//${window.location.host}/api/network/${network_id}/edges/${field}`);
-    let get_field_dictionary = await get_field_request.json();
-    return get_field_dictionary
-  }
-  
   async function GetOutputFieldAttribute(field) {
     const current_url = window.location.href // document.url
     //const network_id = parseInt(current_url.split('/')[5]) // Get network id
@@ -45,6 +34,170 @@
     return get_field_dictionary
   }
   
+  // Type of the array of edge ids of a binary response of the api.
+  function idArrayType(response) {
+    return response.headers.get('X-Edge-Id-Type') === 'float64' ?
+      Float64Array : Uint32Array;
+  }
+
+  // Input fields of the edges, loaded at once as binary arrays (see
+  // api.views.edge_attributes).
+  const INPUT_FIELDS = ['lanes', 'length', 'speed'];
+  var edgeAttributes = null;
+
+  async function getEdgeAttributes() {
+    if (edgeAttributes === null) {
+      const network_id = parseInt(window.location.href.split('/')[5])
+      const response = await fetch(
+        `${window.location.protocol}//${window.location.host}/api/network/${network_id}/edges/attributes/?fields=${INPUT_FIELDS.join(',')}`);
+      // Edge ids followed by one float32 array per field.
+      const buffer = await response.arrayBuffer();
+      const n = Number(response.headers.get('X-Edge-Count'));
+      const IdArray = idArrayType(response);
+      let offset = IdArray.BYTES_PER_ELEMENT * n;
+      edgeAttributes = {edge_id: new IdArray(buffer, 0, n)};
+      for (const field of response.headers.get('X-Edge-Fields').split(',')) {
+        edgeAttributes[field] = new Float32Array(buffer, offset, n);
+        offset += 4 * n;
+      }
+    }
+    return edgeAttributes;
+  }
+
+  // Values of the input fields of the edges already loaded from the api.
+  var edgeValues = {};
+
+  async function getEdgeValues(field) {
+    if (!(field in edgeValues)) {
+      const attributes = await getEdgeAttributes();
+      const values = {};
+      attributes.edge_id.forEach((edge_id, i) => {
+        values[edge_id] = attributes[field][i];
+      });
+      edgeValues[field] = values;
+      // Adding the values from the api to the map data.
+      setEdgeValues(field, edgeValues[field]);
+    }
+    return edgeValues[field];
+  }
+
+  /* With vector tiles, the results of the run are loaded tile by tile, for
+    the current interval only (see metro_app/result_tiles.py). */
+  const run_id = new URLSearchParams(window.location.search).get('run') || 1;
+  // Field of the results and range of the color scale of each output.
+  const OUTPUT_FIELDS = {
+    speed_output: 'speed',
+    congestion: 'congestion',
+    travel_time: 'travel_time',
+  };
+  const OUTPUT_RANGES = {
+    speed_output: [0, 130],
+    congestion: [0, 1],
+    travel_time: [0, 2000],
+  };
+  // Animation of the results (output field, index of the current interval,
+  // times of the intervals in seconds).
+  var results = {field: null, interval: 0, intervals: [], timer: null};
+
+  async function getIntervals() {
+    if (!results.intervals.length) {
+      const response = await fetch(
+        `${window.location.protocol}//${window.location.host}/api/run/${run_id}/edges_results/intervals/`);
+      results.intervals = (await response.json()).intervals;
+    }
+    return results.intervals;
+  }
+
+  function formatTime(seconds) {
+    const hours = Math.floor(seconds / 3600);
+    const minutes = Math.floor(seconds % 3600 / 60);
+    return `${hours}:${String(minutes).padStart(2, '0')}`;
+  }
+
+  // Returns the tiles [z, x, y] covering the visible part of the map.
+  function visibleTiles() {
+    const z = Math.max(0, Math.min(16, Math.floor(map.getZoom())));
+    const n = 2 ** z;
+    const clamp = (value) => Math.max(0, Math.min(n - 1, Math.floor(value)));
+    const tileX = (lon) => clamp((lon + 180) / 360 * n);
+    const tileY = (lat) => {
+      const rad = Math.max(-85.0511, Math.min(85.0511, lat)) * Math.PI / 180;
+      return clamp((1 - Math.asinh(Math.tan(rad)) / Math.PI) / 2 * n);
+    };
+    const bounds = map.getBounds();
+    const tiles = [];
+    for (let x = tileX(bounds.getWest()); x <= tileX(bounds.getEast()); x++) {
+      for (let y = tileY(bounds.getNorth()); y <= tileY(bounds.getSouth()); y++) {
+        tiles.push([z, x, y]);
+      }
+    }
+    return tiles;
+  }
+
+  async function loadResultTile(field, interval, [z, x, y]) {
+    const response = await fetch(
+      `${window.location.protocol}//${window.location.host}/api/run/${run_id}/edges_results/${OUTPUT_FIELDS[field]}/${interval}/${z}/${x}/${y}.bin`);
+    if (!response.ok || field !== results.field) {
+      return;
+    }
+    // Edge ids followed by the values (float32).
+    const buffer = await response.arrayBuffer();
+    const IdArray = idArrayType(response);
+    const n = buffer.byteLength / (IdArray.BYTES_PER_ELEMENT + 4);
+    const ids = new IdArray(buffer, 0, n);
+    const values = new Float32Array(buffer, IdArray.BYTES_PER_ELEMENT * n, n);
+    for (let i = 0; i < n; i++) {
+      map.setFeatureState(roadFeature(ids[i]), {
+        [field]: Number.isNaN(values[i]) ? null : values[i]});
+    }
+  }
+
+  async function showResultInterval(interval) {
+    results.interval = interval;
+    slider.value = interval;
+    current_time.innerText = formatTime(results.intervals[interval]);
+    const field = results.field;
+    await Promise.all(visibleTiles().map(
+      (tile) => loadResultTile(field, interval, tile)));
+  }
+
+  function stopResults() {
+    clearInterval(results.timer);
+    results.timer = null;
+  }
+
+  async function showResults(field) {
+    stopResults();
+    results.field = field;
+    const intervals = await getIntervals();
+    slider.max = intervals.length - 1;
+    const [min, max] = OUTPUT_RANGES[field];
+    map.setPaintProperty('lines', colorProperty, [
+      'interpolate-hcl', ['linear'],
+      ['to-number', edgeValue(field), min],
+      min, color1,
+      max, color2,
+    ]);
+    ColorScale(min, max, color1, color2);
+    await showResultInterval(0);
+  }
+
+  slider.addEventListener('input', () => {
+    if (tile_url && results.field) {
+      stopResults();
+      showResultInterval(Number(slider.value));
+    }
+  });
+  document.getElementById('btnPlay').addEventListener('click', () => {
+    if (!tile_url || !results.field || results.timer) {
+      return;
+    }
+    results.timer = setInterval(() => {
+      showResultInterval((results.interval + 1) % results.intervals.length);
+    }, 1500);
+  });
+  document.getElementById('btnPause').addEventListener('click', stopResults);
+
   /* The following convert hex code to rgb */
   function hex2rgb(hex) {
     var validHEXInput = /^#?([a-f\d]{2})([a-f\d]{2})([a-f\d]{2})$/i.exec(hex);
@@ -67,9 +220,9 @@
   
   function InputSetPaintProperty(field, array, min, color2){
     let max = Math.max(...array);
-     map.setPaintProperty('lines', 'fill-color', [
+     map.setPaintProperty('lines', colorProperty, [
         'interpolate-hcl', ['linear'],
-        ['get', field],
+        edgeValue(field),
         min, color1, //'rgb(255, 245,0 )',
         max, color2, //'rgb(255, 0, 0)',
       ]);
@@ -107,9 +260,9 @@
           });
         var max_of_max = Math.max(..._max_)
         var max = Math.round(Math.max(..._data)); 
-        map.setPaintProperty('lines', 'fill-color', [
+        map.setPaintProperty('lines', colorProperty, [
           'interpolate-hcl', ['linear'],
-           ['at', counter, ['get', field]],
+           ['at', counter, edgeValue(field)],
             min, color1,
             max, color2,
           ]);
@@ -127,32 +280,18 @@
   async function linkDropDown() {
     d3.select('#linkLegendSvg').remove();
     document.getElementById('console').style.display = 'none'
+    stopResults();
+    results.field = null;
   
     if (linkSelector.value == "default") {
-      map.setPaintProperty('lines', 'fill-color', ['get', 'color'])
+      map.setPaintProperty('lines', colorProperty, ['get', 'color'])
     }
     else if (linkSelector.value == "lanes") {
       d3.select('#linkLegendSvg').remove();
   
-      /* The following IF block is to avoid to re-excute the same piece of code
-        two times. The id is for the first time we select 'lanes' the IF statement is
-        executed. But for the second (without refreshing the browser) the ELSE is executed.
-        So in this way, we won't query the api twice and adding the lanes from the api. */
-      if (typeof data.features[0].properties.lanes == 'undefined') {
-        var lanes = await GetFieldAttribute("lanes")
-  
-        // Adding lanes from the api as the map properties
-        data.features.map(
-          item => {
-            item.properties.lanes = lanes[item.properties.edge_id];
-          });
-        //Updating the already map data.
-        map.getSource('roads').setData(data);
-        var lanes_array = Object.values(lanes);
-      }
-      else {
-        var lanes_array = data.features.map(item => item.properties.lanes)
-      }
+      /* The values are only queried from the api the first time the field is
+        selected (see getEdgeValues). */
+      var lanes_array = Object.values(await getEdgeValues("lanes"));
       var min = 1;
       InputSetPaintProperty('lanes', lanes_array, min, color2)
   
@@ -163,20 +302,7 @@
     }
     else if (linkSelector.value == "length") {
       d3.select('#linkLegendSvg').remove();
-      if (typeof data.features[0].properties.length == 'undefined') {
-        const length = await GetFieldAttribute("length")
-        // Adding length from the api as the map properties
-        data.features.map(
-          item => {
-            item.properties.length = length[item.properties.edge_id]
-          });
-        //Updating the already map data.
-        map.getSource('roads').setData(data)
-        var length_array = Object.values(length);
-      }
-      else {
-        var length_array = data.features.map(item => item.properties.length)
-      }
+      var length_array = Object.values(await getEdgeValues("length"));
       let min = 0;
       InputSetPaintProperty('length', length_array, min,color2)
   
@@ -187,20 +313,7 @@
     }
     else if (linkSelector.value == "speed") {
       d3.select('#linkLegendSvg').remove();
-      if (typeof data.features[0].properties.speed == 'undefined') {
-        const speed = await GetFieldAttribute("speed")
-        // Adding speed from the api as the map properties
-        data.features.map(
-          item => {
-            item.properties.speed = speed[item.properties.edge_id]
-          });
-        //Updating the already map data.
-        map.getSource('roads').setData(data)
-        var speed_array = Object.values(speed);
-      }
-      else {
-        var speed_array = data.features.map(item => item.properties.speed)
-      }
+      var speed_array = Object.values(await getEdgeValues("speed"));
   
      let min = 0; 
       InputSetPaintProperty('speed',speed_array, min, color2)
@@ -211,15 +324,16 @@
       });
     }
     /*................. The output value .....................*/
+    else if (tile_url && linkSelector.value in OUTPUT_FIELDS) {
+      d3.select('#linkLegendSvg').remove();
+      await showResults(linkSelector.value);
+      document.getElementById('console').style.display = 'block'
+    }
     else if (linkSelector.value === "speed_output") {
       d3.select('#linkLegendSvg').remove();
       const speed_output = await GetOutputFieldAttribute("speed")
       console.log(speed_output)
-      data.features.map(
-        feature => {
-          feature.properties.speed_output = speed_output[feature.properties.edge_id]
-        });
-      map.getSource('roads').setData(data)
+      setEdgeValues('speed_output', speed_output)
       var speed_output_array = Object.values(speed_output)
       //console.log(speed_output_array)
       let min = 0; 
@@ -227,9 +341,9 @@
       document.getElementById('console').style.display = 'block'
   
       /* To execute the first position (first hour) when a field is selected */
-      map.setPaintProperty('lines', 'fill-color', [
+      map.setPaintProperty('lines', colorProperty, [
         'interpolate-hcl', ['linear'],
-        ['at', 0, ['get', 'speed_output']],
+        ['at', 0, edgeValue('speed_output')],
         0, color1,
         130, color2,
       ]);
@@ -238,20 +352,16 @@
     else if (linkSelector.value === "congestion") {
       d3.select('#linkLegendSvg').remove();
       const congestion = await GetOutputFieldAttribute("congestion")
-      data.features.map(
-        feature => {
-          feature.properties.congestion = congestion[feature.properties.edge_id]
-        });
-      map.getSource('roads').setData(data)
+      setEdgeValues('congestion', congestion)
       var congestion_array = Object.values(congestion)
       let min = 0; 
       OutputSetPaintProperty('congestion', congestion_array, min)
       document.getElementById('console').style.display = 'block'
   
       /* To execute the first position (first hour) when a field is selected */
-      map.setPaintProperty('lines', 'fill-color', [
+      map.setPaintProperty('lines', colorProperty, [
         'interpolate-hcl', ['linear'],
-        ['at', 0, ['get', 'congestion']],
+        ['at', 0, edgeValue('congestion')],
         0, color1,
         1, color2,
       ]);
@@ -260,20 +370,16 @@
       d3.select('#linkLegendSvg').remove();
       const travel_time = await GetOutputFieldAttribute("travel_time")
   
-      data.features.map(
-        feature => {
-          feature.properties.travel_time = travel_time[feature.properties.edge_id]
-        });
-      map.getSource('roads').setData(data)
+      setEdgeValues('travel_time', travel_time)
       var travel_time_array = Object.values(travel_time)
       let min = 0; 
       OutputSetPaintProperty('travel_time', travel_time_array, min)
       document.getElementById('console').style.display = 'block'
   
       /* To execute the first position (first hour) when a field is selected */
-      map.setPaintProperty('lines', 'fill-color', [
+      map.setPaintProperty('lines', colorProperty, [
         'interpolate-hcl', ['linear'],
-        ['at', 0, ['get', 'travel_time']],
+        ['at', 0, edgeValue('travel_time')],
         0, color1,
         2000, color2,
       ]);
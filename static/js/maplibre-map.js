@@ -1,7 +1,6 @@
 // Get url of the current network
 current_url = window.location.href // document.url
 network_id = parseInt(current_url.split('/')[5]) // Get networ id
-var total_bounds = data['total_bounds']
 
 if (network_type) {
   var map = new maplibregl.Map({
@@ -26,7 +25,76 @@ map.addControl(new maplibregl.FullscreenControl())
 
 var hoveredStateId = null;
 
+// Paint property of the color of the edges (the tiles contain lines, the
+// GeoJSON contains the road polygons).
+const colorProperty = tile_url ? 'line-color' : 'fill-color';
+
+// Returns the identifier of a feature of the edges, for setFeatureState.
+function roadFeature(id) {
+  if (tile_url) {
+    return {source: 'roads', sourceLayer: 'edges', id: id};
+  }
+  return {source: 'roads', id: id};
+}
+
+// Returns the expression of the value of a field of the edges, as set by
+// setEdgeValues.
+function edgeValue(field) {
+  return tile_url ? ['feature-state', field] : ['get', field];
+}
+
+// Sets the values of a field of the edges ({edge_id: value}), as feature
+// states of the tiles or as properties of the GeoJSON features.
+function setEdgeValues(field, values) {
+  if (tile_url) {
+    for (const [edge_id, value] of Object.entries(values)) {
+      map.setFeatureState(roadFeature(Number(edge_id)), {[field]: value});
+    }
+  } else {
+    data.features.map(
+      item => {
+        item.properties[field] = values[item.properties.edge_id];
+      });
+    map.getSource('roads').setData(data);
+  }
+}
+
 function addDataLayer() {
+  if (tile_url) {
+    map.addSource('roads', {
+      type: 'vector',
+      tiles: [tile_url],
+      maxzoom: 16,
+      promoteId: {'edges': 'edge_id'},
+    })
+    // The width of the edges is proportional to their number of lanes and
+    // the two-way edges are offset to the right (the zoom must be the input
+    // of the top-level expression).
+    const zoomScaled = (value) => ['interpolate', ['exponential', 2],
+                                   ['zoom'],
+                                   10, ['*', 0.5, value],
+                                   18, ['*', 8, value]];
+    const lanes = ['get', 'lanes'];
+    map.addLayer({
+      'id': 'lines',
+      'type': 'line',
+      'source': 'roads',
+      'source-layer': 'edges',
+      'paint': {
+        'line-color': ['get', 'color'],
+        'line-width': zoomScaled(lanes),
+        'line-offset': zoomScaled(
+          ['case', ['get', 'oneway'], 0, ['/', lanes, 2]]),
+        'line-opacity': [
+          'case',
+          ['boolean', ['feature-state', 'hover'], false],
+          1,
+          0.6
+        ]
+      }
+    })
+    return;
+  }
   map.addSource('roads', {
     type: 'geojson',
     data: data,
@@ -58,6 +126,13 @@ map.on('styledata', function () {
 
 map.on('load', function () {
   map.fitBounds(total_bounds)
+  // The results of the newly visible tiles are loaded for the current
+  // interval (see showResults).
+  map.on('moveend', () => {
+    if (tile_url && results.field) {
+      showResultInterval(results.interval);
+    }
+  });
   // Create a popup, but don't add it to the map yet.
   var popup = new maplibregl.Popup({
     closeButton: false,
@@ -76,18 +151,12 @@ map.on('load', function () {
 
     if (e.features.length > 0) {
       if (hoveredStateId !== null) {
-        map.setFeatureState({
-          source: 'roads',
-          id: hoveredStateId
-        }, {
+        map.setFeatureState(roadFeature(hoveredStateId), {
           hover: false
         });
       }
       hoveredStateId = e.features[0].id; // id is the autogenerated id
-      map.setFeatureState({
-        source: 'roads',
-        id: hoveredStateId
-      }, {
+      map.setFeatureState(roadFeature(hoveredStateId), {
         hover: true
       });
     }//End if
@@ -106,10 +175,7 @@ map.on('load', function () {
    previously hovered feature. */
   map.on('mouseleave', 'lines', () => {
     if (hoveredStateId !== null) {
-      map.setFeatureState({
-        source: 'roads',
-        id: hoveredStateId
-      }, {
+      map.setFeatureState(roadFeature(hoveredStateId), {
         hover: false
       });
     }